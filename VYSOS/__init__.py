@@ -1,5 +1,10 @@
+import os
 from astropy import units as u
 
+mongo_address = '192.168.1.101'
+mongo_port = 27017
+mongo_db = 'vysos'
+
 weather_limits = {'Cloudiness (C)': [-35, -20],
                   'Wind (kph)': [20, 40],
                   'Rain': [2400, 2000],
@@ -52,15 +57,16 @@ class Telescope(object):
     '''This object stores some basic info about the telescope in use (either
     V5 or V20).
     '''
-    def __init__(self, name):
+    def __init__(self, name, simulate=None):
         self.name = name
-        self.mongo_address = '192.168.1.101'
-        self.mongo_port = 27017
-        self.mongo_db = 'vysos'
+        self.mongo_address = mongo_address
+        self.mongo_port = mongo_port
+        self.mongo_db = mongo_db
         self.mongo_collection = 'images'
         self.units_for_FWHM = u.pix
         self.get_pixel_scale()
         self.get_limits()
+        self.get_devices(simulate)
     
     def get_pixel_scale(self):
         if self.name == 'V20':
@@ -87,3 +93,15 @@ class Telescope(object):
             self.ellipticity_limit = None
             self.pointing_error_limit = None
 
+    def get_devices(self, simulate=None):
+        '''The devices queried for status (see VYSOS.devices).  Simulated
+        devices are used if simulate is True or, if it is not given, if the
+        VYSOS_SIMULATE environment variable is set.
+        '''
+        if simulate is None:
+            simulate = os.environ.get('VYSOS_SIMULATE', '') not in ['', '0']
+        self.simulate = simulate
+        if self.name.startswith('V20'):
+            self.devices = ['telescope', 'focuser', 'tcc']
+        else:
+            self.devices = ['telescope', 'focuser']
@@ -0,0 +1,157 @@
+'''
+Match exposures to telemetry by time.
+
+Each exposure covers the window [date, date+exptime].  asof_join matches a
+set of windows to a time series (e.g. V5status focuser_temperature) in one
+vectorized pass: the telemetry is sorted once and np.searchsorted finds the
+samples inside each window, so there is no query or loop per exposure.
+The result for each window is either the sample nearest the middle of the
+window or an aggregate (mean, first, last) of the samples inside it.
+'''
+
+from datetime import timedelta as tdelta
+import numpy as np
+import pymongo
+
+from VYSOS.db import get_db
+
+
+aggregates = ['nearest', 'mean', 'first', 'last']
+
+
+def to_seconds(dates):
+    '''Convert a sequence of datetimes (or a datetime64 array) to float
+    seconds since 1970.
+    '''
+    return np.asarray(dates, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+
+##-------------------------------------------------------------------------
+## As-Of Join
+##-------------------------------------------------------------------------
+def asof_join(starts, ends, times, columns, how='mean', tolerance=None):
+    '''Match each window [starts[i], ends[i]] to the telemetry samples at
+    times and return a dict of arrays, one per column, plus n (the number of
+    samples in each window).
+
+    starts, ends and times are datetimes or seconds (see to_seconds) and
+    columns is a dict of arrays the same length as times.  how is one of:
+
+      - nearest: the sample nearest the middle of the window
+      - mean: the mean of the (finite) samples in the window
+      - first, last: the first or last sample in the window
+
+    For the window aggregates, a window with no samples in it gets the
+    nearest sample instead if that is within tolerance seconds of the
+    window, otherwise NaN.  For nearest, samples further than tolerance
+    seconds from the middle of the window give NaN.
+    '''
+    if how not in aggregates:
+        raise ValueError(f'how must be one of {aggregates}')
+    starts = np.atleast_1d(np.asarray(starts))
+    ends = np.atleast_1d(np.asarray(ends))
+    times = np.asarray(times)
+    if starts.dtype.kind != 'f':
+        starts = to_seconds(starts)
+    if ends.dtype.kind != 'f':
+        ends = to_seconds(ends)
+    if times.dtype.kind != 'f':
+        times = to_seconds(times)
+
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    columns = {name: np.asarray(values, dtype=float)[order]
+               for name, values in columns.items()}
+
+    lo = np.searchsorted(times, starts, side='left')
+    hi = np.searchsorted(times, ends, side='right')
+    result = {'n': hi - lo}
+
+    ## Nearest sample to the middle of each window
+    middle = (starts + ends) / 2
+    if len(times) > 0:
+        after = np.searchsorted(times, middle)
+        before = np.clip(after - 1, 0, len(times)-1)
+        after = np.clip(after, 0, len(times)-1)
+        nearest = np.where(middle - times[before] <= times[after] - middle, before, after)
+        distance = np.abs(times[nearest] - middle)
+        if how != 'nearest':
+            ## distance from the window edge rather than its middle
+            distance = np.maximum(distance - (ends - starts) / 2, 0)
+        if tolerance is not None:
+            near_ok = distance <= tolerance
+        else:
+            near_ok = np.full(len(starts), how == 'nearest')
+    else:
+        nearest = np.zeros(len(starts), dtype=int)
+        near_ok = np.zeros(len(starts), dtype=bool)
+
+    empty = result['n'] == 0
+    for name, values in columns.items():
+        if len(values) == 0:
+            result[name] = np.full(len(starts), np.nan)
+            continue
+        if how == 'nearest':
+            matched = values[nearest]
+            result[name] = np.where(near_ok, matched, np.nan)
+            continue
+        if how == 'mean':
+            finite = np.isfinite(values)
+            sums = np.concatenate([[0.], np.cumsum(np.where(finite, values, 0.))])
+            counts = np.concatenate([[0], np.cumsum(finite)])
+            n = counts[hi] - counts[lo]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                matched = np.where(n > 0, (sums[hi] - sums[lo]) / np.maximum(n, 1), np.nan)
+        elif how == 'first':
+            matched = values[np.clip(lo, 0, len(values)-1)]
+        elif how == 'last':
+            matched = values[np.clip(hi-1, 0, len(values)-1)]
+        matched = np.where(empty, np.nan, matched)
+        result[name] = np.where(empty & near_ok, values[nearest], matched)
+    return result
+
+
+##-------------------------------------------------------------------------
+## Load Telemetry
+##-------------------------------------------------------------------------
+def load_telemetry(collection_name, start, end, fields, db=None):
+    '''Return (times, columns) for the collection between start and end
+    from a single date sorted query.  Missing or non-numeric values are NaN.
+    '''
+    if db is None:
+        db = get_db()
+    projection = {field: 1 for field in fields}
+    projection.update({'date': 1, '_id': 0})
+    documents = list(db[collection_name].find({'date': {'$gte': start, '$lte': end}},
+                                              projection=projection,
+                                              sort=[('date', pymongo.ASCENDING)]))
+    times = to_seconds([d['date'] for d in documents])
+    columns = {}
+    for field in fields:
+        values = [d.get(field, None) for d in documents]
+        columns[field] = np.array([float(v) if isinstance(v, (int, float)) else np.nan
+                                   for v in values], dtype=float)
+    return times, columns
+
+
+def match_images(images, collection_name, fields, how='mean', tolerance=60, db=None):
+    '''Add telemetry fields to a list of image documents (each with date and
+    exptime) using one query for the telemetry spanning all of the images.
+    Values which could not be matched are left out of the documents.
+    '''
+    images = [image for image in images if 'date' in image]
+    if len(images) == 0:
+        return images
+    starts = to_seconds([image['date'] for image in images])
+    ends = starts + np.array([image.get('exptime', 0) or 0 for image in images], dtype=float)
+    padding = tdelta(0, float(max(ends - starts)) + (tolerance or 0))
+    times, columns = load_telemetry(collection_name,
+                                    min(image['date'] for image in images) - padding,
+                                    max(image['date'] for image in images) + padding,
+                                    fields, db=db)
+    matched = asof_join(starts, ends, times, columns, how=how, tolerance=tolerance)
+    for i, image in enumerate(images):
+        for field in fields:
+            if np.isfinite(matched[field][i]):
+                image[field] = float(matched[field][i])
+    return images
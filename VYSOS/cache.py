@@ -0,0 +1,77 @@
+'''
+Small in-process caches for values which are expensive to compute but are
+requested far more often than they change (e.g. by the status pages which
+are reloaded every few seconds).
+'''
+
+import os
+import glob
+import time
+import threading
+
+
+##-------------------------------------------------------------------------
+## Time To Live Cache
+##-------------------------------------------------------------------------
+class TTLCache(object):
+    '''Cache values by key, each with its own time to live.  The cache is
+    thread safe and the value for a key is computed at most once per expiry
+    even if several threads ask for it at the same time.
+    '''
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, key, compute, ttl):
+        '''Return the cached value for key, calling compute() to refresh it
+        if it is missing or older than ttl seconds.
+        '''
+        entry = self.values.get(key, None)
+        if entry is not None and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            ## Another thread may have refreshed the value while we waited
+            entry = self.values.get(key, None)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+            value = compute()
+            self.values[key] = (time.monotonic(), value)
+            return value
+
+    def invalidate(self, key=None):
+        '''Remove key (or all keys) from the cache.
+        '''
+        if key is None:
+            self.values.clear()
+        else:
+            self.values.pop(key, None)
+
+
+##-------------------------------------------------------------------------
+## Directory Listing Cache
+##-------------------------------------------------------------------------
+class GlobCache(object):
+    '''Cache glob results for a directory, refreshing them only when the
+    mtime of the directory changes (i.e. when a file is added, removed, or
+    renamed).  A missing directory gives an empty list.
+    '''
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def glob(self, directory, pattern):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return []
+        key = (directory, pattern)
+        entry = self.values.get(key, None)
+        if entry is not None and entry[0] == mtime:
+            return list(entry[1])
+        result = glob.glob(os.path.join(directory, pattern))
+        with self.lock:
+            self.values[key] = (mtime, result)
+        return list(result)
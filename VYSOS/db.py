@@ -0,0 +1,88 @@
+'''
+Shared MongoDB client handling for the VYSOS tools.
+
+pymongo's MongoClient maintains its own connection pool and is thread safe,
+so each process should create one client per server and reuse it rather than
+connecting and disconnecting on every query.
+'''
+
+import os
+import threading
+import pymongo
+
+from VYSOS import mongo_address, mongo_port, mongo_db
+
+
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+
+
+##-------------------------------------------------------------------------
+## Get Client
+##-------------------------------------------------------------------------
+def get_client(address=None, port=None, check=False):
+    '''Return the process-wide MongoClient for the given address and port
+    (defaults to the VYSOS mongo server).
+
+    The client is created lazily (connect=False) so no network traffic occurs
+    until the first operation.  Clients are not fork safe, so if this is
+    called in a child process (e.g. a multiprocessing worker) any clients
+    inherited from the parent are discarded and new ones created.  If check
+    is True, the server is pinged and the client replaced if it is unhealthy.
+    '''
+    global _clients_pid
+    if address is None:
+        address = mongo_address
+    if port is None:
+        port = mongo_port
+
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get((address, port), None)
+        if client is None:
+            client = pymongo.MongoClient(address, port, connect=False)
+            _clients[(address, port)] = client
+
+    if check and not is_healthy(client):
+        with _lock:
+            if _clients.get((address, port), None) is client:
+                del _clients[(address, port)]
+        client.close()
+        client = get_client(address=address, port=port)
+
+    return client
+
+
+##-------------------------------------------------------------------------
+## Health Check
+##-------------------------------------------------------------------------
+def is_healthy(client):
+    '''Ping the server and return True if it responds.
+    '''
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        return False
+    return True
+
+
+##-------------------------------------------------------------------------
+## Get Database and Collection
+##-------------------------------------------------------------------------
+def get_db(tel=None, check=False):
+    '''Return the vysos database.  If a Telescope object is given, its mongo
+    configuration is used.
+    '''
+    if tel is None:
+        return get_client(check=check)[mongo_db]
+    client = get_client(address=tel.mongo_address, port=tel.mongo_port, check=check)
+    return client[tel.mongo_db]
+
+
+def get_collection(name, tel=None, check=False):
+    '''Return the named collection in the vysos database.
+    '''
+    return get_db(tel=tel, check=check)[name]
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Create and verify the indexes used by the VYSOS tools on the vysos mongo
+database and report the query plan for each of the query shapes used in the
+code.
+"""
+
+import sys
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+import pymongo
+
+from VYSOS import mongo_address
+from VYSOS.db import get_db
+from VYSOS.rollup import rollup_collections
+
+
+telemetry_collections = ['weather', 'V20status', 'V5status']
+
+## (collection, keys, options) for each index
+indexes = [('weather', [('date', pymongo.DESCENDING)], {'unique': True}),
+           ('V20status', [('date', pymongo.DESCENDING)], {}),
+           ('V5status', [('date', pymongo.DESCENDING)], {}),
+           ('images', [('date', pymongo.DESCENDING)], {}),
+           ('images', [('filename', pymongo.ASCENDING)], {'unique': True}),
+           ('images', [('telescope', pymongo.ASCENDING), ('date', pymongo.DESCENDING)], {}),
+           ('images', [('target name', pymongo.ASCENDING), ('date', pymongo.DESCENDING)], {}),
+          ]
+indexes.extend([(name, [('date', pymongo.ASCENDING)], {'unique': True})
+                for name in rollup_collections()])
+
+
+##-------------------------------------------------------------------------
+## Create Indexes
+##-------------------------------------------------------------------------
+def create_indexes(db):
+    '''Create each of the indexes (this is a no-op for indexes which already
+    exist) and return True if all of them are present afterwards.
+    '''
+    ok = True
+    for collection, keys, options in indexes:
+        try:
+            try:
+                name = db[collection].create_index(keys, **options)
+            except pymongo.errors.OperationFailure as e:
+                ## An index on these keys exists with other options (e.g. it
+                ## was created before it was made unique), replace it.
+                if e.code not in [85, 86]:
+                    raise
+                existing = [x['name'] for x in db[collection].list_indexes()
+                            if list(x['key'].items()) == [(k, v) for k, v in keys]]
+                for index_name in existing:
+                    db[collection].drop_index(index_name)
+                name = db[collection].create_index(keys, **options)
+            print(f"  {collection:10s} {name}")
+        except pymongo.errors.DuplicateKeyError:
+            print(f"  {collection:10s} FAILED to create unique index {keys}, "
+                  f"{collection} has documents with the same {keys[0][0]}, "
+                  f"run with --dedup to remove them first")
+            ok = False
+        except pymongo.errors.PyMongoError as e:
+            print(f"  {collection:10s} FAILED to create {keys}: {e}")
+            ok = False
+    print('Verifying indexes')
+    for collection, keys, options in indexes:
+        existing = [list(x['key'].items()) for x in db[collection].list_indexes()]
+        if [(k, v) for k, v in keys] not in existing:
+            print(f"  {collection:10s} missing index on {keys}")
+            ok = False
+    return ok
+
+
+def set_ttl(db, days):
+    '''Expire raw telemetry (weather and status) documents older than the
+    given number of days using a TTL index on date.
+    '''
+    seconds = int(days*24*60*60)
+    for collection in telemetry_collections:
+        ttl_index = [x for x in db[collection].list_indexes() if x['name'] == 'date_ttl']
+        if len(ttl_index) == 0:
+            db[collection].create_index([('date', pymongo.ASCENDING)],
+                                        name='date_ttl', expireAfterSeconds=seconds)
+        elif ttl_index[0].get('expireAfterSeconds', None) != seconds:
+            db.command('collMod', collection,
+                       index={'name': 'date_ttl', 'expireAfterSeconds': seconds})
+        print(f"  {collection:10s} documents expire after {days} days")
+
+
+def remove_ttl(db):
+    for collection in telemetry_collections:
+        if 'date_ttl' in [x['name'] for x in db[collection].list_indexes()]:
+            db[collection].drop_index('date_ttl')
+            print(f"  {collection:10s} removed TTL index")
+
+
+##-------------------------------------------------------------------------
+## Remove Duplicates
+##-------------------------------------------------------------------------
+def unique_keys():
+    '''Return (collection, key) for each of the unique indexes.
+    '''
+    return [(collection, keys[0][0]) for collection, keys, options in indexes
+            if options.get('unique', False)]
+
+
+def remove_duplicates(db, collection='weather', key='date'):
+    '''Delete all but the first document for each value of key, so that a
+    unique index can be built.
+    '''
+    pipeline = [{'$group': {'_id': f'${key}',
+                            'ids': {'$push': '$_id'},
+                            'n': {'$sum': 1}}},
+                {'$match': {'n': {'$gt': 1}}},
+               ]
+    n_deleted = 0
+    for entry in db[collection].aggregate(pipeline, allowDiskUse=True):
+        duplicates = sorted(entry['ids'])[1:]
+        n_deleted += db[collection].delete_many({'_id': {'$in': duplicates}}).deleted_count
+    print(f"  {collection:10s} removed {n_deleted} duplicate documents")
+    return n_deleted
+
+
+##-------------------------------------------------------------------------
+## Explain Query Plans
+##-------------------------------------------------------------------------
+def plan_stages(plan):
+    '''Return the list of stage names in a winning plan, outermost first.
+    '''
+    stages = [plan.get('stage', '?')]
+    if 'inputStage' in plan.keys():
+        stages.extend(plan_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(plan_stages(input_stage))
+    return stages
+
+
+def query_shapes():
+    '''Return a list of (description, collection, filter, sort, limit) for
+    the queries made by the VYSOS tools.
+    '''
+    end = dt.utcnow()
+    start = end - tdelta(1)
+    return [
+        ('latest weather (Status, dash)', 'weather', {}, [('date', pymongo.DESCENDING)], 1),
+        ('weather over time range (plots)', 'weather',
+         {'date': {'$gt': start, '$lt': end}}, [('date', pymongo.ASCENDING)], 0),
+        ('latest V20 status (Status, dash)', 'V20status', {}, [('date', pymongo.DESCENDING)], 1),
+        ('latest V5 status (Status, dash)', 'V5status', {}, [('date', pymongo.DESCENDING)], 1),
+        ('V20 status over time range (plots)', 'V20status',
+         {'date': {'$gt': start, '$lt': end}}, None, 0),
+        ('image by filename (watch_directory, ImageDetailPage)', 'images',
+         {'filename': {'$in': ['V20_test.fts']}}, None, 0),
+        ('images for night (ListOfImages)', 'images',
+         {'date': {'$gt': start, '$lt': end}}, [('date', pymongo.ASCENDING)], 0),
+        ('images for telescope and night', 'images',
+         {'telescope': 'V20', 'date': {'$gt': start, '$lt': end}}, [('date', pymongo.DESCENDING)], 0),
+        ('images for target (ListOfImages)', 'images',
+         {'target name': 'test'}, [('date', pymongo.DESCENDING)], 0),
+    ]
+
+
+def explain_queries(db):
+    for description, collection, query, sort, limit in query_shapes():
+        cursor = db[collection].find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        if limit > 0:
+            cursor = cursor.limit(limit)
+        try:
+            explanation = cursor.explain()
+            stages = plan_stages(explanation['queryPlanner']['winningPlan'])
+        except pymongo.errors.PyMongoError as e:
+            stages = [f'explain failed: {e}']
+        flag = 'WARNING' if 'COLLSCAN' in stages or 'SORT' in stages else 'ok'
+        print(f"  {flag:7s} {description}: {' <- '.join(stages)}")
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def main():
+    parser = ArgumentParser(description="Create and verify indexes on the vysos database")
+    ## add flags
+    parser.add_argument("--explain",
+        action="store_true", dest="explain",
+        default=False, help="Report query plans for each query shape used by the code.")
+    parser.add_argument("--dedup",
+        action="store_true", dest="dedup",
+        default=False, help="Remove duplicate documents (e.g. weather with the same date, images "
+                            "with the same filename) before creating the unique indexes.")
+    parser.add_argument("--no-ttl",
+        action="store_true", dest="nottl",
+        default=False, help="Remove the TTL index on raw telemetry.")
+    ## add arguments
+    parser.add_argument("--ttl",
+        dest="ttl", required=False, type=float, default=None,
+        help="Expire raw weather and status documents after this many days.")
+    args = parser.parse_args()
+
+    db = get_db(check=True)
+    if args.dedup:
+        print('Removing duplicate documents')
+        for collection, key in unique_keys():
+            remove_duplicates(db, collection, key)
+    print(f'Creating indexes on {mongo_address}')
+    ok = create_indexes(db)
+    if args.ttl is not None:
+        print('Setting TTL on raw telemetry')
+        set_ttl(db, args.ttl)
+    elif args.nottl:
+        print('Removing TTL on raw telemetry')
+        remove_ttl(db)
+    if args.explain:
+        print('Query plans')
+        explain_queries(db)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+'''
+Interfaces to the devices queried for telescope status.
+
+Each device has a name, a polling interval (seconds), and a sample() method
+which returns a dict of values to add to the status document.  The real
+devices are ASCOM/COM objects (which need pywin32 and so only work on the
+Windows observatory computers) or the ControlByWeb module.  Each of them has
+a simulated counterpart which returns configurable values with configurable
+latency and error rate, so that the status, telemetry, and mongo write path
+can be run and load tested on any machine.
+
+Which implementation is used is set by the simulate attribute of the
+Telescope object (see get_devices).
+'''
+
+import re
+import time
+import random
+import urllib.request
+from collections import deque
+import numpy as np
+
+try:
+    import win32com.client
+    import pywintypes
+    import pythoncom
+except ImportError:
+    win32com = None
+    pywintypes = None
+    pythoncom = None
+
+
+class DeviceError(Exception):
+    pass
+
+
+def require_com():
+    if win32com is None:
+        raise DeviceError('COM devices need pywin32 (win32com), use simulated devices instead')
+
+
+def com_initialize():
+    '''COM objects must be created and used on a thread which has initialized
+    COM.  This does nothing if pywin32 is not available.
+    '''
+    if pythoncom is not None:
+        pythoncom.CoInitialize()
+
+
+##-------------------------------------------------------------------------
+## Device Interface
+##-------------------------------------------------------------------------
+class Device(object):
+    name = ''
+    interval = 5
+
+    def sample(self):
+        '''Return a dict of values for the status document.  An empty dict
+        means no values are available.  Raising an exception marks the
+        sample as failed.
+        '''
+        raise NotImplementedError
+
+
+##-------------------------------------------------------------------------
+## Running Median
+##-------------------------------------------------------------------------
+class RingMedian(object):
+    '''Keep the last n good values of a reading in a ring buffer and report
+    their median.  Values outside of the (low, high) range are discarded.
+    '''
+    def __init__(self, n, low=None, high=None):
+        self.values = deque(maxlen=n)
+        self.low = low
+        self.high = high
+
+    def add(self, value):
+        value = float(value)
+        if self.low is not None and value <= self.low:
+            return
+        if self.high is not None and value >= self.high:
+            return
+        self.values.append(value)
+
+    def clear(self):
+        self.values.clear()
+
+    def median(self, min_count=1):
+        if len(self.values) < min_count:
+            return None
+        return float(np.median(self.values))
+
+
+##-------------------------------------------------------------------------
+## Query ASCOM ACPHub for Telescope Position and State
+##-------------------------------------------------------------------------
+class ACPTelescope(Device):
+    name = 'ACP'
+    interval = 5
+
+    def __init__(self, logger):
+        require_com()
+        self.logger = logger
+        self.ACP = None
+
+    def sample(self):
+        if self.ACP is None:
+            try:
+                self.ACP = win32com.client.Dispatch("ACP.Telescope")
+            except:
+                self.logger.error('Could not connect to ACP ASCOM object.')
+                return {}
+
+        values = {}
+        try:
+            values['connected'] = self.ACP.Connected
+            self.logger.debug('  ACP Connected = {}'.format(values['connected']))
+            if values['connected']:
+                values['park'] = self.ACP.AtPark
+                values['slewing'] = self.ACP.Slewing
+                values['tracking'] = self.ACP.Tracking
+                values['alt'] = float(self.ACP.Altitude)
+                values['az'] = float(self.ACP.Azimuth)
+                self.logger.debug('  ACP park={park} slewing={slewing} tracking={tracking} '
+                                  'alt={alt:.2f} az={az:.2f}'.format(**values))
+                try:
+                    values['RA'] = self.ACP.TargetRightAscension * 15.0
+                    values['DEC'] = self.ACP.TargetDeclination
+                    self.logger.debug('  ACP target RA = {:.4f}, Dec = {:.4f}'.format(
+                                      values['RA'], values['DEC']))
+                except:
+                    self.logger.debug('  Could not get target info')
+        except pywintypes.com_error as err:
+            self.logger.warning('COM error:')
+            self.logger.warning('  {}'.format(err.message))
+            values['ACPerr'] = '{}'.format(err.message)
+            self.ACP = None
+        except:
+            values['connected'] = False
+            self.logger.warning('Queries to ACP object failed')
+            self.ACP = None
+
+        return values
+
+
+##-------------------------------------------------------------------------
+## Query ASCOM Focuser for Position, Temperature, Fan State
+##-------------------------------------------------------------------------
+class FocusMaxFocuser(Device):
+    name = 'FocusMax'
+    interval = 5
+
+    def __init__(self, logger):
+        require_com()
+        self.logger = logger
+        self.FocusMax = None
+        self.temperature = RingMedian(3)
+
+    def sample(self):
+        if self.FocusMax is None:
+            try:
+                self.FocusMax = win32com.client.Dispatch("FocusMax.Focuser")
+                self.logger.debug('  Connected to FocusMax')
+            except:
+                self.logger.error('Could not connect to FocusMax ASCOM object.')
+                return {}
+        try:
+            if not self.FocusMax.Link:
+                self.FocusMax.Link = True
+        except:
+            self.logger.warning('Could not start FocusMax ASCOM link.')
+            self.reset()
+            return {}
+
+        values = {}
+        try:
+            newtemp = float(self.FocusMax.Temperature)
+            self.logger.debug('  Queried FocusMax temperature = {:.1f}'.format(newtemp))
+            self.temperature.add(newtemp)
+            values['focuser_position'] = int(self.FocusMax.Position)
+        except:
+            ## Don't report the old median as if it were a new reading
+            self.logger.warning('Queries to FocusMax object failed')
+            self.reset()
+            return {}
+        ## Filter out bad values
+        median_temp = self.temperature.median()
+        if median_temp is not None and (median_temp > -10) and (median_temp < 150):
+            values['focuser_temperature'] = median_temp
+
+        return values
+
+    def reset(self):
+        '''Forget the COM object (so the next sample dispatches it again) and
+        the buffered readings.
+        '''
+        self.FocusMax = None
+        self.temperature.clear()
+
+
+##-------------------------------------------------------------------------
+## Query RCOS TCC
+##-------------------------------------------------------------------------
+class RCOSTCC(Device):
+    name = 'RCOS'
+    interval = 1
+
+    def __init__(self, logger):
+        require_com()
+        self.logger = logger
+        self.RCOST = None
+        self.RCOSF = None
+        ## Median of the last 5 temperature readings (in F)
+        self.truss = RingMedian(5, low=20, high=120)
+        self.primary = RingMedian(5, low=20, high=120)
+        self.secondary = RingMedian(5, low=20, high=120)
+        self.fan_speed = RingMedian(5)
+
+    def sample(self):
+        if self.RCOST is None or self.RCOSF is None:
+            try:
+                self.RCOST = win32com.client.Dispatch("RCOS_AE.Temperature")
+                self.RCOSF = win32com.client.Dispatch("RCOS_AE.Focuser")
+                self.logger.debug('  Connected to RCOS focuser')
+            except:
+                self.logger.error('Could not connect to RCOS ASCOM object.')
+                return {}
+
+        try:
+            self.truss.add(self.RCOST.AmbientTemp)
+            self.primary.add(self.RCOST.PrimaryTemp)
+            self.secondary.add(self.RCOST.SecondaryTemp)
+            self.fan_speed.add(self.RCOST.FanSpeed)
+        except:
+            ## Don't report the old medians as if they were new readings
+            self.logger.warning('Queries to RCOS object failed')
+            self.reset()
+            return {}
+
+        values = {}
+        for key, reading in [('truss_temperature', self.truss),
+                             ('primary_temperature', self.primary),
+                             ('secondary_temperature', self.secondary)]:
+            median = reading.median(min_count=3)
+            if median is not None:
+                values[key] = (median - 32.)/1.8
+        fan_speed = self.fan_speed.median(min_count=3)
+        if fan_speed is not None:
+            values['fan_speed'] = fan_speed
+
+        return values
+
+    def reset(self):
+        '''Forget the COM objects (so the next sample dispatches them again)
+        and the buffered readings.
+        '''
+        self.RCOST = None
+        self.RCOSF = None
+        for reading in [self.truss, self.primary, self.secondary, self.fan_speed]:
+            reading.clear()
+
+
+##-------------------------------------------------------------------------
+## Query ControlByWeb Temperature Module for Temperature and Fan State
+##-------------------------------------------------------------------------
+class ControlByWeb(Device):
+    name = 'CBW'
+    interval = 10
+
+    def __init__(self, logger, address='http://192.168.1.115/state.xml'):
+        self.logger = logger
+        self.address = address
+
+    def sample(self):
+        response = urllib.request.urlopen(self.address, timeout=5)
+        raw_result = response.read().decode()
+        tunits = re.search('<units>(\w+)</units>', raw_result).group(1)
+        assert tunits in ['F', 'C']
+        temp1 = float(re.search('<sensor1temp>(\d+\.\d*)</sensor1temp>', raw_result).group(1))
+        r1state = bool(int(re.search('<relay1state>(\d)</relay1state>', raw_result).group(1)))
+        r2state = bool(int(re.search('<relay2state>(\d)</relay2state>', raw_result).group(1)))
+
+        if tunits == 'C':
+            temp1 = temp1*9./5. + 32.
+            tunits = 'F'
+
+        return {'dome_temperature': temp1,
+                'fan_state': r1state,
+                'fan_enable': r2state}
+
+
+##-------------------------------------------------------------------------
+## Simulated Devices
+##-------------------------------------------------------------------------
+## Nominal values for each kind of device.  Float values get gaussian noise
+## of the given fractional size added when they are sampled.
+simulated_values = {
+    'telescope': {'connected': True, 'park': False, 'slewing': False,
+                  'tracking': True, 'alt': 55.0, 'az': 180.0,
+                  'RA': 150.0, 'DEC': 20.0},
+    'focuser': {'focuser_temperature': 8.0, 'focuser_position': 5000},
+    'tcc': {'truss_temperature': 7.5, 'primary_temperature': 8.5,
+            'secondary_temperature': 8.0, 'fan_speed': 100.},
+    'cbw': {'dome_temperature': 48., 'fan_state': True, 'fan_enable': True},
+}
+
+
+class SimulatedDevice(Device):
+    '''A device which returns the given values after the given latency
+    (seconds, with uniform jitter of the given size).  A fraction error_rate
+    of the samples raise DeviceError instead.
+    '''
+    def __init__(self, name, values, interval=5, latency=0., jitter=0.,
+                 error_rate=0., noise=0.01):
+        self.name = name
+        self.values = dict(values)
+        self.interval = interval
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.noise = noise
+
+    def sample(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.error_rate:
+            raise DeviceError(f'Simulated failure of {self.name}')
+        values = {}
+        for key, value in self.values.items():
+            if callable(value):
+                value = value()
+            elif isinstance(value, float):
+                value = random.gauss(value, abs(value)*self.noise)
+            values[key] = value
+        return values
+
+
+##-------------------------------------------------------------------------
+## Get Devices for a Telescope
+##-------------------------------------------------------------------------
+com_devices = {'telescope': ACPTelescope,
+               'focuser': FocusMaxFocuser,
+               'tcc': RCOSTCC,
+               'cbw': ControlByWeb,
+              }
+
+simulated_intervals = {'telescope': ACPTelescope.interval,
+                       'focuser': FocusMaxFocuser.interval,
+                       'tcc': RCOSTCC.interval,
+                       'cbw': ControlByWeb.interval,
+                      }
+
+
+def get_devices(tel, logger, latency=0., jitter=0., error_rate=0.):
+    '''Return the list of devices for the Telescope object.  If tel.simulate
+    is True these are simulated devices with the given latency and error
+    rate, otherwise they are the real (COM and ControlByWeb) devices.
+    '''
+    devices = []
+    for kind in tel.devices:
+        if tel.simulate:
+            devices.append(SimulatedDevice(f'{com_devices[kind].name}sim',
+                                           simulated_values[kind],
+                                           interval=simulated_intervals[kind],
+                                           latency=latency, jitter=jitter,
+                                           error_rate=error_rate))
+        else:
+            devices.append(com_devices[kind](logger))
+    return devices
@@ -0,0 +1,347 @@
+'''
+Vectorized sun and moon ephemerides for the VYSOS site.
+
+Positions are computed for a whole array of times in one call to astropy
+rather than stepping a pyephem Observer through a Python loop.  The sun and
+moon events for each UT date can be precomputed for several years in to a
+compact numpy file (see main) so that status pages and plotting jobs only
+need an O(1) lookup.  Dates which are not in the file are computed on demand
+and cached.
+'''
+
+import os
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+from functools import lru_cache
+import numpy as np
+
+from astropy import units as u
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, AltAz, get_sun, get_body
+
+
+sites = {'VYSOS': EarthLocation(lat=19.53602*u.deg,
+                                lon=-155.57608*u.deg,
+                                height=3400*u.m),
+        }
+
+## Sun altitude (of center) for each event and whether the sun is setting
+## (True) or rising (False) at that event.  The sunset/sunrise horizon
+## accounts for refraction and the radius of the solar disk.
+twilight_definitions = [('sunset', -0.833, True),
+                        ('ec', -6.0, True),
+                        ('en', -12.0, True),
+                        ('ea', -18.0, True),
+                        ('ma', -18.0, False),
+                        ('mn', -12.0, False),
+                        ('mc', -6.0, False),
+                        ('sunrise', -0.833, False),
+                       ]
+moon_definitions = [('moonset', -0.833, True),
+                    ('moonrise', -0.833, False),
+                   ]
+event_names = [x[0] for x in twilight_definitions + moon_definitions]
+
+## Step of the altitude grid used to find events and of the altitude curves
+## saved in the precomputed table.
+event_step = tdelta(0, 120)
+table_step = tdelta(0, 600)
+
+default_table_file = os.environ.get('VYSOS_EPHEMERIS',
+                     os.path.join(os.path.expanduser('~'), '.vysos_ephemeris.npz'))
+_table = {}
+
+
+##-------------------------------------------------------------------------
+## Time Grid
+##-------------------------------------------------------------------------
+def time_grid(start, end, step=tdelta(0, 300)):
+    '''Return a numpy datetime64 array from start to end (inclusive) with the
+    given step.
+    '''
+    n = int((end - start).total_seconds() // step.total_seconds()) + 1
+    return np.datetime64(start, 'us') + np.arange(n) * np.timedelta64(step)
+
+
+##-------------------------------------------------------------------------
+## Sun and Moon Positions
+##-------------------------------------------------------------------------
+def sun_moon_grid(times, site='VYSOS'):
+    '''Compute the sun and moon positions for an array of UT times in one
+    vectorized call.  Returns a dict of numpy arrays: sun_alt, sun_az,
+    moon_alt, moon_az (all in degrees), and moon_phase (percent illuminated).
+    '''
+    location = sites[site]
+    t = Time(np.asarray(times, dtype='datetime64[us]'), scale='utc')
+    frame = AltAz(obstime=t, location=location)
+    sun = get_sun(t)
+    moon = get_body('moon', t, location=location)
+    sun_altaz = sun.transform_to(frame)
+    moon_altaz = moon.transform_to(frame)
+
+    elongation = sun.separation(moon)
+    phase_angle = np.arctan2(sun.distance*np.sin(elongation),
+                             moon.distance - sun.distance*np.cos(elongation))
+    illumination = (1. + np.cos(phase_angle))/2.
+
+    return {'sun_alt': sun_altaz.alt.to(u.deg).value,
+            'sun_az': sun_altaz.az.to(u.deg).value,
+            'moon_alt': moon_altaz.alt.to(u.deg).value,
+            'moon_az': moon_altaz.az.to(u.deg).value,
+            'moon_phase': 100.*np.asarray(illumination.value),
+           }
+
+
+##-------------------------------------------------------------------------
+## Events for a UT Date
+##-------------------------------------------------------------------------
+def find_crossing(alt, horizon, setting):
+    '''Return the fractional index at which alt first crosses horizon in the
+    given direction or None if it does not.
+    '''
+    above = alt > horizon
+    if setting:
+        crossings = np.where(above[:-1] & ~above[1:])[0]
+    else:
+        crossings = np.where(~above[:-1] & above[1:])[0]
+    if len(crossings) == 0:
+        return None
+    i = crossings[0]
+    return i + (horizon - alt[i]) / (alt[i+1] - alt[i])
+
+
+@lru_cache(maxsize=64)
+def compute_night(date_string, site='VYSOS'):
+    '''Compute the sun and moon events during the given UT date
+    (e.g. '20180505UT').
+
+    The sun and moon altitudes are computed on a 2 minute grid for the whole
+    day and the crossing of each horizon is linearly interpolated.  Returns a
+    dict with a datetime (or None if the event does not occur that day) for
+    each of event_names, the moon phase at 0h UT, and the sun and moon
+    altitude curves sampled every table_step.
+    '''
+    start = dt.strptime(date_string, '%Y%m%dUT')
+    grid = time_grid(start, start + tdelta(1), event_step)
+    positions = sun_moon_grid(grid, site=site)
+
+    night = {}
+    for definitions, alt in [(twilight_definitions, positions['sun_alt']),
+                             (moon_definitions, positions['moon_alt'])]:
+        for name, horizon, setting in definitions:
+            index = find_crossing(alt, horizon, setting)
+            if index is None:
+                night[name] = None
+            else:
+                night[name] = start + tdelta(0, float(index*event_step.total_seconds()))
+    night['moon_phase'] = float(positions['moon_phase'][0])
+    stride = int(table_step.total_seconds() // event_step.total_seconds())
+    night['sun_alt'] = positions['sun_alt'][::stride].astype(np.float32)
+    night['moon_alt'] = positions['moon_alt'][::stride].astype(np.float32)
+    return night
+
+
+##-------------------------------------------------------------------------
+## Precomputed Table
+##-------------------------------------------------------------------------
+def load_table(filename=None):
+    '''Load a precomputed ephemeris table written by generate_table.  Returns
+    None if the file does not exist.  The table is cached along with the
+    file's mtime, so a table which is generated or regenerated while a
+    process is running is picked up on the next call.
+    '''
+    if filename is None:
+        filename = default_table_file
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+    cached = _table.get(filename, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with np.load(filename) as data:
+        table = {key: data[key] for key in data.files}
+    table['first_date'] = dt.strptime(str(table['first_date']), '%Y%m%dUT')
+    table['site'] = str(table['site'])
+    _table[filename] = (mtime, table)
+    return table
+
+
+def generate_table(filename, first_date, ndays, site='VYSOS'):
+    '''Compute the events for ndays starting at first_date (a datetime) and
+    write them to a numpy .npz file.
+    '''
+    columns = {name: np.full(ndays, np.datetime64('NaT'), dtype='datetime64[s]')
+               for name in event_names}
+    moon_phase = np.zeros(ndays, dtype=np.float32)
+    npoints = int(tdelta(1).total_seconds() // table_step.total_seconds()) + 1
+    sun_alt = np.zeros((ndays, npoints), dtype=np.float32)
+    moon_alt = np.zeros((ndays, npoints), dtype=np.float32)
+    for i in range(ndays):
+        date_string = (first_date + tdelta(i)).strftime('%Y%m%dUT')
+        night = compute_night.__wrapped__(date_string, site=site)
+        for name in event_names:
+            if night[name] is not None:
+                columns[name][i] = np.datetime64(night[name], 's')
+        moon_phase[i] = night['moon_phase']
+        sun_alt[i] = night['sun_alt']
+        moon_alt[i] = night['moon_alt']
+    np.savez_compressed(filename, site=site,
+                        first_date=first_date.strftime('%Y%m%dUT'),
+                        moon_phase=moon_phase, sun_alt=sun_alt,
+                        moon_alt=moon_alt, **columns)
+    _table.pop(filename, None)
+
+
+def table_index(date, site='VYSOS'):
+    '''Return the table and row index for the given UT date (a datetime) or
+    (None, None) if it is not covered by the precomputed table.
+    '''
+    table = load_table()
+    if table is None or table['site'] != site:
+        return None, None
+    i = (dt(date.year, date.month, date.day) - table['first_date']).days
+    if i < 0 or i >= len(table['moon_phase']):
+        return None, None
+    return table, i
+
+
+def night_events(date_string, site='VYSOS'):
+    '''Return a dict of the sun and moon events during the given UT date.
+    The keys are event_names plus moon_phase.  Events which do not occur on
+    that date are None.  Uses the precomputed table if it covers the date.
+    '''
+    table, i = table_index(dt.strptime(date_string, '%Y%m%dUT'), site=site)
+    if table is None:
+        night = compute_night(date_string, site=site)
+        return {key: night[key] for key in event_names + ['moon_phase']}
+    night = {'moon_phase': float(table['moon_phase'][i])}
+    for name in event_names:
+        value = table[name][i]
+        night[name] = None if np.isnat(value) else value.astype(dt)
+    return night
+
+
+##-------------------------------------------------------------------------
+## Twilights
+##-------------------------------------------------------------------------
+def twilights(date_string, site='VYSOS'):
+    '''Return a dict of sunset, twilight, and sunrise times (as datetime
+    objects) which occur during the given UT date.  The keys are those of
+    twilight_definitions.
+    '''
+    night = night_events(date_string, site=site)
+    return {name: night[name] for name, horizon, setting in twilight_definitions}
+
+
+def twilight_events(start, end, site='VYSOS'):
+    '''Return a time sorted list of (datetime, name) tuples for all of the
+    sunset, twilight, and sunrise events between start and end.
+    '''
+    events = []
+    date = dt(start.year, start.month, start.day)
+    while date <= end:
+        for name, when in twilights(date.strftime('%Y%m%dUT'), site=site).items():
+            if when is not None and when >= start and when <= end:
+                events.append((when, name))
+        date += tdelta(1)
+    events.sort(key=lambda x: x[0])
+    return events
+
+
+def next_event(name, when, site='VYSOS'):
+    '''Return the time of the next occurrence of the named event after when,
+    or None if it does not occur in the next three days.
+    '''
+    date = dt(when.year, when.month, when.day)
+    for i in range(3):
+        event = night_events((date + tdelta(i)).strftime('%Y%m%dUT'), site=site)[name]
+        if event is not None and event > when:
+            return event
+    return None
+
+
+##-------------------------------------------------------------------------
+## Current Sun and Moon
+##-------------------------------------------------------------------------
+def sun_moon_now(when=None, site='VYSOS'):
+    '''Return sun and moon dicts describing the current state of the sky in
+    the form used by the status pages.  The sun dict has alt, rise, set, and
+    now (a description such as 'night').  The moon dict has alt, phase, rise,
+    set, and now ('up' or 'down').
+    '''
+    if when is None:
+        when = dt.utcnow()
+    table, i = table_index(when, site=site)
+    if table is not None:
+        seconds = (when - dt(when.year, when.month, when.day)).total_seconds()
+        x = seconds / table_step.total_seconds()
+        grid = np.arange(table['sun_alt'].shape[1])
+        sun_alt = float(np.interp(x, grid, table['sun_alt'][i]))
+        moon_alt = float(np.interp(x, grid, table['moon_alt'][i]))
+        if i+1 < len(table['moon_phase']):
+            moon_phase = float(table['moon_phase'][i] + (seconds/86400.)\
+                         * (table['moon_phase'][i+1] - table['moon_phase'][i]))
+        else:
+            moon_phase = float(table['moon_phase'][i])
+    else:
+        positions = sun_moon_grid([when], site=site)
+        sun_alt = float(positions['sun_alt'][0])
+        moon_alt = float(positions['moon_alt'][0])
+        moon_phase = float(positions['moon_phase'][0])
+
+    sun = {'alt': sun_alt,
+           'set': next_event('sunset', when, site=site),
+           'rise': next_event('sunrise', when, site=site),
+          }
+    if sun['alt'] <= -18:
+        sun['now'] = 'night'
+    elif sun['alt'] > -18 and sun['alt'] <= -12:
+        sun['now'] = 'astronomical twilight'
+    elif sun['alt'] > -12 and sun['alt'] <= -6:
+        sun['now'] = 'nautical twilight'
+    elif sun['alt'] > -6 and sun['alt'] <= 0:
+        sun['now'] = 'civil twilight'
+    elif sun['alt'] > 0:
+        sun['now'] = 'day'
+
+    moon = {'phase': moon_phase,
+            'alt': moon_alt,
+            'set': next_event('moonset', when, site=site),
+            'rise': next_event('moonrise', when, site=site),
+           }
+    if moon['alt'] > 0:
+        moon['now'] = 'up'
+    else:
+        moon['now'] = 'down'
+
+    return sun, moon
+
+
+##-------------------------------------------------------------------------
+## Main Program: Generate Precomputed Table
+##-------------------------------------------------------------------------
+def main():
+    parser = ArgumentParser(description="Precompute sun and moon events for the VYSOS site")
+    ## add arguments
+    parser.add_argument("-s", "--start",
+        dest="start", required=False, type=str,
+        default=dt.utcnow().strftime('%Y0101UT'),
+        help="First UT date in the table. (i.e. '20180101UT')")
+    parser.add_argument("-n", "--ndays",
+        dest="ndays", required=False, type=int, default=5*366,
+        help="Number of days in the table. (default = 1830)")
+    parser.add_argument("-o", "--output",
+        dest="output", required=False, type=str, default=default_table_file,
+        help=f"Output file. (default = {default_table_file})")
+    args = parser.parse_args()
+
+    first_date = dt.strptime(args.start, '%Y%m%dUT')
+    print(f"Computing {args.ndays} days of ephemerides starting {args.start}")
+    generate_table(args.output, first_date, args.ndays)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Export the telemetry (weather, V20status, V5status) and images collections
+to Parquet files for long-term analysis, and read them back as columns.
+
+The files for each collection are partitioned by telescope and UT month:
+
+    <root>/<collection>/telescope=<V5|V20|site>/month=<YYYY-MM>/data.parquet
+
+Exports are incremental.  The newest _id and date at the last export are
+kept in <root>/<collection>/_watermark.json and each run rewrites only the
+month partitions which may have changed since then (see changed_months).
+read() uses the partitioning and the date column statistics so that a query
+for a date range only reads the files it needs.
+
+This needs pyarrow (and pandas for read(..., as_pandas=True)).  The export
+root is given by the VYSOS_EXPORT environment variable and defaults to
+~/vysos_export.
+"""
+
+import os
+import sys
+import json
+import shutil
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+import pymongo
+from bson import ObjectId
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+from VYSOS.db import get_collection
+
+
+default_root = os.environ.get('VYSOS_EXPORT',
+                              os.path.join(os.path.expanduser('~'), 'vysos_export'))
+
+## Telescope partition for each collection (None means use the telescope
+## field of each document)
+collections = {'weather': 'site',
+               'V20status': 'V20',
+               'V5status': 'V5',
+               'images': None,
+              }
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('Parquet export needs pyarrow (pip install pyarrow)')
+
+
+##-------------------------------------------------------------------------
+## Convert Documents to Columns
+##-------------------------------------------------------------------------
+def to_table(documents):
+    '''Convert a list of mongo documents to a pyarrow Table.  Numbers are
+    stored as float64, booleans as bool, dates as timestamps, and anything
+    else scalar as strings, so that the schema of a field does not change
+    between files.  Nested fields (lists and dicts) are left out.
+    '''
+    keys = []
+    for document in documents:
+        for key in document.keys():
+            if key not in keys:
+                keys.append(key)
+
+    columns = {}
+    for key in keys:
+        values = [document.get(key, None) for document in documents]
+        present = [v for v in values if v is not None]
+        if len(present) == 0 or any(isinstance(v, (list, dict)) for v in present):
+            continue
+        if all(isinstance(v, bool) for v in present):
+            columns[key] = pa.array(values, type=pa.bool_())
+        elif all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+            columns[key] = pa.array([float(v) if v is not None else None for v in values],
+                                    type=pa.float64())
+        elif all(isinstance(v, dt) for v in present):
+            columns[key] = pa.array(values, type=pa.timestamp('us'))
+        else:
+            columns[key] = pa.array([str(v) if v is not None else None for v in values],
+                                    type=pa.string())
+    return pa.table(columns)
+
+
+##-------------------------------------------------------------------------
+## Watermark
+##-------------------------------------------------------------------------
+def watermark_file(root, collection):
+    return os.path.join(root, collection, '_watermark.json')
+
+
+def read_watermark(root, collection):
+    '''Return (last_id, last_date) from the previous export, or (None, None).
+    '''
+    try:
+        with open(watermark_file(root, collection), 'r') as f:
+            watermark = json.load(f)
+        return (ObjectId(watermark['last_id']),
+                dt.strptime(watermark['last_date'], '%Y-%m-%dT%H:%M:%S.%f'))
+    except (OSError, KeyError, ValueError, TypeError):
+        return None, None
+
+
+def write_watermark(root, collection, last_id, last_date):
+    file = watermark_file(root, collection)
+    with open(file + '.tmp', 'w') as f:
+        json.dump({'last_id': str(last_id),
+                   'last_date': last_date.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                   'updated': dt.utcnow().isoformat()}, f)
+    os.replace(file + '.tmp', file)
+
+
+def exported_until(collection, root=default_root):
+    '''Return the date up to which the export of the collection is complete
+    (the newest document date at the time of the last export) or None.
+    '''
+    return read_watermark(root, collection)[1]
+
+
+##-------------------------------------------------------------------------
+## Export
+##-------------------------------------------------------------------------
+def month_of(date):
+    return date.strftime('%Y-%m') if isinstance(date, dt) else 'unknown'
+
+
+def month_range(month):
+    '''Return the date query for the documents in a month partition.
+    '''
+    if month == 'unknown':
+        return {'$not': {'$type': 'date'}}
+    start = dt.strptime(month, '%Y-%m')
+    end = dt(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return {'$gte': start, '$lt': end}
+
+
+def months_between(start, end):
+    months = []
+    month = dt(start.year, start.month, 1)
+    while month <= end:
+        months.append(month_of(month))
+        month = dt(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return months
+
+
+def changed_months(collection, last_id, last_date, overlap):
+    '''Return the months which need to be (re)written.  These are:
+
+      - the months of documents inserted since the last export (by _id).
+        This catches new documents and reanalysed images, which are deleted
+        and inserted again with a new _id but their original date.
+      - every month from overlap days before the last exported date to now.
+        This catches documents replayed from a telemetry spool after an
+        outage, which keep the (older) _id they were given before the
+        outage.  Outages longer than the overlap need --overlap or --full.
+    '''
+    match = {} if last_id is None else {'_id': {'$gt': last_id}}
+    pipeline = [{'$match': match},
+                {'$group': {'_id': {'$dateToString': {'format': '%Y-%m', 'date': '$date'}}}}]
+    months = set([result['_id'] or 'unknown'
+                  for result in get_collection(collection).aggregate(pipeline)])
+    if last_id is None:
+        return sorted(months)
+    months.update(months_between(last_date - tdelta(overlap), dt.utcnow()))
+    return sorted(months)
+
+
+def export_collection(collection, root=default_root, overlap=7, logger=None):
+    '''Rewrite each month partition of the collection which may have changed
+    since the last export (see changed_months) from the current contents of
+    mongo and return the number of documents written.  Because whole
+    partitions are rewritten, deleted and replaced documents (e.g. from
+    reanalysis of an image) do not leave duplicates behind.
+    '''
+    require_pyarrow()
+    os.makedirs(os.path.join(root, collection), exist_ok=True)
+    mongo_collection = get_collection(collection)
+    ## Record the extent of the collection before reading it, so anything
+    ## inserted during the export is picked up next time
+    newest_id = mongo_collection.find_one({}, projection={'_id': 1},
+                                          sort=[('_id', pymongo.DESCENDING)])
+    newest_date = mongo_collection.find_one({'date': {'$type': 'date'}},
+                                            projection={'date': 1},
+                                            sort=[('date', pymongo.DESCENDING)])
+    if newest_id is None or newest_date is None:
+        return 0
+
+    last_id, last_date = read_watermark(root, collection)
+    n_exported = 0
+    for month in changed_months(collection, last_id, last_date, overlap):
+        documents = list(mongo_collection.find({'date': month_range(month)},
+                                               sort=[('date', pymongo.ASCENDING)]))
+        n_exported += write_month(collection, month, documents, root)
+        if logger: logger.info(f'  {collection} {month}: exported {len(documents)} documents')
+    write_watermark(root, collection, newest_id['_id'], newest_date['date'])
+    return n_exported
+
+
+def write_month(collection, month, documents, root):
+    '''Replace the files for the month (for every telescope) with the
+    given documents.
+    '''
+    groups = {}
+    for document in documents:
+        telescope = collections[collection] or document.get('telescope', None) or 'unknown'
+        groups.setdefault(telescope, []).append(document)
+    base = os.path.join(root, collection)
+    for telescope_dir in os.listdir(base):
+        path = os.path.join(base, telescope_dir, f'month={month}')
+        if telescope_dir.startswith('telescope=') and os.path.isdir(path)\
+           and telescope_dir[len('telescope='):] not in groups:
+            shutil.rmtree(path)
+    for telescope, group in groups.items():
+        path = os.path.join(base, f'telescope={telescope}', f'month={month}')
+        os.makedirs(path, exist_ok=True)
+        ## Write to a hidden file (ignored by read) and then swap it in
+        tmp_file = os.path.join(path, '.data.parquet.tmp')
+        pq.write_table(to_table(group), tmp_file)
+        os.replace(tmp_file, os.path.join(path, 'data.parquet'))
+        for file in os.listdir(path):
+            if file.endswith('.parquet') and file != 'data.parquet':
+                os.remove(os.path.join(path, file))
+    return len(documents)
+
+
+##-------------------------------------------------------------------------
+## Read
+##-------------------------------------------------------------------------
+def read(collection, columns=None, start=None, end=None, telescope=None,
+         root=default_root, as_pandas=False):
+    '''Read exported data for the collection between start and end (UT
+    datetimes).  Returns a pandas DataFrame if as_pandas is True, otherwise a
+    dict of numpy arrays keyed by column name.  Only the month partitions
+    which overlap the date range are read and the date filter is pushed
+    down to the Parquet row groups.
+    '''
+    require_pyarrow()
+    path = os.path.join(root, collection)
+    partition_schema = pa.schema([('telescope', pa.string()), ('month', pa.string())])
+    partitioning = ds.partitioning(partition_schema, flavor='hive')
+    files = [os.path.join(dirpath, f) for dirpath, dirnames, filenames in os.walk(path)
+             for f in filenames if f.endswith('.parquet')]
+    if len(files) == 0:
+        return {} if not as_pandas else None
+    ## The partition fields are not stored in the files, so add them to the
+    ## schema for the filters on telescope and month
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files] + [partition_schema])
+    dataset = ds.dataset(path, schema=schema, format='parquet',
+                         partitioning=partitioning,
+                         exclude_invalid_files=False)
+
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('month') >= start.strftime('%Y-%m'))
+        conditions.append(ds.field('date') >= pa.scalar(start, type=pa.timestamp('us')))
+    if end is not None:
+        conditions.append(ds.field('month') <= end.strftime('%Y-%m'))
+        conditions.append(ds.field('date') < pa.scalar(end, type=pa.timestamp('us')))
+    if telescope is not None:
+        conditions.append(ds.field('telescope') == telescope)
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if columns is not None:
+        columns = [c for c in columns if c in schema.names]
+    table = dataset.to_table(columns=columns, filter=expression)
+    if 'date' in table.column_names:
+        table = table.sort_by('date')
+    if as_pandas:
+        return table.to_pandas()
+    return {name: table.column(name).to_numpy(zero_copy_only=False)
+            for name in table.column_names}
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def main():
+    parser = ArgumentParser(description="Export telemetry and image results to Parquet")
+    ## add flags
+    parser.add_argument("--full",
+        action="store_true", dest="full",
+        default=False, help="Discard previous exports and start over.")
+    ## add arguments
+    parser.add_argument("-o", "--output",
+        dest="root", required=False, type=str, default=default_root,
+        help=f"Export directory (default = {default_root}).")
+    parser.add_argument("-c", "--collection",
+        dest="collections", required=False, action='append',
+        choices=list(collections.keys()), default=None,
+        help="Collection to export (may be repeated, default is all).")
+    parser.add_argument("--overlap",
+        dest="overlap", required=False, type=float, default=7,
+        help="Days before the last export to always rewrite (default = 7).")
+    args = parser.parse_args()
+
+    if pa is None:
+        print('vysos-export needs pyarrow (pip install pyarrow)')
+        sys.exit(1)
+
+    for collection in (args.collections or collections.keys()):
+        if args.full and os.path.exists(os.path.join(args.root, collection)):
+            shutil.rmtree(os.path.join(args.root, collection))
+        n = export_collection(collection, root=args.root, overlap=args.overlap)
+        print(f'{collection}: exported {n} documents')
+
+
+if __name__ == '__main__':
+    main()
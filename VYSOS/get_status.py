@@ -3,242 +3,104 @@
 from __future__ import division, print_function
 
 ## Import General Tools
-import sys
-import os
 import argparse
 import logging
 import time
 import datetime
-import re
-import numpy as np
-import pymongo
+import threading
 
-import win32com.client
-import pywintypes
+from VYSOS.telemetry import get_writer
+
+from VYSOS import Telescope
+from VYSOS.devices import get_devices, com_initialize
 
 # import mongoengine as me
 # from VYSOS.schema import telstatus
 
 ##-------------------------------------------------------------------------
-## Query ASCOM ACPHub for Telescope Position and State
-##-------------------------------------------------------------------------
-def get_telescope_info(status, logger):
-    logger.info('Getting ACP status')
-    try:
-        ACP = win32com.client.Dispatch("ACP.Telescope")
-    except:
-        logger.error('Could not connect to ACP ASCOM object.')
-        return status
-
-    try:
-        status['connected'] = ACP.Connected
-        logger.debug('  ACP Connected = {}'.format(status['connected']))
-        if status['connected']:
-            status['park'] = ACP.AtPark
-            logger.info('  ACP At Park = {}'.format(status['park']))
-            status['slewing'] = ACP.Slewing
-            logger.info('  ACP Slewing = {}'.format(status['slewing']))
-            status['tracking'] = ACP.Tracking
-            logger.info('  ACP Tracking = {}'.format(status['tracking']))
-            status['alt'] = float(ACP.Altitude)
-            logger.info('  ACP Alt = {:.2f}'.format(status['alt']))
-            status['az'] = float(ACP.Azimuth)
-            logger.info('  ACP Az = {:.2f}'.format(status['az']))
-            try:
-                status['RA'] = ACP.TargetRightAscension * 15.0
-                status['DEC'] = ACP.TargetDeclination
-                logger.info('  ACP target RA = {:.4f}'.format(status['RA']))
-                logger.info('  ACP target Dec = {:.4f}'.format(status['DEC']))
-            except:
-                logger.info('  Could not get target info')
-    except pywintypes.com_error as err:
-        logger.warning('COM error:')
-        logger.warning('  {}'.format(err.message))
-        status['ACPerr'] = '{}'.format(err.message)
-    except:
-        status['connected'] = False
-        logger.warning('Queries to ACP object failed')
-
-    return status
-
-
-##-------------------------------------------------------------------------
-## Query ASCOM Focuser for Position, Temperature, Fan State
+## Poll a Device on its own Thread
 ##-------------------------------------------------------------------------
-def get_focuser_info(status, logger):
-    logger.info('Getting ASCOM focuser status')
-    try:
-        FocusMax = win32com.client.Dispatch("FocusMax.Focuser")
-        if not FocusMax.Link:
+class DevicePoller(threading.Thread):
+    '''Sample a device every device.interval seconds and keep the latest
+    values, so that a slow or hung device does not delay the others.
+    '''
+    def __init__(self, device, logger):
+        super().__init__(name=device.name, daemon=True)
+        self.device = device
+        self.logger = logger
+        self.values = {}
+        self.updated = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def run(self):
+        com_initialize()
+        while not self.stopping.is_set():
+            start = time.monotonic()
             try:
-                FocusMax.Link = True
-            except:
-                logger.error('Could not start FocusMax ASCOM link.')
-        logger.debug('  Connected to FocusMax')
-    except:
-        logger.error('Could not connect to FocusMax ASCOM object.')
-        return status
-
-    ## Get Average of 3 Temperature Readings
-    FocusMax_Temps = []
-    for i in range(0,3,1):
-        try:
-            newtemp = float(FocusMax.Temperature)
-            logger.debug('  Queried FocusMax temperature = {:.1f}'.format(newtemp))
-            FocusMax_Temps.append(newtemp)
-        except:
-            pass
-    if len(FocusMax_Temps) > 0:
-        ## Filter out bad values
-        median_temp = np.median(FocusMax_Temps)
-        if (median_temp > -10) and (median_temp < 150):
-            status['focuser_temperature'] = median_temp
-            logger.info('  FocusMax temperature = {:.1f} {}'.format(status['focuser_temperature'], 'C'))
-    ## Get Position
-    try:
-        status['focuser_position'] = int(FocusMax.Position)
-        logger.info('  FocusMax position = {:d}'.format(status['focuser_position']))
-    except:
-        pass
-
-    return status
-
-
-##-------------------------------------------------------------------------
-## Query RCOS TCC
-##-------------------------------------------------------------------------
-def get_RCOS_info(status, logger):
-    logger.info('Getting RCOS TCC status')
-    try:
-        RCOST = win32com.client.Dispatch("RCOS_AE.Temperature")
-        RCOSF = win32com.client.Dispatch("RCOS_AE.Focuser")
-        logger.debug('  Connected to RCOS focuser')
-    except:
-        logger.error('Could not connect to RCOS ASCOM object.')
-        return status
-
-    ## Get Average of 5 Temperature Readings
-    RCOS_Truss_Temps = []
-    RCOS_Primary_Temps = []
-    RCOS_Secondary_Temps = []
-    RCOS_Fan_Speeds = []
-    RCOS_Focus_Positions = []
-    logger.debug('  {:>7s}, {:>7s}, {:>7s}, {:>7s}, {:>5s}'.format('Truss', 'Pri', 'Sec', 'Fan', 'Foc'))
-    for i in range(0,5,1):
-        try:
-            new_Truss_Temp = RCOST.AmbientTemp
-            if new_Truss_Temp > 20 and new_Truss_Temp < 120:
-                RCOS_Truss_Temps.append(new_Truss_Temp)
-            else:
-                new_Truss_Temp = float('nan')
-
-            new_Pri_Temp = RCOST.PrimaryTemp
-            if new_Pri_Temp > 20 and new_Pri_Temp < 120:
-                RCOS_Primary_Temps.append(new_Pri_Temp)
-            else:
-                new_Pri_Temp = float('nan')
-
-            new_Sec_Temp = RCOST.SecondaryTemp
-            if new_Sec_Temp > 20 and new_Sec_Temp < 120:
-                RCOS_Secondary_Temps.append(new_Sec_Temp)
+                values = self.device.sample()
+            except Exception as e:
+                self.logger.warning(f'Failed to sample {self.device.name}: {e}')
             else:
-                new_Sec_Temp = float('nan')
-
-            new_Fan_Speed = RCOST.FanSpeed
-            RCOS_Fan_Speeds.append(new_Fan_Speed)
-
-            new_Focus_Pos = RCOSF.Position
-            RCOS_Focus_Positions.append(new_Focus_Pos)
+                with self.lock:
+                    self.values = values
+                    self.updated = time.monotonic()
+            self.stopping.wait(max(self.device.interval - (time.monotonic() - start), 0))
 
-            logger.debug('  {:5.1f} F, {:5.1f} F, {:5.1f} F, {:5.0f} %, {:5d}'.format(new_Truss_Temp, new_Pri_Temp, new_Sec_Temp, new_Fan_Speed, new_Focus_Pos))
-        except:
-            pass
-        time.sleep(1)
-    if len(RCOS_Truss_Temps) >= 3:
-        status['truss_temperature'] = (float(np.median(RCOS_Truss_Temps)) - 32.)/1.8
-        logger.info('  RCOS temperature (truss) = {:.1f} {}'.format(
-                    status['truss_temperature'], 'C'))
-    if len(RCOS_Primary_Temps) >= 3:
-        status['primary_temperature'] = (float(np.median(RCOS_Primary_Temps)) - 32.)/1.8
-        logger.info('  RCOS temperature (primary) = {:.1f} {}'.format(
-                    status['primary_temperature'], 'C'))
-    if len(RCOS_Secondary_Temps) >= 3:
-        status['secondary_temperature'] = (float(np.median(RCOS_Secondary_Temps)) - 32.)/1.8
-        logger.info('  RCOS temperature (secondary) = {:.1f} {}'.format(
-                    status['secondary_temperature'], 'C'))
-    if len(RCOS_Fan_Speeds) >= 3:
-        status['fan_speed'] = float(np.median(RCOS_Fan_Speeds))
-        logger.info('  RCOS fan speed = {:.0f} %'.format(status['fan_speed']))
-
-    return status
+    def latest(self, max_age):
+        '''Return the latest values, or an empty dict if they are older than
+        max_age seconds.
+        '''
+        with self.lock:
+            if self.updated is None or time.monotonic() - self.updated > max_age:
+                return {}
+            return dict(self.values)
 
+    def stop(self):
+        self.stopping.set()
 
 
 ##-------------------------------------------------------------------------
-## Query ControlByWeb Temperature Module for Temperature and Fan State
+## Assemble Status Documents at a Fixed Cadence
 ##-------------------------------------------------------------------------
-def control_by_web(status, logger):
-    logger.info('Getting CBW temperature module status')
-    address = 'http://192.168.1.115/state.xml'
-    import urllib2
-    response = urllib2.urlopen(address)
-    raw_result = response.read()
-    tunits = re.search('<units>(\w+)</units>', raw_result).group(1)
-    assert tunits in ['F', 'C']
-    temp1 = float(re.search('<sensor1temp>(\d+\.\d*)</sensor1temp>', raw_result).group(1))
-    r1state = bool(int(re.search('<relay1state>(\d)</relay1state>', raw_result).group(1)))
-    r2state = bool(int(re.search('<relay2state>(\d)</relay2state>', raw_result).group(1)))
-
-    if tunits == 'C':
-        temp1 = temp1*9./5. + 32.
-        tunits = 'F'
-
-    status['dome_temperature'] = temp1
-    status['fan_state'] = r1state
-    status['fan_enable'] = r2state
-
-    return status
-
-
-def get_status_and_log(telescope, logger):
-
-    ##-------------------------------------------------------------------------
-    ## Get Status Info
-    ##-------------------------------------------------------------------------
-    logger.info('#### Starting Status Queries ####')
+def assemble_status(telescope, pollers, max_age):
     status = {'telescope': telescope,
-              'date':datetime.datetime.utcnow()
+              'date': datetime.datetime.utcnow()
              }
-    status = get_telescope_info(status, logger)
-    status = get_focuser_info(status, logger)
-    if telescope == 'V20':
-        status = get_RCOS_info(status, logger)
+    for poller in pollers:
+        status.update(poller.latest(max_age))
+    return status
 
-    ##-------------------------------------------------------------------------
-    ## Write to Mongo
-    ##-------------------------------------------------------------------------
-    done = False
-    while done is False:
-        try:
-            logger.info('Connecting to mongo db at 192.168.1.101')
-            client = pymongo.MongoClient('192.168.1.101', 27017)
-            db = client.vysos
-            status_collection = db['{}status'.format(telescope)]
-        except:
-            logger.error('Failed to connect to mongo')
-        else:
-            ## Save new "current" document
-            try:
-                inserted_id = status_collection.insert_one(status).inserted_id
-                logger.info("  Inserted document id: {}".format(inserted_id))
-                done = True
-            except:
-                e = sys.exc_info()[0]
-                logger.error('Failed to add new document')
-                logger.error('Will wait 10 seconds and try again')
-                logger.error(e)
-                time.sleep(10)
-            client.close()
+
+def get_status_and_log(telescope, logger, cadence=20, max_age=60, cbw=False,
+                       simulate=None, latency=0., error_rate=0., cycles=None):
+    '''Start a poller thread for each device and write one status document
+    every cadence seconds from the latest values of each device.  Values
+    older than max_age seconds (e.g. from a hung device) are left out.  Runs
+    forever unless cycles (the number of documents to write) is given.
+    '''
+    tel = Telescope(telescope, simulate=simulate)
+    if cbw:
+        tel.devices.append('cbw')
+    devices = get_devices(tel, logger, latency=latency, jitter=latency/2.,
+                          error_rate=error_rate)
+    pollers = [DevicePoller(device, logger) for device in devices]
+    writer = get_writer('{}status'.format(telescope), logger=logger)
+    for poller in pollers:
+        poller.start()
+
+    next_time = time.monotonic() + cadence
+    n_written = 0
+    while cycles is None or n_written < cycles:
+        time.sleep(max(next_time - time.monotonic(), 0))
+        next_time += cadence
+        logger.info('#### Assembling Status ####')
+        status = assemble_status(telescope, pollers, max_age)
+        logger.info('  {}'.format(', '.join(sorted(status.keys()))))
+        writer.write(status)
+        n_written += 1
+    for poller in pollers:
+        poller.stop()
 
 
 if __name__ == '__main__':
@@ -258,6 +120,24 @@ if __name__ == '__main__':
         type=str, dest="telescope", default='',
         choices=['V5', 'V20', ''], required=False,
         help="The telescope system we are querying.  Will query weather if not specified.")
+    parser.add_argument("--cadence",
+        type=float, dest="cadence", default=20,
+        help="Seconds between status documents (default = 20)")
+    parser.add_argument("--cbw",
+        action="store_true", dest="cbw",
+        default=False, help="Also poll the ControlByWeb temperature module")
+    parser.add_argument("--simulate",
+        action="store_true", dest="simulate",
+        default=None, help="Use simulated devices (default is set by VYSOS_SIMULATE)")
+    parser.add_argument("--latency",
+        type=float, dest="latency", default=0.,
+        help="Latency (seconds) of each simulated device query")
+    parser.add_argument("--error-rate",
+        type=float, dest="error_rate", default=0.,
+        help="Fraction of simulated device queries which fail")
+    parser.add_argument("-n", "--number",
+        type=int, dest="number", default=1,
+        help="Number of simulated telescopes to run (for load testing)")
     args = parser.parse_args()
 
     telescope = args.telescope
@@ -283,9 +163,23 @@ if __name__ == '__main__':
         logger.addHandler(LogConsoleHandler)
 
 
-    run = True
-    while run:
-        get_status_and_log(telescope, logger)
-#         run = False
-        logging.shutdown()
-        time.sleep(20)
+    if args.simulate and args.number > 1:
+        ## Run several simulated copies of the telescope, each writing to its
+        ## own status collection
+        threads = [threading.Thread(target=get_status_and_log,
+                                    args=(f'{telescope}sim{i}', logger),
+                                    kwargs={'cadence': args.cadence,
+                                            'cbw': args.cbw,
+                                            'simulate': True,
+                                            'latency': args.latency,
+                                            'error_rate': args.error_rate},
+                                    daemon=True)
+                   for i in range(args.number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        get_status_and_log(telescope, logger, cadence=args.cadence, cbw=args.cbw,
+                           simulate=args.simulate, latency=args.latency,
+                           error_rate=args.error_rate)
@@ -9,39 +9,77 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.dates import HourLocator, MinuteLocator, DateFormatter
 plt.style.use('classic')
-import pymongo
 
-import ephem
 from astropy.io import ascii
 import astropy.units as u
 from astropy.table import Table, Column, Row
 
 from VYSOS import Telescope, weather_limits
+from VYSOS.db import get_db
+from VYSOS import ephemeris
 
 
-def query_mongo(db, collection, query):
+def empty_column(name, n):
+    if name == 'date':
+        return np.full(n, np.datetime64('NaT'), dtype='datetime64[us]')
+    return np.full(n, np.nan, dtype=np.float64)
+
+
+def query_mongo(db, collection, query, limit=0, chunk=4096):
+    '''Load the fields needed for plotting from a collection in to an astropy
+    Table.  Only the needed fields are requested from mongo and the values are
+    written in to numpy arrays (grown chunk rows at a time) in a single pass
+    over the cursor, without a separate count query.  At most limit documents
+    are read (0 means no limit).  Missing values are NaN (or NaT for the date).
+    '''
     if collection == 'weather':
         names=('date', 'temp', 'clouds')
-        dtype=(dt, np.float, np.float)
     elif collection == 'V20status':
         names=('date', 'focuser_temperature', 'primary_temperature',
                           'secondary_temperature', 'truss_temperature')
-        dtype=(dt, np.float, np.float, np.float, np.float)
     elif collection == 'images':
-        names=('date')
-        dtype=(dt)
-
-    result = Table(names=names, dtype=dtype)
-    for entry in db[collection].find(query):
-        insert = {}
+        names=('date',)
+
+    projection = {name: 1 for name in names}
+    projection['_id'] = 0
+    size = min(limit, chunk) if limit > 0 else chunk
+    columns = {name: empty_column(name, size) for name in names}
+
+    i = 0
+    for entry in db[collection].find(query, projection=projection).limit(limit):
+        if i == size:
+            columns = {name: np.concatenate([columns[name], empty_column(name, size)])
+                       for name in names}
+            size *= 2
         for name in names:
-            if name in entry.keys():
-                insert[name] = entry[name]
-        result.add_row(insert)
+            value = entry.get(name, None)
+            if value is not None:
+                columns[name][i] = value
+        i += 1
+
+    result = Table([columns[name][:i] for name in names], names=names)
     return result
 
 
+def overplot_twilights(axes, twilights):
+    '''Shade the twilight periods on the given axes and return the list of
+    patches which were added.
+    '''
+    boundaries = [('sunset', 'ec', 0.1), ('ec', 'en', 0.2), ('en', 'ea', 0.3),
+                  ('ea', 'ma', 0.5), ('ma', 'mn', 0.3), ('mn', 'mc', 0.2),
+                  ('mc', 'sunrise', 0.1)]
+    spans = []
+    for begin, end, alpha in boundaries:
+        spans.append(axes.axvspan(twilights[begin], twilights[end], ymin=0,
+                                  ymax=1, color='blue', alpha=alpha))
+    return spans
+
+
 def make_plots(date_string, telescope, logger, recent=False):
+    '''Make the nightly (or recent) summary plot.  Returns a dict holding the
+    figure, artists, and data so that a recent plot can be updated in place
+    by update_recent_plots.
+    '''
     logger.info(f"Making Nightly Plots for {telescope} on {date_string}")
     telname = {'V20':'VYSOS-20', 'V5':'VYSOS-5'}
 
@@ -67,28 +105,17 @@ def make_plots(date_string, telescope, logger, recent=False):
     night_plot_file = os.path.join(destination_path, night_plot_file_name)
 
     ##------------------------------------------------------------------------
-    ## Use pyephem determine sunrise and sunset times
+    ## Determine sunrise and sunset times
     ##------------------------------------------------------------------------
-    Observatory = ephem.Observer()
-    Observatory.lon = "-155:34:33.9"
-    Observatory.lat = "+19:32:09.66"
-    Observatory.elevation = 3400.0
-    Observatory.temp = 10.0
-    Observatory.pressure = 680.0
-    Observatory.date = start.strftime('%Y/%m/%d 10:00:00')
-
-    Observatory.horizon = '0.0'
-    sunset  = Observatory.previous_setting(ephem.Sun()).datetime()
-    sunrise = Observatory.next_rising(ephem.Sun()).datetime()
-    Observatory.horizon = '-6.0'
-    evening_civil_twilight = Observatory.previous_setting(ephem.Sun(), use_center=True).datetime()
-    morning_civil_twilight = Observatory.next_rising(ephem.Sun(), use_center=True).datetime()
-    Observatory.horizon = '-12.0'
-    evening_nautical_twilight = Observatory.previous_setting(ephem.Sun(), use_center=True).datetime()
-    morning_nautical_twilight = Observatory.next_rising(ephem.Sun(), use_center=True).datetime()
-    Observatory.horizon = '-18.0'
-    evening_astronomical_twilight = Observatory.previous_setting(ephem.Sun(), use_center=True).datetime()
-    morning_astronomical_twilight = Observatory.next_rising(ephem.Sun(), use_center=True).datetime()
+    twilights = ephemeris.twilights(start.strftime('%Y%m%dUT'))
+    sunset = twilights['sunset']
+    sunrise = twilights['sunrise']
+    evening_civil_twilight = twilights['ec']
+    morning_civil_twilight = twilights['mc']
+    evening_nautical_twilight = twilights['en']
+    morning_nautical_twilight = twilights['mn']
+    evening_astronomical_twilight = twilights['ea']
+    morning_astronomical_twilight = twilights['ma']
 
     if recent is False:
         plot_start = sunset - tdelta(0, 1800)
@@ -101,8 +128,7 @@ def make_plots(date_string, telescope, logger, recent=False):
     ##------------------------------------------------------------------------
     ## Get weather, telescope status, and image data from database
     ##------------------------------------------------------------------------
-    client = pymongo.MongoClient(tel.mongo_address, tel.mongo_port)
-    db = client[tel.mongo_db]
+    db = get_db(tel)
     
 #     logger.info(f"Querying database for images")
 #     images = query_mongo(db, 'images', {'date': {'$gt':start, '$lt':end}, 'telescope':telescope } )
@@ -186,31 +212,32 @@ def make_plots(date_string, telescope, logger, recent=False):
         plt.title("Weather for {} on the Night of {}".format(telescope, date_string))
     logger.info('Adding temperature plot')
 
+    lines = {}
     logger.debug('  Adding ambient temp to plot')
-    t_axes.plot_date(weather['date'], weather['temp']*9/5+32, 'ko',
+    lines[('weather', 'temp')] = t_axes.plot_date(weather['date'], weather['temp']*9/5+32, 'ko',
                      markersize=2, markeredgewidth=0, drawstyle="default",
-                     label="Outside Temp")
+                     label="Outside Temp")[0]
 
     logger.debug('  Adding focuser temp to plot')
-    t_axes.plot_date(status['date'], status['focuser_temperature']*9/5+32, 'ro',
+    lines[('V20status', 'focuser_temperature')] = t_axes.plot_date(status['date'], status['focuser_temperature']*9/5+32, 'ro',
                      markersize=2, markeredgewidth=0,
-                     label="Focuser Temp")
+                     label="Focuser Temp")[0]
 
     logger.debug('  Adding primary temp to plot')
-    t_axes.plot_date(status['date'], status['primary_temperature']*9/5+32, 'bo',
+    lines[('V20status', 'primary_temperature')] = t_axes.plot_date(status['date'], status['primary_temperature']*9/5+32, 'bo',
                      markersize=2, markeredgewidth=0,
-                     label="Primary Temp")
+                     label="Primary Temp")[0]
 
     logger.debug('  Adding secondary temp to plot')
-    t_axes.plot_date(status['date'], status['secondary_temperature']*9/5+32, 'go',
+    lines[('V20status', 'secondary_temperature')] = t_axes.plot_date(status['date'], status['secondary_temperature']*9/5+32, 'go',
                      markersize=2, markeredgewidth=0,
-                     label="Secondary Temp")
+                     label="Secondary Temp")[0]
 
     logger.debug('  Adding truss temp to plot')
-    t_axes.plot_date(status['date'], status['truss_temperature']*9/5+32, 'ko',
+    lines[('V20status', 'truss_temperature')] = t_axes.plot_date(status['date'], status['truss_temperature']*9/5+32, 'ko',
                      alpha=0.5,
                      markersize=2, markeredgewidth=0,
-                     label="Truss Temp")
+                     label="Truss Temp")[0]
 
 
     t_axes.xaxis.set_major_locator(hours)
@@ -218,13 +245,7 @@ def make_plots(date_string, telescope, logger, recent=False):
     t_axes.xaxis.set_major_formatter(hours_fmt)
 
     ## Overplot Twilights
-    plt.axvspan(sunset, evening_civil_twilight, ymin=0, ymax=1, color='blue', alpha=0.1)
-    plt.axvspan(evening_civil_twilight, evening_nautical_twilight, ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(evening_nautical_twilight, evening_astronomical_twilight, ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(evening_astronomical_twilight, morning_astronomical_twilight, ymin=0, ymax=1, color='blue', alpha=0.5)
-    plt.axvspan(morning_astronomical_twilight, morning_nautical_twilight, ymin=0, ymax=1, color='blue', alpha=0.3)
-    plt.axvspan(morning_nautical_twilight, morning_civil_twilight, ymin=0, ymax=1, color='blue', alpha=0.2)
-    plt.axvspan(morning_civil_twilight, sunrise, ymin=0, ymax=1, color='blue', alpha=0.1)
+    spans = overplot_twilights(t_axes, twilights)
 
     plt.legend(loc='best', prop={'size':10})
     plt.ylabel("Temperature (F)")
@@ -236,30 +257,21 @@ def make_plots(date_string, telescope, logger, recent=False):
         plt.xlabel("UT Time")
 
     ## Overplot Moon Up Time
-    TheMoon = ephem.Moon()
-    moon_alts = []
-    moon_phases = []
-    moon_time_list = []
-    moon_time = plot_start
-    while moon_time <= plot_end:
-        Observatory.date = moon_time
-        TheMoon.compute(Observatory)
-        moon_time_list.append(moon_time)
-        moon_alts.append(TheMoon.alt * 180. / ephem.pi)
-        moon_phases.append(TheMoon.phase)
-        moon_time += tdelta(0, 60*5)
-    moon_phase = max(moon_phases)
+    moon_time_list = ephemeris.time_grid(plot_start, plot_end, tdelta(0, 60*5))
+    moon = ephemeris.sun_moon_grid(moon_time_list)
+    moon_alts = moon['moon_alt']
+    moon_phase = max(moon['moon_phase'])
     moon_fill = moon_phase/100.*0.5+0.05
 
     m_axes = t_axes.twinx()
     m_axes.set_ylabel('Moon Alt (%.0f%% full)' % moon_phase, color='y')
-    m_axes.plot_date(moon_time_list, moon_alts, 'y-')
+    moon_line = m_axes.plot_date(moon_time_list, moon_alts, 'y-')[0]
     m_axes.xaxis.set_major_locator(hours)
     m_axes.xaxis.set_major_formatter(hours_fmt)
     plt.ylim(0,100)
     plt.yticks([10,30,50,70,90], color='y')
     plt.xlim(plot_start, plot_end)
-    plt.fill_between(moon_time_list, 0, moon_alts, where=np.array(moon_alts)>0, color='yellow', alpha=moon_fill)        
+    moon_fill_area = plt.fill_between(moon_time_list, 0, moon_alts, where=np.array(moon_alts)>0, color='yellow', alpha=moon_fill)
     plt.ylabel('')
 
 
@@ -269,13 +281,14 @@ def make_plots(date_string, telescope, logger, recent=False):
     ##------------------------------------------------------------------------
     logger.info('Adding cloudiness plot')
     c_axes = plt.axes(plot_positions[3][0])
-    if recent: plt.title('(plot generated at {})'.format(now.strftime("%Y%m%d %H:%M:%S UT")))
+    title = None
+    if recent: title = plt.title('(plot generated at {})'.format(end.strftime("%Y%m%d %H:%M:%S UT")))
 
     logger.debug('  Adding sky temp to plot')
     print(weather['clouds']*9/5+32)
-    t_axes.plot_date(weather['date'], weather['clouds']*9/5+32, 'bo',
+    lines[('weather', 'clouds')] = t_axes.plot_date(weather['date'], weather['clouds']*9/5+32, 'bo',
                      markersize=2, markeredgewidth=0,
-                     label="Sky Temp")
+                     label="Sky Temp")[0]
 #     plt.fill_between(weather['date'], -140, weather['clouds'],
 #                      where=weather['clouds']<weather_limits['Cloudiness (C)'][0],
 #                      color='green', alpha=0.5)
@@ -690,6 +703,72 @@ def make_plots(date_string, telescope, logger, recent=False):
     plt.savefig(night_plot_file, dpi=dpi, bbox_inches='tight', pad_inches=0.10)
     logger.info('Done.')
 
+    state = {'db': db,
+             'figure': Figure,
+             'file': night_plot_file,
+             'dpi': dpi,
+             'data': {'weather': {name: np.array(weather[name]) for name in weather.colnames},
+                      'V20status': {name: np.array(status[name]) for name in status.colnames},
+                     },
+             'lines': lines,
+             'axes': [t_axes, m_axes, c_axes],
+             'spans': spans,
+             'moon_line': moon_line,
+             'moon_fill': moon_fill_area,
+             'title': title,
+            }
+    return state
+
+
+def update_recent_plots(state, logger, window=tdelta(0,7200)):
+    '''Update a recent plot made by make_plots in place.  Only documents newer
+    than the last one already plotted are retrieved from mongo.  The line data,
+    moon curve, twilight shading, and time limits are updated and the PNG is
+    saved again.
+    '''
+    end = dt.utcnow()
+    start = end - window
+    logger.info('Updating recent plot {}'.format(state['file']))
+
+    for collection, data in state['data'].items():
+        ## The frame is empty (or all NaT) on the first update of a night
+        dates = data['date'][~np.isnat(data['date'])]
+        if len(dates) > 0:
+            since = max(dates.max().astype(dt), start)
+        else:
+            since = start
+        new = query_mongo(state['db'], collection, {'date': {'$gt': since, '$lt': end} })
+        logger.debug(f"  Found {len(new)} new {collection} entries")
+        keep = data['date'] > np.datetime64(start, 'us')
+        for name in data.keys():
+            data[name] = np.concatenate([data[name][keep], np.array(new[name])])
+
+    for (collection, name), line in state['lines'].items():
+        data = state['data'][collection]
+        line.set_data(data['date'], data[name]*9/5+32)
+
+    t_axes, m_axes, c_axes = state['axes']
+    for span in state['spans']:
+        span.remove()
+    state['spans'] = overplot_twilights(t_axes, ephemeris.twilights(start.strftime('%Y%m%dUT')))
+
+    moon_time_list = ephemeris.time_grid(start, end, tdelta(0, 60*5))
+    moon_alts = ephemeris.sun_moon_grid(moon_time_list)['moon_alt']
+    state['moon_line'].set_data(moon_time_list, moon_alts)
+    alpha = state['moon_fill'].get_alpha()
+    state['moon_fill'].remove()
+    state['moon_fill'] = m_axes.fill_between(moon_time_list, 0, moon_alts,
+                                             where=np.array(moon_alts)>0,
+                                             color='yellow', alpha=alpha)
+
+    for axes in state['axes']:
+        axes.set_xlim(start, end)
+    if state['title'] is not None:
+        state['title'].set_text('(plot generated at {})'.format(end.strftime("%Y%m%d %H:%M:%S UT")))
+
+    state['figure'].savefig(state['file'], dpi=state['dpi'], bbox_inches='tight', pad_inches=0.10)
+    logger.info('Done.')
+
 
 
 
@@ -745,7 +824,13 @@ def main():
 #     LogFileHandler.setFormatter(LogFormat)
 #     logger.addHandler(LogFileHandler)
 
-    make_plots(args.date, args.telescope, logger, recent=recent)
+    if args.loop is True and recent is True:
+        state = make_plots(args.date, args.telescope, logger, recent=recent)
+        while True:
+            time.sleep(120)
+            update_recent_plots(state, logger)
+    else:
+        make_plots(args.date, args.telescope, logger, recent=recent)
 
 #     if args.loop is True:
 #         while True:
@@ -5,6 +5,7 @@ import datetime
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
 import logging
+import time
 
 import numpy as np
 import matplotlib as mpl
@@ -15,12 +16,11 @@ from matplotlib.dates import HourLocator, MinuteLocator, DateFormatter
 
 import pymongo
 from VYSOS import weather_limits
+from VYSOS.db import get_collection
+from VYSOS import ephemeris
 
 import astropy.units as u
 from astropy.table import Table, Column
-from astropy.time import Time
-from astropy.coordinates import EarthLocation
-from astroplan import Observer
 
 def moving_averagexy(x, y, window_size):
     if len(x) == 0:
@@ -39,34 +39,12 @@ def moving_averagexy(x, y, window_size):
 
 def get_twilights(start, end):
     """ Determine sunrise and sunset times """
-    location = EarthLocation(
-        lat=+19.53602,
-        lon=-155.57608,
-        height=3400,
-    )
-    obs = Observer(location=location, name='VYSOS',
-                   timezone='US/Hawaii')
-
-    sunset = obs.sun_set_time(Time(start), which='next').datetime
-    sunrise = obs.sun_rise_time(Time(start), which='next').datetime
-
-    # Calculate and order twilights and set plotting alpha for each
-    twilights = [(start, 'start', 0.0),
-                 (sunset, 'sunset', 0.0),
-                 (obs.twilight_evening_civil(Time(start),
-                                             which='next').datetime, 'ec', 0.1),
-                 (obs.twilight_evening_nautical(Time(start),
-                                                which='next').datetime, 'en', 0.2),
-                 (obs.twilight_evening_astronomical(Time(start),
-                                                    which='next').datetime, 'ea', 0.3),
-                 (obs.twilight_morning_astronomical(Time(start),
-                                                    which='next').datetime, 'ma', 0.5),
-                 (obs.twilight_morning_nautical(Time(start),
-                                                which='next').datetime, 'mn', 0.3),
-                 (obs.twilight_morning_civil(Time(start),
-                                             which='next').datetime, 'mc', 0.2),
-                 (sunrise, 'sunrise', 0.1),
-                 ]
+    # Set plotting alpha for the span which ends at each event
+    alphas = {'sunset': 0.0, 'ec': 0.1, 'en': 0.2, 'ea': 0.3,
+              'ma': 0.5, 'mn': 0.3, 'mc': 0.2, 'sunrise': 0.1}
+    twilights = [(start, 'start', 0.0)]
+    for when, name in ephemeris.twilight_events(start, end):
+        twilights.append((when, name, alphas[name]))
 
     twilights.sort(key=lambda x: x[0])
     final = {'sunset': 0.1, 'ec': 0.2, 'en': 0.3, 'ea': 0.5,
@@ -79,149 +57,228 @@ def get_twilights(start, end):
 
 
 
-def plot_weather(date=None, verbose=False):
-    '''
-    Make plot of the last 24 hours of weather or, if keyword date is set, make
-    plot of that UT day's weather.
+def classify(label, values):
+    '''Return the indices of the values which are safe, warning, and unsafe
+    according to the weather_limits for the given label.
     '''
-    if not date:
-        end = dt.utcnow()
+    if label == 'Rain':
+        wsafe = np.where(values > weather_limits[label][0])[0]
+        wwarn = np.where(np.array(values <= weather_limits[label][0])\
+                         & np.array(values > weather_limits[label][1]) )[0]
+        wunsafe = np.where(values <= weather_limits[label][1])[0]
     else:
-        raise NotImplementedError
-
-    start = end - tdelta(1,0)
+        wsafe = np.where(values < weather_limits[label][0])[0]
+        wwarn = np.where(np.array(values >= weather_limits[label][0])\
+                         & np.array(values < weather_limits[label][1]) )[0]
+        wunsafe = np.where(values >= weather_limits[label][1])[0]
+    assert len(values) - len(wsafe) - len(wwarn) - len(wunsafe) == 0
+    return wsafe, wwarn, wunsafe
 
-    client = pymongo.MongoClient('192.168.1.101', 27017)
-    db = client['vysos']
-    weather = client.vysos['weather']
-    data = [x for x in weather.find({'date': {'$gt': start, '$lt': end}},
-                                    sort=[('date', pymongo.DESCENDING)])]
-    time = np.array([x['date'] for x in data])
 
+class WeatherPlot(object):
+    '''
+    Plot of the last 24 hours of weather.
 
-#     me.connect('vysos', host='192.168.1.101')
-#     data = weather.objects(__raw__={'date': {'$gt': start, '$lt': end}})
-#     time = np.array([x.date for x in data])
-
-    dpi=72
-    fig = plt.figure(figsize=(20,10), dpi=dpi)
-    night_plot_file_name = 'weather.png'
-    destination_path = os.path.abspath('/var/www/')
-    night_plot_file = os.path.join(destination_path, night_plot_file_name)
+    The figure, the plotted artists, and the data arrays are kept between
+    calls to update() so that when run in a loop only the weather documents
+    newer than the last one seen are retrieved and the existing lines are
+    updated in place before the PNG is saved again.
+    '''
+    labels = ['Outside Temp (F)', 'Cloudiness (C)', 'Wind (kph)', 'Rain', 'Safe']
+    fields = ['temp', 'clouds', 'wind', 'rain', 'safe']
     plot_positions = [ [ [0.060, 0.700, 0.600, 0.220], [0.670, 0.700, 0.320, 0.220] ],
                        [ [0.060, 0.470, 0.600, 0.220], [0.670, 0.470, 0.320, 0.220] ],
                        [ [0.060, 0.240, 0.600, 0.220], [0.670, 0.240, 0.320, 0.220] ],
                        [ [0.060, 0.090, 0.600, 0.140], [0.670, 0.090, 0.320, 0.140] ],
                        [ [0.060, 0.020, 0.600, 0.060], [0.670, 0.020, 0.320, 0.060] ],
                      ]
-    labels = ['Outside Temp (F)', 'Cloudiness (C)', 'Wind (kph)', 'Rain', 'Safe']
-    data = [ np.array([(float(x['temp'])*1.8+32.) for x in data]),
-             np.array([float(x['clouds']) for x in data]),
-             np.array([float(x['wind']) for x in data]),
-             np.array([float(x['rain']) for x in data]),
-             np.array([float(x['safe']) for x in data]),
-           ]
-
-    windlim_data = list(data[2]*1.1) # multiply by 1.1 for plot limit
-    windlim_data.append(65) # minimum limit on plot is 65
-    ylims = [ (25,95),
-              (-45,15),
-              (-2,max(windlim_data)),
-              (3000,0),
-              (-0.25, 1.1),
-            ]
-
-    ##-------------------------------------------------------------------------
-    ## Loop Over Plots
-    ##-------------------------------------------------------------------------
-    for i,label in enumerate(labels):
-        if verbose: print(label)
-        if label in weather_limits.keys():
-            if label == 'Rain':
-                wsafe = np.where(data[i] > weather_limits[label][0])[0]
-                wwarn = np.where(np.array(data[i] <= weather_limits[label][0])\
-                                 & np.array(data[i] > weather_limits[label][1]) )[0]
-                wunsafe = np.where(data[i] <= weather_limits[label][1])[0]
-            else:
-                wsafe = np.where(data[i] < weather_limits[label][0])[0]
-                wwarn = np.where(np.array(data[i] >= weather_limits[label][0])\
-                                 & np.array(data[i] < weather_limits[label][1]) )[0]
-                wunsafe = np.where(data[i] >= weather_limits[label][1])[0]
-            if verbose: print(len(data[i]), len(wsafe), len(wwarn), len(wunsafe))
-            assert len(data[i]) - len(wsafe) - len(wwarn) - len(wunsafe) == 0
-
 
-        for lr in range(2):
-            t_axes = plt.axes(plot_positions[i][lr])
-            if label != 'Safe':
-                ## Overplot Twilights
-                twilights = get_twilights(start, end)
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.dpi = 72
+        destination_path = os.path.abspath('/var/www/')
+        self.night_plot_file = os.path.join(destination_path, 'weather.png')
+        self.time = np.array([], dtype='datetime64[us]')
+        self.data = [np.array([], dtype=np.float64) for label in self.labels]
+        self.fig = None
+        self.axes = []
+        self.lines = []
+        self.fills = []
+        self.spans = []
+
+    def fetch(self):
+        '''Retrieve weather documents newer than the last one already held
+        and drop any older than the start of the plot.
+        '''
+        if len(self.time) > 0:
+            since = self.time[-1].astype(dt)
+        else:
+            since = self.start
+        weather = get_collection('weather')
+        projection = {field: 1 for field in self.fields}
+        projection['date'] = 1
+        projection['_id'] = 0
+        new = [x for x in weather.find({'date': {'$gt': since, '$lt': self.end}},
+                                       projection=projection,
+                                       sort=[('date', pymongo.ASCENDING)])]
+        if self.verbose: print(f'Retrieved {len(new)} new weather documents')
+        new_time = np.array([x['date'] for x in new], dtype='datetime64[us]')
+        new_data = [ np.array([(float(x['temp'])*1.8+32.) for x in new]),
+                     np.array([float(x['clouds']) for x in new]),
+                     np.array([float(x['wind']) for x in new]),
+                     np.array([float(x['rain']) for x in new]),
+                     np.array([float(x['safe']) for x in new]),
+                   ]
+        keep = self.time > np.datetime64(self.start, 'us')
+        self.time = np.concatenate([self.time[keep], new_time])
+        self.data = [np.concatenate([old[keep], new_data[i]])
+                     for i,old in enumerate(self.data)]
+
+    def ylims(self):
+        windlim_data = list(self.data[2]*1.1) # multiply by 1.1 for plot limit
+        windlim_data.append(65) # minimum limit on plot is 65
+        return [ (25,95),
+                 (-45,15),
+                 (-2,max(windlim_data)),
+                 (3000,0),
+                 (-0.25, 1.1),
+               ]
+
+    def draw_twilights(self):
+        for span in self.spans:
+            span.remove()
+        self.spans = []
+        twilights = get_twilights(self.start, self.end)
+        for i,label in enumerate(self.labels):
+            if label == 'Safe':
+                continue
+            for lr in range(2):
                 for j in range(len(twilights)-1):
-                    plt.axvspan(twilights[j][0], twilights[j+1][0], ymin=0, ymax=1,
-                                color='blue', alpha=twilights[j+1][2])
-                ## Plot data
-                if label in weather_limits.keys():
-                    t_axes.plot_date(time, data[i], 'ko', label=label,
-                                     markersize=2, markeredgewidth=0,
-                                     drawstyle="default")
-                    if len(wsafe) > 0:
-                        t_axes.plot_date(time[wsafe], data[i][wsafe], 'go',
-                                         markersize=2, markeredgewidth=0,
-                                         drawstyle="default")
-                    if len(wwarn) > 0:
-                        t_axes.plot_date(time[wwarn], data[i][wwarn], 'yo',
-                                         markersize=2, markeredgewidth=0,
-                                         drawstyle="default")
-                    if len(wunsafe) > 0:
-                        t_axes.plot_date(time[wunsafe], data[i][wunsafe], 'ro',
-                                         markersize=2, markeredgewidth=0,
-                                         drawstyle="default")
-
-                else:
-                    t_axes.plot_date(time, data[i], 'ko', label=label,
-                                     markersize=2, markeredgewidth=0,
-                                     drawstyle="default")
-            else:
-                plt.fill_between(time, -1, data[i], where=np.array(data[i])>0, facecolor='green')
-                plt.fill_between(time, -1, data[i], where=np.array(data[i])<=0, facecolor='red')
-            if label == 'Wind (kph)':
-                matime, wind_mavg = moving_averagexy(time, data[i], 9)
-                t_axes.plot_date(matime, wind_mavg, 'k-')
-            if lr==0:
-                if i==0:
-                    plt.title('VYSOS Weather (at {})'.format(end.strftime('%Y/%m/%d %H:%M:%S UT')))
-                plt.ylabel(label)
-                plt.xlim(start, end)
-                t_axes.xaxis.set_major_locator(HourLocator(byhour=range(24)))
-                if label == 'Rain':
-                    t_axes.get_yaxis().set_ticklabels([])
-                if i == len(labels)-1:
-                    t_axes.set_yticks([])
+                    self.spans.append(self.axes[i][lr].axvspan(
+                                      twilights[j][0], twilights[j+1][0],
+                                      ymin=0, ymax=1, color='blue',
+                                      alpha=twilights[j+1][2]))
+
+    def draw_fills(self):
+        for fill in self.fills:
+            fill.remove()
+        self.fills = []
+        i = self.labels.index('Safe')
+        for lr in range(2):
+            t_axes = self.axes[i][lr]
+            self.fills.append(t_axes.fill_between(self.time, -1, self.data[i],
+                              where=np.array(self.data[i])>0, facecolor='green'))
+            self.fills.append(t_axes.fill_between(self.time, -1, self.data[i],
+                              where=np.array(self.data[i])<=0, facecolor='red'))
+
+    def draw(self):
+        '''Create the figure and all of the plot elements.
+        '''
+        self.fig = plt.figure(figsize=(20,10), dpi=self.dpi)
+        ylims = self.ylims()
+        for i,label in enumerate(self.labels):
+            if self.verbose: print(label)
+            self.axes.append([])
+            self.lines.append([])
+            for lr in range(2):
+                t_axes = self.fig.add_axes(self.plot_positions[i][lr])
+                self.axes[i].append(t_axes)
+                lines = {}
+                if label != 'Safe':
+                    ## Plot data
+                    lines['all'] = t_axes.plot_date(self.time, self.data[i], 'ko',
+                                                    label=label, markersize=2,
+                                                    markeredgewidth=0,
+                                                    drawstyle="default")[0]
+                    if label in weather_limits.keys():
+                        for key,fmt in [('safe', 'go'), ('warn', 'yo'), ('unsafe', 'ro')]:
+                            lines[key] = t_axes.plot_date([], [], fmt,
+                                                          markersize=2,
+                                                          markeredgewidth=0,
+                                                          drawstyle="default")[0]
+                if label == 'Wind (kph)':
+                    lines['average'] = t_axes.plot_date([], [], 'k-')[0]
+                self.lines[i].append(lines)
+                if lr==0:
+                    if i==0:
+                        self.title = t_axes.set_title('')
+                    t_axes.set_ylabel(label)
+                    t_axes.xaxis.set_major_locator(HourLocator(byhour=range(24)))
+                    if label == 'Rain':
+                        t_axes.get_yaxis().set_ticklabels([])
+                    if i == len(self.labels)-1:
+                        t_axes.set_yticks([])
+                        t_axes.get_yaxis().set_ticklabels([])
+                        t_axes.xaxis.set_major_formatter(DateFormatter('%H'))
+                    else:
+                        t_axes.grid(which='major', color='k')
+                        t_axes.grid(which='minor', color='k', alpha=0.8)
+                        t_axes.xaxis.set_major_formatter(plt.NullFormatter())
+                elif lr==1:
+                    t_axes.get_xaxis().set_ticklabels([])
                     t_axes.get_yaxis().set_ticklabels([])
-                    t_axes.xaxis.set_major_formatter(DateFormatter('%H'))
-                else:
-                    plt.grid(which='major', color='k')
-                    plt.grid(which='minor', color='k', alpha=0.8)
-                    t_axes.xaxis.set_major_formatter(plt.NullFormatter())
-            elif lr==1:
-                plt.xlim(end - tdelta(0,1.25*60*60), end)
-                t_axes.get_xaxis().set_ticklabels([])
-                t_axes.get_yaxis().set_ticklabels([])
-                t_axes.xaxis.set_major_locator(HourLocator(byhour=range(24)))
-                t_axes.xaxis.set_minor_locator(MinuteLocator(range(0,60,15)))
-                if i == len(labels)-1:
-                    t_axes.set_yticks([])
-                    t_axes.xaxis.set_major_formatter(DateFormatter('%H:%M'))
-                    t_axes.xaxis.set_minor_formatter(DateFormatter('%H:%M'))
+                    t_axes.xaxis.set_major_locator(HourLocator(byhour=range(24)))
+                    t_axes.xaxis.set_minor_locator(MinuteLocator(range(0,60,15)))
+                    if i == len(self.labels)-1:
+                        t_axes.set_yticks([])
+                        t_axes.xaxis.set_major_formatter(DateFormatter('%H:%M'))
+                        t_axes.xaxis.set_minor_formatter(DateFormatter('%H:%M'))
+                    else:
+                        t_axes.grid(which='major', color='k')
+                        t_axes.grid(which='minor', color='k', alpha=0.8)
+                        t_axes.xaxis.set_major_formatter(plt.NullFormatter())
+                t_axes.set_ylim(ylims[i])
+                if i == len(self.labels)-1:
+                    t_axes.set_xlabel("UT Time")
+
+    def refresh(self):
+        '''Update the data in all of the plot elements and the time range.
+        '''
+        ylims = self.ylims()
+        for i,label in enumerate(self.labels):
+            if label in weather_limits.keys():
+                wsafe, wwarn, wunsafe = classify(label, self.data[i])
+            for lr in range(2):
+                lines = self.lines[i][lr]
+                if 'all' in lines.keys():
+                    lines['all'].set_data(self.time, self.data[i])
+                if label in weather_limits.keys():
+                    lines['safe'].set_data(self.time[wsafe], self.data[i][wsafe])
+                    lines['warn'].set_data(self.time[wwarn], self.data[i][wwarn])
+                    lines['unsafe'].set_data(self.time[wunsafe], self.data[i][wunsafe])
+                if 'average' in lines.keys():
+                    lines['average'].set_data(*moving_averagexy(self.time, self.data[i], 9))
+                if lr == 0:
+                    self.axes[i][lr].set_xlim(self.start, self.end)
                 else:
-                    plt.grid(which='major', color='k')
-                    plt.grid(which='minor', color='k', alpha=0.8)
-                    t_axes.xaxis.set_major_formatter(plt.NullFormatter())
-            plt.ylim(ylims[i])
-            if i == len(labels)-1:
-                plt.xlabel("UT Time")
+                    self.axes[i][lr].set_xlim(self.end - tdelta(0,1.25*60*60), self.end)
+                self.axes[i][lr].set_ylim(ylims[i])
+        self.draw_fills()
+        self.draw_twilights()
+        self.title.set_text('VYSOS Weather (at {})'.format(self.end.strftime('%Y/%m/%d %H:%M:%S UT')))
+
+    def update(self):
+        '''Retrieve new data, update the plot, and save the PNG file.
+        '''
+        self.end = dt.utcnow()
+        self.start = self.end - tdelta(1,0)
+        self.fetch()
+        if self.fig is None:
+            self.draw()
+        self.refresh()
+        self.fig.savefig(self.night_plot_file, dpi=self.dpi, bbox_inches='tight')
 
-    plt.savefig(night_plot_file, dpi=dpi, bbox_inches='tight')
+
+def plot_weather(date=None, verbose=False):
+    '''
+    Make plot of the last 24 hours of weather or, if keyword date is set, make
+    plot of that UT day's weather.
+    '''
+    if date:
+        raise NotImplementedError
+    plot = WeatherPlot(verbose=verbose)
+    plot.update()
+    return plot
 
 
 def main():
@@ -247,11 +304,9 @@ def main():
         args.date = dt.utcnow().strftime("%Y%m%dUT")
 
     if args.loop:
+        plot = WeatherPlot(verbose=args.verbose)
         while True:
-            ## Set date to tonight
-            now = dt.utcnow()
-            date_string = now.strftime("%Y%m%dUT")
-            plot_weather(verbose=args.verbose)
+            plot.update()
             time.sleep(120)
     else:
         plot_weather(verbose=args.verbose)
@@ -25,6 +25,9 @@ import SIDRE
 
 import pymongo
 
+from VYSOS import mongo_address
+from VYSOS.db import get_collection
+from VYSOS.asof import match_images
 
 
 ##-------------------------------------------------------------------------
@@ -123,6 +126,14 @@ def measure_image(file,\
     image_info['FWHM_pix'] = im.FWHM_pix
     image_info['ellipticity'] = im.ellipticity
 
+    ## Telescope temperatures during the exposure
+    if record and 'telescope' in image_info and 'date' in image_info:
+        try:
+            match_images([image_info], f"{image_info['telescope']}status",
+                         ['focuser_temperature', 'primary_temperature'])
+        except pymongo.errors.PyMongoError as e:
+            im.log.warning(f'Could not get telescope temperatures during exposure: {e}')
+
 
     ## Load (local) photometric reference catalog
 #     image_info.target = im.ccd.header.get('OBJECT')
@@ -160,11 +171,9 @@ def measure_image(file,\
                        overplot_assoc=False, overplot_pointing=True)
     
     if record:
-        im.log.info('Connecting to mongo db at 192.168.1.101')
+        im.log.info(f'Connecting to mongo db at {mongo_address}')
         try:
-            client = pymongo.MongoClient('192.168.1.101', 27017)
-            db = client.vysos
-            images = db['images']
+            images = get_collection('images')
         except:
             im.log.error('Could not connect to mongo db')
             raise Exception('Failed to connect to mongo')
@@ -203,7 +212,6 @@ def measure_image(file,\
                 e = sys.exc_info()[0]
                 im.log.error('Failed to add new document')
                 im.log.error(e)
-            client.close()
 
 
 
@@ -8,14 +8,72 @@ import fnmatch
 import numpy
 from datetime import datetime as dt
 import glob
+import shutil
+import tempfile
+import traceback
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 import astropy.io.fits as fits
 
 import IQMon
 from measure_image import measure_image
 
 
-def measure_night(date=None, telescope=None):
+##-------------------------------------------------------------------------
+## Worker Setup for Parallel Analysis
+##-------------------------------------------------------------------------
+def init_worker(tmp_root):
+    '''Give each worker process its own temporary directory so that SIDRE
+    and astrometry.net scratch files from different images can not collide.
+    '''
+    worker_tmp = tempfile.mkdtemp(prefix=f'worker{os.getpid()}_', dir=tmp_root)
+    os.environ['TMPDIR'] = worker_tmp
+    tempfile.tempdir = worker_tmp
+
+
+def measure_one(file):
+    '''Run measure_image on a single file and return a tuple of (file,
+    elapsed seconds, error string or None).  Exceptions are caught here so
+    that one bad frame does not take down the rest of the night.
+    '''
+    tick = dt.utcnow()
+    error = None
+    try:
+        measure_image(file, nographics=True)
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    elapsed = (dt.utcnow() - tick).total_seconds()
+    return (file, elapsed, error)
+
+
+def measure_files(files, workers=1):
+    '''Analyze a list of files using a pool of worker processes.  At most
+    2*workers images are queued at any time and results are yielded in the
+    same order as the input list.
+    '''
+    if workers <= 1:
+        for file in files:
+            yield measure_one(file)
+        return
+
+    tmp_root = tempfile.mkdtemp(prefix='measure_night_')
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(tmp_root,)) as pool:
+            pending = deque()
+            for file in files:
+                pending.append(pool.submit(measure_one, file))
+                if len(pending) >= 2*workers:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+def measure_night(date=None, telescope=None, workers=1):
     ##-------------------------------------------------------------------------
     ## Set date to tonight if not specified
     ##-------------------------------------------------------------------------
@@ -43,9 +101,36 @@ def measure_night(date=None, telescope=None):
     
         files = glob.glob(os.path.join(location, '*.fts'))
         files.extend(glob.glob(os.path.join(location, '*.fts.fz')))
+        files = sorted(files)
         print(f"Found {len(files):d} files in images directory")
-        for file in files:
-            measure_image(file, nographics=True)
+
+        tick = dt.utcnow()
+        times = []
+        failures = []
+        for i,result in enumerate(measure_files(files, workers=workers)):
+            file, elapsed, error = result
+            times.append(elapsed)
+            if error is not None:
+                failures.append(file)
+                print(f"  {i+1:4d}/{len(files):d} FAILED {os.path.basename(file)}: {error}")
+            else:
+                print(f"  {i+1:4d}/{len(files):d} {os.path.basename(file)} ({elapsed:.1f} s)")
+        wall_time = (dt.utcnow() - tick).total_seconds()
+
+        ##---------------------------------------------------------------------
+        ## Summary
+        ##---------------------------------------------------------------------
+        print(f"Summary for {telescope} on {date}")
+        print(f"  Workers: {workers:d}")
+        print(f"  Images analyzed: {len(times)-len(failures):d} of {len(files):d}")
+        print(f"  Wall time: {wall_time:.1f} s")
+        if len(times) > 0:
+            print(f"  Per image time: mean={numpy.mean(times):.1f} s, "
+                  f"median={numpy.median(times):.1f} s, max={numpy.max(times):.1f} s")
+            print(f"  Effective throughput: {wall_time/len(times):.1f} s per image")
+        print(f"  Failures: {len(failures):d}")
+        for file in failures:
+            print(f"    {file}")
 
 
 if __name__ == "__main__":
@@ -66,7 +151,9 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--date", 
         dest="date", required=False, default="", type=str,
         help="UT date of night to analyze. (i.e. '20130805UT')")
+    parser.add_argument("-w", "--workers",
+        dest="workers", required=False, default=1, type=int,
+        help="Number of worker processes to analyze images in parallel. (default = 1)")
     args = parser.parse_args()
 
-    measure_night(date=args.date, telescope=args.telescope)
-
+    measure_night(date=args.date, telescope=args.telescope, workers=args.workers)
@@ -1,72 +1,265 @@
-import sys
+import re
+import asyncio
 import logging
 import argparse
 from datetime import datetime as dt
-from time import sleep
 import pymongo
 import requests
 
+from VYSOS.db import get_collection
+from VYSOS.telemetry import get_writer
+
 # import mongoengine as me
 # from VYSOS.schema import weather, currentweather
 
+aag_address = 'http://192.168.1.105'
+## (connect, read) timeouts in seconds for queries to the AAG Solo
+timeout = (3.05, 10)
+
+
+##-------------------------------------------------------------------------
+## Parse AAG Solo Results
+##-------------------------------------------------------------------------
+def make_weatherdoc(result, querydate=None):
+    '''Build a weather document from a dict of the AAG Solo key, value
+    strings.
+    '''
+    return {"date": dt.strptime(result['dataGMTTime'], '%Y/%m/%d %H:%M:%S'),
+            "querydate": querydate,
+            "clouds": float(result['clouds']),
+            "temp": float(result['temp']),
+            "wind": float(result['wind']),
+            "gust": float(result['gust']),
+            "rain": int(float(result['rain'])),
+            "light": int(float(result['light'])),
+            "switch": int(float(result['switch'])),
+            "safe": {'1': True, '0': False}[result['safe'].strip()],
+           }
+
+
+def parse_last_data(text, querydate=None):
+    '''Parse the output of cgiLastData (one key=value pair per line) in to a
+    weather document.
+    '''
+    result = {}
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        key, val = line.split('=', 1)
+        result[key.strip()] = val.strip()
+    return make_weatherdoc(result, querydate=querydate)
+
+
+def parse_hist_data(text):
+    '''Parse the output of cgiHistData in to a list of weather documents
+    sorted by date.  Each record is either a line of key=value pairs
+    (separated by commas or ampersands) or, if the first line
+    has no "=", a row of a CSV table whose first line gives the keys.  Lines
+    which can not be parsed are skipped.
+    '''
+    lines = [line.strip() for line in text.splitlines() if line.strip() != '']
+    if len(lines) == 0:
+        return []
+    if '=' in lines[0]:
+        records = [dict([val.strip() for val in pair.split('=', 1)]
+                        for pair in re.split('[,&]', line) if '=' in pair)
+                   for line in lines]
+    else:
+        keys = [key.strip() for key in lines[0].split(',')]
+        records = [dict(zip(keys, [val.strip() for val in line.split(',')]))
+                   for line in lines[1:]]
+    weatherdocs = []
+    for record in records:
+        try:
+            weatherdocs.append(make_weatherdoc(record))
+        except (KeyError, ValueError):
+            continue
+    return sorted(weatherdocs, key=lambda doc: doc['date'])
+
+
+##-------------------------------------------------------------------------
+## Filter Repeated and Unchanged Samples
+##-------------------------------------------------------------------------
+## Changes smaller than these are ignored in change only mode.  Fields not
+## listed (e.g. safe, switch) are stored on any change.
+deadbands = {'clouds': 0.5,
+             'temp': 0.2,
+             'wind': 1.0,
+             'gust': 1.0,
+             'rain': 50,
+             'light': 50,
+            }
+
+
+class SampleFilter(object):
+    '''Decide which weather samples to store.  Samples whose device timestamp
+    has not advanced are always dropped.  In change only mode a sample is
+    also dropped unless a value has moved beyond its deadband since the
+    last stored sample or heartbeat seconds have passed since then.
+
+    The status pages call the weather stale after 60 seconds, so with the
+    20 second poll a steady reading must be stored at least every 40
+    seconds (the next poll after a 30 second heartbeat).  Stored samples are
+    flushed immediately in change only mode so that the writer's flush
+    interval does not add to this.
+    '''
+    def __init__(self, change_only=False, heartbeat=30, deadbands=deadbands):
+        self.change_only = change_only
+        self.heartbeat = heartbeat
+        self.deadbands = deadbands
+        self.last_date = None
+        self.last_stored = None
+
+    def accept(self, weatherdoc):
+        if self.last_date is not None and weatherdoc['date'] <= self.last_date:
+            return False
+        self.last_date = weatherdoc['date']
+        if self.change_only and self.last_stored is not None:
+            age = (weatherdoc['date'] - self.last_stored['date']).total_seconds()
+            if age < self.heartbeat and not self.changed(weatherdoc):
+                return False
+        self.last_stored = weatherdoc
+        return True
+
+    def changed(self, weatherdoc):
+        for key, value in weatherdoc.items():
+            if key in ['date', 'querydate']:
+                continue
+            last = self.last_stored.get(key, None)
+            if key in self.deadbands:
+                if last is None or abs(value - last) > self.deadbands[key]:
+                    return True
+            elif value != last:
+                return True
+        return False
+
+
 ##-------------------------------------------------------------------------
 ## Query AAG Solo for Weather Data
 ##-------------------------------------------------------------------------
-def get_weather(logger, robust=True):
+def get_weather(logger, session=None, sample_filter=None):
+    '''Query cgiLastData, save the result, and return the weather document
+    (or None if the query failed).  If a SampleFilter is given, samples it
+    rejects are returned but not saved.
+    '''
     logger.info('Getting Weather status')
-    
-    # http://aagsolo/cgi-bin/cgiLastData
-    # http://aagsolo/cgi-bin/cgiHistData
+    if session is None:
+        session = requests
     querydate = dt.utcnow()
-    address = 'http://192.168.1.105/cgi-bin/cgiLastData'
+    address = f'{aag_address}/cgi-bin/cgiLastData'
 
     try:
-        r = requests.get(address)
-    except:
-        logger.error('Failed to connect to AAG Solo')
-    else:
-        lines = r.text.splitlines()
-        result = {}
-        for line in lines:
-            key, val = line.split('=')
-            result[str(key)] = str(val)
-            logger.debug('  {} = {}'.format(key, val))
-        logger.info('  Done.')
-
-        weatherdoc = {"date": dt.strptime(result['dataGMTTime'], '%Y/%m/%d %H:%M:%S'),
-                      "querydate": querydate,
-                      "clouds": float(result['clouds']),
-                      "temp": float(result['temp']),
-                      "wind": float(result['wind']),
-                      "gust": float(result['gust']),
-                      "rain": int(result['rain']),
-                      "light": int(result['light']),
-                      "switch": int(result['switch']),
-                      "safe": {'1': True, '0': False}[result['safe']],
-                     }
-
-        threshold = 30
-        age = (weatherdoc["querydate"] - weatherdoc["date"]).total_seconds()
-        logger.debug('Data age = {:.1f} seconds'.format(age))
-        if age > threshold:
-            logger.warning('Age of weather data ({:.1f}) is greater than {:.0f} seconds'.format(
-                           age, threshold))
-
-        logger.info('Saving weather document')
-        logger.info('Connecting to mongoDB')
-        client = pymongo.MongoClient('192.168.1.101', 27017)
-        db = client.vysos
-        weather = db.weather
+        r = session.get(address, timeout=timeout)
+        r.raise_for_status()
+        weatherdoc = parse_last_data(r.text, querydate=querydate)
+    except Exception as e:
+        logger.error(f'Failed to get data from AAG Solo: {e}')
+        return None
+    logger.info('  Done.')
+
+    threshold = 30
+    age = (weatherdoc["querydate"] - weatherdoc["date"]).total_seconds()
+    logger.debug('Data age = {:.1f} seconds'.format(age))
+    if age > threshold:
+        logger.warning('Age of weather data ({:.1f}) is greater than {:.0f} seconds'.format(
+                       age, threshold))
+
+    if sample_filter is not None and not sample_filter.accept(weatherdoc):
+        logger.info('  Weather unchanged, not saving')
+        return weatherdoc
+
+    logger.info('Saving weather document')
+    flush = sample_filter is not None and sample_filter.change_only
+    get_writer('weather', upsert_key='date', logger=logger).write(weatherdoc, flush=flush)
+    return weatherdoc
+
+
+##-------------------------------------------------------------------------
+## Backfill Gaps from AAG Solo History
+##-------------------------------------------------------------------------
+def backfill(start, end, logger, session=None):
+    '''Fetch cgiHistData and save the samples with dates between start and
+    end which are not already in the weather collection.
+    '''
+    logger.info(f'Backfilling weather from {start} to {end}')
+    if session is None:
+        session = requests
+    address = f'{aag_address}/cgi-bin/cgiHistData'
+    try:
+        r = session.get(address, timeout=timeout)
+        r.raise_for_status()
+        weatherdocs = [doc for doc in parse_hist_data(r.text)
+                       if doc['date'] > start and doc['date'] < end]
+        existing = set(get_collection('weather').distinct('date',
+                       {'date': {'$gt': start, '$lt': end}}))
+    except Exception as e:
+        logger.error(f'Failed to backfill weather: {e}')
+        return 0
+    missing = [doc for doc in weatherdocs if doc['date'] not in existing]
+    writer = get_writer('weather', upsert_key='date', logger=logger)
+    for doc in missing:
+        writer.write(doc)
+    logger.info(f'  Backfilled {len(missing)} of {len(weatherdocs)} samples')
+    return len(missing)
 
+
+##-------------------------------------------------------------------------
+## Ingest Loop
+##-------------------------------------------------------------------------
+def latest_weather_date(logger):
+    '''Return the date of the newest document in the weather collection, or
+    None if there is none or mongo can not be reached.
+    '''
+    try:
+        latest = get_collection('weather').find_one({}, projection={'date': 1},
+                                                    sort=[('date', pymongo.DESCENDING)])
+    except pymongo.errors.PyMongoError as e:
+        logger.warning(f'Could not get latest weather date: {e}')
+        return None
+    return latest['date'] if latest is not None else None
+
+
+async def ingest(logger, interval=20, gap=60, sample_filter=None):
+    '''Query the AAG Solo every interval seconds.  The blocking HTTP calls
+    run in the default executor with timeouts, using one persistent
+    session.  If the device timestamp jumps by more than gap seconds (e.g.
+    after a network or ingest outage) the missing samples are backfilled
+    from cgiHistData in the background.  Only one backfill runs at a time,
+    a gap found while one is running is logged and not backfilled.
+    '''
+    loop = asyncio.get_event_loop()
+    session = requests.Session()
+    backfilling = None
+
+    def backfill_done(future):
         try:
-            inserted_id = weather.insert_one(weatherdoc).inserted_id
-            logger.info("  Inserted document with id: {}".format(inserted_id))
-        except:
-            e = sys.exc_info()[0]
-            logger.error('Failed to add new document')
-            logger.error(e)
+            logger.info(f'Backfill finished, saved {future.result()} samples')
+        except Exception as e:
+            logger.error(f'Backfill failed: {e}')
+
+    ## Start from the newest stored sample so that the gap left by a restart
+    ## of this process is backfilled too
+    last_date = await loop.run_in_executor(None, latest_weather_date, logger)
+    next_time = loop.time()
+    while True:
+        weatherdoc = await loop.run_in_executor(None, get_weather, logger,
+                                                session, sample_filter)
+        if weatherdoc is not None:
+            if last_date is not None and\
+               (weatherdoc['date'] - last_date).total_seconds() > gap:
+                if backfilling is not None and not backfilling.done():
+                    logger.warning(f'Backfill already running, not backfilling '
+                                   f'{last_date} to {weatherdoc["date"]}')
+                else:
+                    ## requests.Session is not thread safe, so the backfill
+                    ## (which runs alongside the polls) does not share it
+                    backfilling = loop.run_in_executor(None, backfill, last_date,
+                                                       weatherdoc['date'], logger)
+                    backfilling.add_done_callback(backfill_done)
+            last_date = weatherdoc['date']
+        next_time += interval
+        await asyncio.sleep(max(next_time - loop.time(), 0))
 
-        client.close()
 
 if __name__ == '__main__':
 
@@ -80,9 +273,14 @@ if __name__ == '__main__':
     parser.add_argument("-v", "--verbose",
         action="store_true", dest="verbose",
         default=False, help="Be verbose! (default = False)")
-    parser.add_argument("--notrobust",
-        action="store_true", dest="notrobust",
-        default=False, help="Use try except to catch errors.")
+    parser.add_argument("--change-only",
+        action="store_true", dest="change_only",
+        default=False, help="Only store samples which changed beyond the deadbands (plus a heartbeat).")
+    parser.add_argument("--heartbeat",
+        type=float, dest="heartbeat", default=30,
+        help="In change only mode, store a sample at least this often (seconds, "
+             "default = 30).  The next 20 second poll after the heartbeat must "
+             "be well under 60 s or the status pages report stale weather.")
     ## add arguments
     args = parser.parse_args()
 
@@ -107,7 +305,7 @@ if __name__ == '__main__':
         LogConsoleHandler.setFormatter(LogFormat)
         logger.addHandler(LogConsoleHandler)
 
-    while True:
-        get_weather(logger, robust=not args.notrobust)
-        logging.shutdown()
-        sleep(20)
+    sample_filter = SampleFilter(change_only=args.change_only,
+                                 heartbeat=args.heartbeat)
+    asyncio.get_event_loop().run_until_complete(
+        ingest(logger, interval=20, sample_filter=sample_filter))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Maintain downsampled copies of the weather and telescope status telemetry.
+
+For each raw collection (e.g. weather) and resolution (1 minute, 10 minutes,
+1 hour) a rollup collection (e.g. weather_1m) holds one document per time
+bucket with the min, mean, and max of each numeric field and the number of
+raw samples in the bucket.  Rollups are built incrementally with an
+aggregation which $merges in to the rollup collection, so each run only
+reads the raw documents since the last bucket.
+
+query_telemetry picks the coarsest resolution which still gives at least
+one point per pixel for the requested time span, so long-range plots read
+far fewer documents than the raw 20 second samples.
+"""
+
+import time
+from argparse import ArgumentParser
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+import pymongo
+
+from VYSOS.db import get_db
+
+
+## (suffix, bucket size in seconds), finest first
+resolutions = [('1m', 60), ('10m', 600), ('1h', 3600)]
+
+status_fields = ['alt', 'az', 'focuser_temperature', 'focuser_position',
+                 'truss_temperature', 'primary_temperature',
+                 'secondary_temperature', 'fan_speed', 'dome_temperature']
+
+## Numeric fields to roll up for each raw collection
+rollup_fields = {'weather': ['clouds', 'temp', 'wind', 'gust', 'rain', 'light'],
+                 'V20status': status_fields,
+                 'V5status': status_fields,
+                }
+
+
+def rollup_collections():
+    '''Return the list of rollup collection names.
+    '''
+    return [f'{collection}_{suffix}' for collection in rollup_fields.keys()
+            for suffix, seconds in resolutions]
+
+
+##-------------------------------------------------------------------------
+## Build Rollups
+##-------------------------------------------------------------------------
+def bucket_start(date, seconds):
+    epoch = dt(1970, 1, 1)
+    offset = int((date - epoch).total_seconds()) // seconds * seconds
+    return epoch + tdelta(0, offset)
+
+
+def suffix_for(seconds):
+    return {s: suffix for suffix, s in resolutions}[seconds]
+
+
+def rollup_pipeline(collection, seconds, start, end):
+    ms = seconds*1000
+    bucket = {'$toDate': {'$subtract': [{'$toLong': '$date'},
+                                        {'$mod': [{'$toLong': '$date'}, ms]}]}}
+    group = {'_id': bucket, 'n': {'$sum': 1}}
+    for field in rollup_fields[collection]:
+        group[f'{field}_min'] = {'$min': f'${field}'}
+        group[f'{field}_mean'] = {'$avg': f'${field}'}
+        group[f'{field}_max'] = {'$max': f'${field}'}
+    return [{'$match': {'date': {'$gte': start, '$lt': end}}},
+            {'$group': group},
+            {'$addFields': {'date': '$_id'}},
+            {'$project': {'_id': 0}},
+            {'$merge': {'into': f'{collection}_{suffix_for(seconds)}',
+                        'on': 'date',
+                        'whenMatched': 'replace',
+                        'whenNotMatched': 'insert'}},
+           ]
+
+
+def ensure_indexes(db):
+    for name in rollup_collections():
+        db[name].create_index([('date', pymongo.ASCENDING)], unique=True)
+
+
+def update_rollup(db, collection, seconds, end=None):
+    '''Recompute the rollup buckets from the last (possibly incomplete) bucket
+    in the rollup collection up to end.  Returns the start of the range
+    which was recomputed.
+    '''
+    if end is None:
+        end = dt.utcnow()
+    target = db[f'{collection}_{suffix_for(seconds)}']
+    last = target.find_one({}, projection={'date': 1}, sort=[('date', pymongo.DESCENDING)])
+    if last is not None:
+        start = last['date']
+    else:
+        first = db[collection].find_one({}, projection={'date': 1},
+                                        sort=[('date', pymongo.ASCENDING)])
+        if first is None:
+            return None
+        start = bucket_start(first['date'], seconds)
+    db[collection].aggregate(rollup_pipeline(collection, seconds, start, end),
+                             allowDiskUse=True)
+    return start
+
+
+def update_rollups(db, collections=None):
+    '''Update every resolution for each of the raw collections and return a
+    list of (rollup collection, start of recomputed range).
+    '''
+    if collections is None:
+        collections = rollup_fields.keys()
+    updated = []
+    for collection in collections:
+        for suffix, seconds in resolutions:
+            start = update_rollup(db, collection, seconds)
+            updated.append((f'{collection}_{suffix}', start))
+    return updated
+
+
+##-------------------------------------------------------------------------
+## Query Telemetry at a Suitable Resolution
+##-------------------------------------------------------------------------
+def pick_resolution(start, end, width=1000):
+    '''Return the (suffix, seconds) of the coarsest resolution which gives at
+    least one point per pixel across width pixels, or None if the raw data
+    should be used.
+    '''
+    seconds_per_pixel = (end - start).total_seconds() / width
+    choice = None
+    for suffix, seconds in resolutions:
+        if seconds <= seconds_per_pixel:
+            choice = (suffix, seconds)
+    return choice
+
+
+def query_telemetry(collection, start, end, fields=None, width=1000, db=None):
+    '''Return (resolution, documents) for the collection between start and
+    end, sorted by date.  The resolution is the rollup suffix or 'raw'.  For
+    rollups each field is the bucket mean, with field_min, field_max and n
+    also available, so callers can treat raw and rolled up documents alike.
+    '''
+    if db is None:
+        db = get_db()
+    if fields is None:
+        fields = rollup_fields[collection]
+    resolution = pick_resolution(start, end, width=width)
+    query = {'date': {'$gte': start, '$lt': end}}
+    sort = [('date', pymongo.ASCENDING)]
+
+    if resolution is None:
+        projection = {field: 1 for field in fields}
+        projection.update({'date': 1, '_id': 0})
+        return 'raw', list(db[collection].find(query, projection=projection, sort=sort))
+
+    suffix, seconds = resolution
+    projection = {'date': 1, 'n': 1, '_id': 0}
+    for field in fields:
+        for stat in ['min', 'mean', 'max']:
+            projection[f'{field}_{stat}'] = 1
+    documents = list(db[f'{collection}_{suffix}'].find(query, projection=projection, sort=sort))
+    for document in documents:
+        for field in fields:
+            document[field] = document.get(f'{field}_mean', None)
+    return suffix, documents
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def main():
+    parser = ArgumentParser(description="Update the downsampled telemetry collections")
+    ## add flags
+    parser.add_argument("--loop",
+        action="store_true", dest="loop",
+        default=False, help="Keep updating the rollups.")
+    ## add arguments
+    parser.add_argument("--interval",
+        dest="interval", required=False, type=float, default=60,
+        help="Seconds between updates when looping (default = 60).")
+    parser.add_argument("-c", "--collection",
+        dest="collections", required=False, action='append',
+        choices=list(rollup_fields.keys()), default=None,
+        help="Raw collection to roll up (may be repeated, default is all).")
+    args = parser.parse_args()
+
+    db = get_db(check=True)
+    ensure_indexes(db)
+    while True:
+        start = time.monotonic()
+        for name, since in update_rollups(db, collections=args.collections):
+            print(f'{name} updated from {since}')
+        if not args.loop:
+            break
+        time.sleep(max(args.interval - (time.monotonic() - start), 0))
+
+
+if __name__ == '__main__':
+    main()
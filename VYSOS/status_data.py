@@ -0,0 +1,203 @@
+'''
+The inputs to the status pages (the tornado Status page and the dash status
+app), cached so that frequent page reloads are cheap.
+
+  - sun and moon ephemeris: 60 seconds
+  - disk use: 60 seconds
+  - latest weather and telescope status documents: 5 seconds, or kept up
+    to date from a change stream if start_watcher has been called
+  - image and flat lists: until the directory mtime changes
+'''
+
+import os
+import re
+import time
+import logging
+import threading
+from datetime import datetime as dt
+import pymongo
+
+from astropy import units as u
+
+from VYSOS import ephemeris
+from VYSOS.db import get_db, get_collection
+from VYSOS.cache import TTLCache, GlobCache
+
+
+ephemeris_ttl = 60
+disks_ttl = 60
+telemetry_ttl = 5
+
+disk_paths = {'Drobo': os.path.join('/', 'Volumes', 'DataCopy'),
+              'macOS': os.path.expanduser('~'),
+              'DroboPro': os.path.join('/', 'Volumes', 'MLOData'),
+             }
+
+telemetry_collections = ['weather', 'V20status', 'V5status']
+
+cache = TTLCache()
+directories = GlobCache()
+
+## Latest document for each telemetry collection, kept up to date by the
+## change stream watcher
+latest_values = {}
+watching = threading.Event()
+watcher = None
+watcher_lock = threading.Lock()
+
+log = logging.getLogger('VYSOS.status_data')
+
+
+##-------------------------------------------------------------------------
+## Check Free Space on Drive
+##-------------------------------------------------------------------------
+def free_space(path):
+    statvfs = os.statvfs(path)
+    size = statvfs.f_frsize * statvfs.f_blocks * u.byte
+    avail = statvfs.f_frsize * statvfs.f_bfree * u.byte
+
+    if re.search('\/Volumes\/DataCopy', path):
+        print('Correcting for 4.97 TB disk capacity')
+        capacity = (4.97*u.TB).to(u.byte)
+        correction = size - capacity
+        size -= correction
+        avail -= correction
+    elif re.search('\/Volumes\/MLOData', path):
+        print('Correcting for 16 TB disk capacity')
+        capacity = (16.89*u.TB).to(u.byte)
+        correction = size - capacity
+        size -= correction
+        avail -= correction
+        if capacity > 16*u.TB:
+            correction2 = (capacity - 16*u.TB).to(u.byte)
+            size -= correction2
+    used = (size - avail)/size
+
+    return (size.to(u.GB).value, avail.to(u.GB).value, used.to(u.percent).value)
+
+
+def get_disks():
+    '''Return a dict of [size_GB, avail_GB, pcnt_used] for each disk which is
+    mounted.
+    '''
+    def compute():
+        disks = {}
+        for disk, path in disk_paths.items():
+            if os.path.exists(path):
+                disks[disk] = list(free_space(path))
+        return disks
+    return {k: list(v) for k, v in cache.get('disks', compute, disks_ttl).items()}
+
+
+##-------------------------------------------------------------------------
+## Sun and Moon
+##-------------------------------------------------------------------------
+def get_astronomy():
+    '''Return the sun and moon dicts from ephemeris.sun_moon_now.
+    '''
+    sun, moon = cache.get('astronomy', lambda: ephemeris.sun_moon_now(dt.utcnow()),
+                          ephemeris_ttl)
+    return dict(sun), dict(moon)
+
+
+def sun_event_strings(sun):
+    '''Return the descriptions of the next sunrise and sunset in the order
+    they occur.  sun['rise'] or sun['set'] is None if the event is not in the
+    next three days (see ephemeris.next_event).
+    '''
+    events = []
+    for name in ['rise', 'set']:
+        if sun[name] is None:
+            events.append((dt.max, f'No sun{name} in the next 3 days'))
+        else:
+            events.append((sun[name], 'Next sun{} is at {}'.format(name,
+                           sun[name].strftime('%Y/%m/%d %H:%M:%S UT'))))
+    events.sort(key=lambda x: x[0])
+    return [text for when, text in events]
+
+
+##-------------------------------------------------------------------------
+## Latest Telemetry
+##-------------------------------------------------------------------------
+def find_latest(collection_name):
+    '''Query for the most recent document in the collection.  This is an
+    indexed find().sort(date, -1).limit(1).
+    '''
+    collection = get_collection(collection_name)
+    return collection.find_one({}, sort=[('date', pymongo.DESCENDING)])
+
+
+def get_latest(collection_name):
+    '''Return a copy of the most recent document in the collection (e.g.
+    weather, V20status) or None if it is empty.  If the change stream watcher
+    is running (see start_watcher) the value comes from memory, otherwise
+    the query result is cached for telemetry_ttl seconds.
+    '''
+    if watching.is_set() and collection_name in latest_values:
+        latest = latest_values[collection_name]
+    else:
+        latest = cache.get(collection_name, lambda: find_latest(collection_name),
+                           telemetry_ttl)
+    return dict(latest) if latest is not None else None
+
+
+##-------------------------------------------------------------------------
+## Change Stream Watcher
+##-------------------------------------------------------------------------
+def watch_latest(collection_names, retry_interval=60):
+    '''Keep latest_values up to date from a change stream on the database.
+    Change streams need a replica set, if they are not available (or the
+    connection is lost) get_latest falls back to querying until the stream
+    can be reopened.
+    '''
+    pipeline = [{'$match': {'operationType': 'insert',
+                            'ns.coll': {'$in': list(collection_names)}}}]
+    while True:
+        try:
+            with get_db().watch(pipeline) as stream:
+                ## Read the current values after opening the stream so that
+                ## no insert is missed between the two.
+                for name in collection_names:
+                    latest_values[name] = find_latest(name)
+                watching.set()
+                log.info(f'Watching {collection_names} for new documents')
+                for change in stream:
+                    name = change['ns']['coll']
+                    document = change['fullDocument']
+                    current = latest_values.get(name, None)
+                    if current is None or\
+                       document.get('date', dt.min) >= current.get('date', dt.min):
+                        latest_values[name] = document
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f'Change stream unavailable ({e}), querying for latest values')
+        watching.clear()
+        latest_values.clear()
+        time.sleep(retry_interval)
+
+
+def start_watcher(collection_names=telemetry_collections):
+    '''Start the change stream watcher in a daemon thread (once per process).
+    '''
+    global watcher
+    with watcher_lock:
+        if watcher is None or not watcher.is_alive():
+            watcher = threading.Thread(target=watch_latest, args=(collection_names,),
+                                       name='latest_values', daemon=True)
+            watcher.start()
+    return watcher
+
+
+##-------------------------------------------------------------------------
+## Check for Images and Flats
+##-------------------------------------------------------------------------
+def image_path(telescope, date):
+    return os.path.join('/', 'Users', 'vysosuser', f'{telescope}Data', 'Images', f'{date}')
+
+
+def get_image_list(telescope, date):
+    return directories.glob(image_path(telescope, date), f'{telescope}*fts')
+
+
+def get_flat_list(telescope, date):
+    return directories.glob(os.path.join(image_path(telescope, date), 'AutoFlat'),
+                            'AutoFlat*fts')
@@ -0,0 +1,176 @@
+'''
+Buffered writer for telemetry documents (weather and telescope status).
+
+Documents are added to an in memory buffer and written to mongo with
+insert_many (or upserts keyed on a field such as date, so that repeated
+samples are stored once) by a background thread when the buffer reaches
+batch_size documents or every flush_interval seconds, so data acquisition
+never waits on the database.  If mongo can not be reached the documents are appended to
+a local spool file (one JSON document per line, using bson.json_util so
+dates and ids round trip) and the spool is replayed in bulk once the
+database is back.
+
+The spool directory is given by the VYSOS_SPOOL environment variable and
+defaults to ~/.vysos_spool.
+'''
+
+import os
+import atexit
+import logging
+import threading
+import pymongo
+from pymongo import UpdateOne
+from bson import json_util
+
+from VYSOS.db import get_collection
+
+
+default_spool_path = os.environ.get('VYSOS_SPOOL',
+                                    os.path.join(os.path.expanduser('~'), '.vysos_spool'))
+
+_writers = {}
+_lock = threading.Lock()
+
+
+##-------------------------------------------------------------------------
+## Telemetry Writer
+##-------------------------------------------------------------------------
+class TelemetryWriter(object):
+    def __init__(self, collection_name, batch_size=10, flush_interval=10,
+                 spool_path=None, replay_chunk=1000, upsert_key=None, logger=None):
+        self.collection_name = collection_name
+        self.upsert_key = upsert_key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.replay_chunk = replay_chunk
+        if spool_path is None:
+            spool_path = default_spool_path
+        self.spool_file = os.path.join(spool_path, f'{collection_name}.jsonl')
+        if logger is None:
+            logger = logging.getLogger('VYSOS.telemetry')
+        self.logger = logger
+
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name=f'{collection_name}_writer')
+        self.thread.start()
+
+    def write(self, document, flush=False):
+        '''Add a document to the buffer.  This never blocks on the database.
+        If flush is True the background thread writes the buffer right away
+        instead of waiting for a full batch or the flush interval.
+        '''
+        with self.lock:
+            self.buffer.append(document)
+            full = len(self.buffer) >= self.batch_size
+        if full or flush:
+            self.wake.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        '''Stop the background thread and write (or spool) anything left in
+        the buffer.
+        '''
+        self.stopping.set()
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+
+    ##---------------------------------------------------------------------
+    ## Write to Mongo or Spool
+    ##---------------------------------------------------------------------
+    def flush(self):
+        with self.lock:
+            documents = self.buffer
+            self.buffer = []
+        if os.path.exists(self.spool_file) and not self.replay():
+            ## Mongo is still unavailable, don't wait on it again
+            self.spool(documents)
+            return
+        if len(documents) == 0:
+            return
+        failed = self.insert(documents)
+        if len(failed) > 0:
+            self.spool(failed)
+
+    def insert(self, documents):
+        '''Insert the documents and return the list of those which could not
+        be written.  Documents which are already in the collection (e.g.
+        from a partially successful earlier attempt) count as written.  If
+        upsert_key is set, documents are only inserted if there is not
+        already a document with the same value of that key.
+        '''
+        collection = get_collection(self.collection_name)
+        try:
+            if self.upsert_key is None:
+                collection.insert_many(documents, ordered=False)
+            else:
+                key = self.upsert_key
+                collection.bulk_write([UpdateOne({key: doc[key]}, {'$setOnInsert': doc},
+                                                 upsert=True)
+                                       for doc in documents], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            failed = [documents[err['index']] for err in e.details['writeErrors']
+                      if err['code'] != 11000]
+            self.logger.warning(f'Failed to write {len(failed)} of {len(documents)} '
+                                f'documents to {self.collection_name}')
+            return failed
+        except pymongo.errors.PyMongoError as e:
+            self.logger.warning(f'Failed to write {len(documents)} documents to '
+                                f'{self.collection_name}: {e}')
+            return documents
+        self.logger.debug(f'  Wrote {len(documents)} documents to {self.collection_name}')
+        return []
+
+    def spool(self, documents):
+        if len(documents) == 0:
+            return
+        os.makedirs(os.path.dirname(self.spool_file), exist_ok=True)
+        with open(self.spool_file, 'a') as spool:
+            for document in documents:
+                spool.write(json_util.dumps(document) + '\n')
+        self.logger.info(f'  Spooled {len(documents)} documents to {self.spool_file}')
+
+    def replay(self):
+        '''Insert the spooled documents in chunks.  Return True if the spool
+        was emptied.
+        '''
+        with open(self.spool_file, 'r') as spool:
+            documents = [json_util.loads(line) for line in spool if line.strip() != '']
+        self.logger.info(f'Replaying {len(documents)} spooled documents to {self.collection_name}')
+        for i in range(0, len(documents), self.replay_chunk):
+            failed = self.insert(documents[i:i+self.replay_chunk])
+            if len(failed) > 0:
+                remaining = failed + documents[i+self.replay_chunk:]
+                tmp_file = self.spool_file + '.tmp'
+                with open(tmp_file, 'w') as spool:
+                    for document in remaining:
+                        spool.write(json_util.dumps(document) + '\n')
+                os.replace(tmp_file, self.spool_file)
+                return False
+        os.remove(self.spool_file)
+        return True
+
+
+##-------------------------------------------------------------------------
+## Get Writer
+##-------------------------------------------------------------------------
+def get_writer(collection_name, logger=None, **kwargs):
+    '''Return the process-wide writer for the collection.  Writers are
+    closed (flushing their buffers) when the process exits.
+    '''
+    with _lock:
+        writer = _writers.get(collection_name, None)
+        if writer is None:
+            writer = TelemetryWriter(collection_name, logger=logger, **kwargs)
+            _writers[collection_name] = writer
+            atexit.register(writer.close)
+    return writer
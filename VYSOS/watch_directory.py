@@ -13,15 +13,199 @@ from argparse import ArgumentParser
 import re
 import time
 from datetime import datetime as dt
-import pymongo
-from pymongo import MongoClient
+import threading
+import queue
 import logging
 
 from astropy import units as u
 
 from VYSOS import Telescope
+from VYSOS.db import get_collection
 from measure_image import measure_image
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+MatchFilename = re.compile("(.*)\-([0-9]{8})at([0-9]{6})\.fts")
+MatchEmpty = re.compile(".*\-Empty\-.*\.fts")
+
+
+##-------------------------------------------------------------------------
+## Directory Watcher
+##-------------------------------------------------------------------------
+class DirectoryWatcher(object):
+    '''Watch tonight's image directory for a telescope and put the full path
+    of each new, completely written image on to the analysis queue.
+
+    Uses inotify (via the inotify_simple module) when it is available and
+    falls back to polling the directory otherwise.  In either case a file is
+    only handed on once its size has stopped changing.  The watcher moves on
+    to the next UT date directory automatically.
+    '''
+    def __init__(self, telescope, analysis_queue, images, logger,
+                 poll_interval=0.5, settle_time=0.25, use_inotify=True):
+        self.telescope = telescope
+        self.queue = analysis_queue
+        self.images = images
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.use_inotify = use_inotify and (inotify_simple is not None)
+        self.queued = set()
+        self.analyzed = set()
+        self.sizes = {}
+        self.pending = set()
+
+    def data_path(self, date_string):
+        return os.path.join(os.path.expanduser("~"), f"{self.telescope}Data",
+                            "Images", date_string)
+
+    def is_candidate(self, file):
+        IsMatch = MatchFilename.match(file)
+        IsEmpty = MatchEmpty.match(file)
+        return (IsMatch is not None) and (IsEmpty is None)
+
+    def find_unanalyzed(self, files):
+        '''Return the subset of files which do not have an entry in the images
+        collection.  Filenames already known to be analyzed are remembered
+        between calls so that each call costs at most one query.
+        '''
+        files = [f for f in files if f not in self.analyzed]
+        if len(files) == 0:
+            return []
+        query = {"filename": {"$in": files}}
+        for entry in self.images.find(query, projection={"filename": 1, "_id": 0}):
+            self.analyzed.add(entry['filename'])
+        return [f for f in files if f not in self.analyzed]
+
+    def is_stable(self, fullpath):
+        '''Return True if the file size is non-zero and has not changed over
+        settle_time seconds.
+        '''
+        try:
+            size = os.path.getsize(fullpath)
+            time.sleep(self.settle_time)
+            return (size > 0) and (size == os.path.getsize(fullpath))
+        except OSError:
+            return False
+
+    def enqueue(self, path, file):
+        if file in self.queued:
+            return
+        self.queued.add(file)
+        self.logger.info('  Queueing {}'.format(file))
+        self.queue.put(os.path.join(path, file))
+
+    def check_files(self, path, files):
+        '''Queue those of the files (plus any left pending from the last call)
+        which are complete and have not been analyzed.  Files which are still
+        being written are kept pending and checked again on the next call, as
+        no further inotify event may arrive for them.
+        '''
+        candidates = sorted(self.pending.union(files))
+        self.pending = set()
+        complete = []
+        for file in candidates:
+            if not self.is_candidate(file) or file in self.queued:
+                continue
+            fullpath = os.path.join(path, file)
+            if self.is_stable(fullpath):
+                complete.append(file)
+            elif os.path.exists(fullpath):
+                self.pending.add(file)
+        for file in self.find_unanalyzed(complete):
+            self.enqueue(path, file)
+
+    def scan(self, path):
+        '''Examine every file in the directory and queue any which have not
+        been analyzed.  Used on startup, on rollover, and when polling.
+        '''
+        if not os.path.exists(path):
+            return
+        files = sorted([f for f in os.listdir(path)
+                        if self.is_candidate(f) and f not in self.queued])
+        self.logger.debug('  Found {} new files in {}'.format(len(files), path))
+        complete = []
+        for file in files:
+            fullpath = os.path.join(path, file)
+            try:
+                size = os.path.getsize(fullpath)
+            except OSError:
+                continue
+            ## When polling, a file is complete once its size is unchanged
+            ## between two successive scans.
+            if size == 0 or self.sizes.get(file, None) != size:
+                self.sizes[file] = size
+                continue
+            self.sizes.pop(file, None)
+            complete.append(file)
+        for file in self.find_unanalyzed(complete):
+            self.enqueue(path, file)
+        self.queued.update(complete)
+
+    def run_polling(self):
+        date_string = None
+        while True:
+            now = dt.utcnow()
+            if now.strftime("%Y%m%dUT") != date_string:
+                date_string = now.strftime("%Y%m%dUT")
+                path = self.data_path(date_string)
+                self.logger.info('Watching directory {} (polling)'.format(path))
+                self.sizes = {}
+            self.scan(path)
+            time.sleep(self.poll_interval)
+
+    def run_inotify(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO
+        inotify = inotify_simple.INotify()
+        date_string = None
+        wd = None
+        while True:
+            now = dt.utcnow()
+            if now.strftime("%Y%m%dUT") != date_string or wd is None:
+                if now.strftime("%Y%m%dUT") != date_string and wd is not None:
+                    inotify.rm_watch(wd)
+                    wd = None
+                date_string = now.strftime("%Y%m%dUT")
+                path = self.data_path(date_string)
+                if not os.path.exists(path):
+                    time.sleep(self.poll_interval)
+                    continue
+                self.logger.info('Watching directory {} (inotify)'.format(path))
+                wd = inotify.add_watch(path, mask)
+                self.pending = set()
+                ## Pick up anything written before the watch was added
+                files = [f for f in os.listdir(path)
+                         if self.is_candidate(f) and f not in self.queued]
+                self.check_files(path, self.find_unanalyzed(files))
+            events = inotify.read(timeout=int(self.poll_interval*1000))
+            self.check_files(path, [event.name for event in events])
+
+    def run(self):
+        if self.use_inotify:
+            self.run_inotify()
+        else:
+            self.run_polling()
+
+
+##-------------------------------------------------------------------------
+## Analysis Worker
+##-------------------------------------------------------------------------
+def analyze_queue(analysis_queue, logger):
+    while True:
+        file = analysis_queue.get()
+        logger.info('Analyzing {}'.format(os.path.basename(file)))
+        try:
+            measure_image(file, nographics=True)
+        except:
+            logger.warning('  MeasureImage failed on {}.'.format(file))
+            logger.error(sys.exc_info())
+        analysis_queue.task_done()
+
 
 def main():
     ##-------------------------------------------------------------------------
@@ -33,6 +217,9 @@ def main():
     parser.add_argument("-v", "--verbose",
         action="store_true", dest="verbose",
         default=False, help="Be verbose! (default = False)")
+    parser.add_argument("--poll",
+        action="store_true", dest="poll",
+        default=False, help="Poll the directory instead of using inotify. (default = False)")
     ## add arguments
     parser.add_argument("-t", "--telescope",
         dest="telescope", required=True, type=str,
@@ -67,50 +254,21 @@ def main():
     ## Telescope Configuration
     ##-------------------------------------------------------------------------
     tel = Telescope(telescope)
-    client = MongoClient(tel.mongo_address, tel.mongo_port)
-    db = client[tel.mongo_db]
-    images = db[tel.mongo_collection]
+    images = get_collection(tel.mongo_collection, tel=tel)
 
     ##-------------------------------------------------------------------------
     ## Operation Loop
     ##-------------------------------------------------------------------------
-    Operate = True
-    MatchFilename = re.compile("(.*)\-([0-9]{8})at([0-9]{6})\.fts")
-    MatchEmpty = re.compile(".*\-Empty\-.*\.fts")
-    while Operate:
-        ## Set date to tonight
-        now = dt.utcnow()
-        date_string = now.strftime("%Y%m%dUT")
-        DataPath = os.path.join(os.path.expanduser("~"), f"{args.telescope}Data", "Images", date_string)
-        
-        logger.info('Examining directory {}'.format(DataPath))
-        ## Look for files
-        if os.path.exists(DataPath):
-            files = os.listdir(DataPath)
-        else:
-            files = []
-        logger.info('  Found {} files'.format(len(files)))
-        time.sleep(1)
-        images_to_analyze = {}
-        for file in files:
-            IsMatch = MatchFilename.match(file)
-            IsEmpty = MatchEmpty.match(file)
-            if IsMatch and not IsEmpty:
-                analyzed = [x for x in images.find( {"filename" : file} )]
-                if (len(analyzed) == 0):
-                    target = IsMatch.group(1)
-                    filetime = IsMatch.group(3)
-                    images_to_analyze[filetime] = file
-        logger.debug('  Found {} files to analyze'.format(len(images_to_analyze)))
-        for filetime in sorted(images_to_analyze.keys()):
-            file = images_to_analyze[filetime]
-            try:
-                measure_image(os.path.join(DataPath, file), nographics=True)
-            except:
-                logger.warning('  MeasureImage failed on {}.'.format(file))
-                logger.error(sys.exc_info())
+    analysis_queue = queue.Queue(maxsize=100)
+    worker = threading.Thread(target=analyze_queue,
+                              args=(analysis_queue, logger), daemon=True)
+    worker.start()
 
-        time.sleep(30)
+    if not args.poll and inotify_simple is None:
+        logger.warning('inotify_simple not available, polling directory instead')
+    watcher = DirectoryWatcher(telescope, analysis_queue, images, logger,
+                               use_inotify=not args.poll)
+    watcher.run()
 
 
 if __name__ == "__main__":
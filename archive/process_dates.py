@@ -8,7 +8,6 @@ from datetime import datetime as dt
 from datetime import timedelta as tdelta
 from argparse import ArgumentParser
 import subprocess
-import ephem
 import pymongo
 from pymongo import MongoClient
 
@@ -16,6 +15,7 @@ import measure_image
 import make_nightly_plots
 
 import IQMon
+from VYSOS import ephemeris
 
 def main(startdate, enddate, logger, nice=False, skip=False):
     if startdate > enddate:
@@ -23,21 +23,6 @@ def main(startdate, enddate, logger, nice=False, skip=False):
     else:
         oneday = tdelta(1, 0)
 
-    ##------------------------------------------------------------------------
-    ## Use pyephem determine sunrise and sunset times
-    ##------------------------------------------------------------------------
-    now = dt.utcnow()
-    if nice:
-        Observatory = ephem.Observer()
-        Observatory.lon = "-155:34:33.9"
-        Observatory.lat = "+19:32:09.66"
-        Observatory.elevation = 3400.0
-        Observatory.temp = 10.0
-        Observatory.pressure = 680.0
-        Observatory.horizon = '0.0'
-        Observatory.date = now.strftime('%Y/%m/%d %H:%M:%S')
-        TheSun = ephem.Sun()
-
     MatchFilename = re.compile("(.*)\-([0-9]{8})at([0-9]{6})\.fts")
     MatchEmpty = re.compile(".*\-Empty\-.*\.fts")
 
@@ -122,20 +107,20 @@ def main(startdate, enddate, logger, nice=False, skip=False):
             image = entry[0]
             if nice:
                 now = dt.utcnow()
-                Observatory.date = now.strftime('%Y/%m/%d %H:%M:%S')
-                TheSun.compute(Observatory)
-                if TheSun.alt < 0:
-                    print('The Sun is down (alt = {:.1f})'.format(TheSun.alt*180./ephem.pi))
-                    sunrise = Observatory.next_rising(TheSun).datetime()
-                    until_sunrise = (sunrise - now).total_seconds()/60./60.
+                sun, moon = ephemeris.sun_moon_now(now)
+                if sun['alt'] < 0:
+                    print('The Sun is down (alt = {:.1f})'.format(sun['alt']))
+                    if sun['rise'] is not None:
+                        until_sunrise = (sun['rise'] - now).total_seconds()/60./60.
+                    else:
+                        until_sunrise = 1.
                     logger.info('Sleeping {:.1f} hours until sunrise'.format(until_sunrise))
                     time.sleep(until_sunrise + 300)
                     now = dt.utcnow()
-                    Observatory.date = now.strftime('%Y/%m/%d %H:%M:%S')
-                    sunset  = Observatory.next_setting(ephem.Sun()).datetime()
-                    sunrise = Observatory.next_rising(ephem.Sun()).datetime()
+                    sunset = ephemeris.next_event('sunset', now)
                     logger.info('Resuming processing ...')
-                    logger.info('  Next sunset at {}'.format(sunset.strftime('%Y/%m/%d %H:%M:%S')))
+                    if sunset is not None:
+                        logger.info('  Next sunset at {}'.format(sunset.strftime('%Y/%m/%d %H:%M:%S')))
             if MatchFilename.match(image) and not MatchEmpty.match(image):
                 try:
                     measure_image.MeasureImage(image,\
@@ -1,5 +1,4 @@
 import sys
-import os
 from argparse import ArgumentParser
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
@@ -11,43 +10,99 @@ import pymongo
 from astropy.modeling import models, fitting
 from astropy.table import Table
 
-
-
-def correlate_temps():
-
-    if not os.path.exists('tempcompdata.txt'):
-        client = pymongo.MongoClient('192.168.1.101', 27017)
-        db = client['vysos']
-        images = db['V5.images']
-        status = db['V5.status']
-
-        results = images.find( {'FWHM pix': {'$lt': 2.0}} )
-
-        tab = Table(names=('time', 'focuspos', 'tubetemp', 'ambtemp'),
-                    dtype=('a25', 'i4', 'f4', 'f4'))
-        for i,result in enumerate(results):
-            when = result['exposure start']
-            exptime = result['exposure time']
-            telemetry = status.find( {'UT timestamp': {'$gte': when,
-                                                       '$lte': when+tdelta(0,exptime)} } )
-            if i in np.arange(0,results.count(),100):
-                print('{:4d} {} {:d}'.format(i, when.isoformat(), telemetry.count()))
-            try:
-                assert 'FocusMax temperature (tube)' in telemetry[0].keys()
-                assert 'boltwood ambient temp' in telemetry[0].keys()
-                assert 'FocusMax focuser position' in telemetry[0].keys()
-                row = {'time': when.isoformat(),
-                       'focuspos': int(telemetry[0]['FocusMax focuser position']),
-                       'tubetemp': float(telemetry[0]['FocusMax temperature (tube)']),
-                       'ambtemp': float(telemetry[0]['boltwood ambient temp'])}
-                tab.add_row(row)
-            except:
-                print('Failed on data at {}'.format(when.isoformat()))
-        tab.write('tempcompdata.txt', format='ascii.csv')
+from VYSOS import asof, export
+from VYSOS.db import get_collection
+
+
+
+def read_export(collection_name, columns, start=None, end=None, telescope=None):
+    '''Return (data, until) from the Parquet export (see VYSOS.export), where
+    until is the date up to which the export is complete.  data is empty if
+    there is no usable export.
+    '''
+    until = export.exported_until(collection_name)
+    if until is None or (start is not None and until <= start):
+        return {}, None
+    try:
+        data = export.read(collection_name, columns=columns, start=start,
+                           end=until if end is None else min(end, until),
+                           telescope=telescope)
+    except Exception as e:
+        ## No pyarrow, or a broken or partial export: use mongo instead
+        print(f'Could not read {collection_name} export ({e}), using mongo')
+        return {}, None
+    if not all([column in data.keys() for column in columns]):
+        return {}, None
+    return data, until
+
+
+def load_images(telescope='V5'):
+    '''Return the date and exposure time of the well focused images, from
+    the Parquet export if there is one and from mongo for any images newer
+    than the export.
+    '''
+    data, until = read_export('images', ['date', 'exptime', 'FWHM_pix'],
+                              telescope=telescope)
+    if len(data) > 0:
+        dates = np.asarray(data['date'], dtype='datetime64[us]')
+        exptimes = np.nan_to_num(np.asarray(data['exptime'], dtype=float))
+        good = (np.nan_to_num(np.asarray(data['FWHM_pix'], dtype=float), nan=np.inf) < 2.0)\
+               & ~np.isnat(dates)
+        dates, exptimes = list(dates[good].tolist()), list(exptimes[good])
+        query = {'telescope': telescope, 'FWHM_pix': {'$lt': 2.0}, 'date': {'$gte': until}}
     else:
-        tab = Table.read('tempcompdata.txt', format='ascii.csv')
-
-    time = [ dt.strptime(t, '%Y-%m-%dT%H:%M:%S') for t in tab['time'] ]
+        dates, exptimes = [], []
+        query = {'telescope': telescope, 'FWHM_pix': {'$lt': 2.0}}
+    for image in get_collection('images').find(query,
+                                               projection={'date': 1, 'exptime': 1, '_id': 0},
+                                               sort=[('date', pymongo.ASCENDING)]):
+        if isinstance(image.get('date', None), dt):
+            dates.append(image['date'])
+            exptimes.append(image.get('exptime', 0) or 0)
+    return dates, np.array(exptimes, dtype=float)
+
+
+def load_series(collection_name, start, end, fields):
+    '''Return (times, columns) for a telemetry collection.  The part of the
+    range covered by the Parquet export is read from it and the rest (e.g.
+    data newer than the last export) from mongo.
+    '''
+    data, until = read_export(collection_name, ['date']+fields, start=start, end=end)
+    if len(data) == 0:
+        return asof.load_telemetry(collection_name, start, end, fields)
+    times = asof.to_seconds(data['date'])
+    columns = {f: np.asarray(data[f], dtype=float) for f in fields}
+    if until < end:
+        tail_times, tail_columns = asof.load_telemetry(collection_name, until, end, fields)
+        times = np.concatenate([times, tail_times])
+        columns = {f: np.concatenate([columns[f], tail_columns[f]]) for f in fields}
+    return times, columns
+
+
+def correlate_temps(telescope='V5'):
+    dates, exptimes = load_images(telescope=telescope)
+    if len(dates) == 0:
+        print(f'No {telescope} images with FWHM < 2 pix found')
+        return
+    starts = asof.to_seconds(dates)
+    ends = starts + exptimes
+    start = min(dates)
+    end = max(dates) + tdelta(0, float(np.max(exptimes)) + 60)
+
+    times, columns = load_series(f'{telescope}status', start, end,
+                                 ['focuser_position', 'focuser_temperature'])
+    status = asof.asof_join(starts, ends, times, columns, how='mean', tolerance=60)
+    times, columns = load_series('weather', start, end, ['temp'])
+    weather = asof.asof_join(starts, ends, times, columns, how='mean', tolerance=60)
+
+    good = np.isfinite(status['focuser_position'])\
+           & np.isfinite(status['focuser_temperature'])\
+           & np.isfinite(weather['temp'])
+    print(f'Matched telemetry for {np.sum(good)} of {len(good)} images')
+    tab = Table({'focuspos': status['focuser_position'][good],
+                 'tubetemp': status['focuser_temperature'][good],
+                 'ambtemp': weather['temp'][good]})
+    time = [t for t, ok in zip(dates, good) if ok]
 
 
     # -------------------------------------------------------------------------
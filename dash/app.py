@@ -10,7 +10,7 @@ from pymongo import MongoClient
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-import ephem
+from VYSOS import ephemeris
 
 
 #------------------------------------------------------------------------------
@@ -26,47 +26,7 @@ def get_temperature_data(weather):
 # Get Astronomical Info
 #------------------------------------------------------------------------------
 def update_astronomical_info():
-    nowut = dt.utcnow()
-    Observatory = ephem.Observer()
-    Observatory.lon = "-155:34:33.9"
-    Observatory.lat = "+19:32:09.66"
-    Observatory.elevation = 3400.0
-    Observatory.temp = 10.0
-    Observatory.pressure = 680.0
-    Observatory.horizon = '0.0'
-    Observatory.date = nowut
-
-    TheSun = ephem.Sun()
-    TheSun.compute(Observatory)
-    sun = {}
-    sun['alt'] = float(TheSun.alt) * 180. / ephem.pi
-    sun['set'] = Observatory.next_setting(TheSun).datetime()
-    sun['rise'] = Observatory.next_rising(TheSun).datetime()
-    if sun['alt'] <= -18:
-        sun['now'] = 'night'
-    elif sun['alt'] > -18 and sun['alt'] <= -12:
-        sun['now'] = 'astronomical twilight'
-    elif sun['alt'] > -12 and sun['alt'] <= -6:
-        sun['now'] = 'nautical twilight'
-    elif sun['alt'] > -6 and sun['alt'] <= 0:
-        sun['now'] = 'civil twilight'
-    elif sun['alt'] > 0:
-        sun['now'] = 'day'
-
-    TheMoon = ephem.Moon()
-    Observatory.date = nowut
-    TheMoon.compute(Observatory)
-    moon = {}
-    moon['phase'] = TheMoon.phase
-    moon['alt'] = TheMoon.alt * 180. / ephem.pi
-    moon['set'] = Observatory.next_setting(TheMoon).datetime()
-    moon['rise'] = Observatory.next_rising(TheMoon).datetime()
-    if moon['alt'] > 0:
-        moon['now'] = 'up'
-    else:
-        moon['now'] = 'down'
-
-    return sun, moon
+    return ephemeris.sun_moon_now(dt.utcnow())
 
 
 
@@ -1,21 +1,23 @@
-import os
-import re
 import dash
 from dash.dependencies import Input, Output, Event
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly
-import pymongo
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
 
 from astropy import units as u
-import ephem
+from astropy.coordinates import SkyCoord
 from VYSOS import weather_limits, styles
+from VYSOS.status_data import get_astronomy, get_disks, get_latest, start_watcher,\
+                               sun_event_strings
 
 ##-------------------------------------------------------------------------
 ## Define App
 ##-------------------------------------------------------------------------
+## The live push of status updates over a WebSocket is only on the tornado
+## status page (webpage/custom_handlers.py).  This app still polls, but each
+## poll reads the cached status inputs in VYSOS.status_data.
 app = dash.Dash(__name__)
 app.layout = html.Div(
     html.Div([
@@ -28,46 +30,6 @@ app.layout = html.Div(
 )
 
 
-##-------------------------------------------------------------------------
-## Check Free Space on Drive
-##-------------------------------------------------------------------------
-def free_space(path):
-    statvfs = os.statvfs(path)
-    size = statvfs.f_frsize * statvfs.f_blocks * u.byte
-    avail = statvfs.f_frsize * statvfs.f_bfree * u.byte
-
-    if re.search('\/Volumes\/DataCopy', path):
-        print('Correcting for 4.97 TB disk capacity')
-        capacity = (4.97*u.TB).to(u.byte)
-        correction = size - capacity
-        size -= correction
-        avail -= correction
-    elif re.search('\/Volumes\/MLOData', path):
-        print('Correcting for 16 TB disk capacity')
-        capacity = (16.89*u.TB).to(u.byte)
-        correction = size - capacity
-        size -= correction
-        avail -= correction
-        if capacity > 16*u.TB:
-            correction2 = (capacity - 16*u.TB).to(u.byte)
-            size -= correction2
-    used = (size - avail)/size
-
-    return (size.to(u.GB).value, avail.to(u.GB).value, used.to(u.percent).value)
-
-
-##-------------------------------------------------------------------------
-## Get Weather Data
-##-------------------------------------------------------------------------
-def retrieve_weather(lookbackdays=0):
-    delta_time = tdelta(lookbackdays, 120)
-    client = pymongo.MongoClient('192.168.1.101', 27017)
-    db = client.vysos
-    weather = db.weather
-    weatherdata = [x for x in weather.find( {"date": {"$gt": dt.utcnow()-delta_time} } )]
-    client.close()
-    return weatherdata
-
 ##-------------------------------------------------------------------------
 ## Determine Conditions from Weather Data
 ##-------------------------------------------------------------------------
@@ -138,14 +100,11 @@ def get_conditions(weatherdata):
 ## Get Telescope Status Data
 ##-------------------------------------------------------------------------
 def retrieve_telstatus(telescope):
-    client = pymongo.MongoClient('192.168.1.101', 27017)
-    db = client.vysos
-
     telstatus = {}
     for telescope in ['V20', 'V5']:
-        results = db[f'{telescope}status'].find(limit=1, sort=[('date', pymongo.DESCENDING)])
-        if results.count() > 0:
-            telstatus[telescope] = results.next()
+        latest = get_latest(f'{telescope}status')
+        if latest is not None:
+            telstatus[telescope] = latest
             try:
                 if telstatus[telescope]['slewing'] is True:
                     telstatus[telescope]['status'] = 'Slewing'
@@ -184,56 +143,15 @@ def retrieve_telstatus(telescope):
         else:
             telstatus[telescope]['Decstr'] = '{}'.format(telstatus['V20']['Dec'])
         telstatus[telescope]['age'] = (dt.utcnow() - telstatus[telescope]['date']).total_seconds()/60.
-    client.close()
 
     return telstatus
 
 
 ##------------------------------------------------------------------------
-## Use pyephem determine sunrise and sunset times
+## Look up sunrise and sunset times
 ##------------------------------------------------------------------------
 def update_astronomy():
-    nowut = dt.utcnow()
-    Observatory = ephem.Observer()
-    Observatory.lon = "-155:34:33.9"
-    Observatory.lat = "+19:32:09.66"
-    Observatory.elevation = 3400.0
-    Observatory.temp = 10.0
-    Observatory.pressure = 680.0
-    Observatory.horizon = '0.0'
-
-    Observatory.date = nowut
-    TheSun = ephem.Sun()
-    TheSun.compute(Observatory)
-    sun = {}
-    sun['alt'] = float(TheSun.alt) * 180. / ephem.pi
-    sun['set'] = Observatory.next_setting(TheSun).datetime()
-    sun['rise'] = Observatory.next_rising(TheSun).datetime()
-    if sun['alt'] <= -18:
-        sun['now'] = 'night'
-    elif sun['alt'] > -18 and sun['alt'] <= -12:
-        sun['now'] = 'astronomical twilight'
-    elif sun['alt'] > -12 and sun['alt'] <= -6:
-        sun['now'] = 'nautical twilight'
-    elif sun['alt'] > -6 and sun['alt'] <= 0:
-        sun['now'] = 'civil twilight'
-    elif sun['alt'] > 0:
-        sun['now'] = 'day'
-
-    TheMoon = ephem.Moon()
-    Observatory.date = nowut
-    TheMoon.compute(Observatory)
-    moon = {}
-    moon['phase'] = TheMoon.phase
-    moon['alt'] = TheMoon.alt * 180. / ephem.pi
-    moon['set'] = Observatory.next_setting(TheMoon).datetime()
-    moon['rise'] = Observatory.next_rising(TheMoon).datetime()
-    if moon['alt'] > 0:
-        moon['now'] = 'up'
-    else:
-        moon['now'] = 'down'
-
-    return sun, moon
+    return get_astronomy()
 
 
 ##-------------------------------------------------------------------------
@@ -247,7 +165,7 @@ def update_astronomy():
 def generate_weather_table():
     now = dt.now()
     nowut = now + tdelta(0, 10*60*60)
-    weatherdata = retrieve_weather(lookbackdays=0)[-1]
+    weatherdata = get_latest('weather')
     condition, color = get_conditions(weatherdata)
     weather_data_age = (nowut - weatherdata['date']).total_seconds()
     if weather_data_age < 60:
@@ -261,20 +179,9 @@ def generate_weather_table():
 
     telstatus = retrieve_telstatus('V20')
     sun, moon = update_astronomy()
-    sunstrings = [f"Next sunrise is at {sun['rise'].strftime('%Y/%m/%d %H:%M:%S UT')}",
-                  f"Next sunset is at {sun['set'].strftime('%Y/%m/%d %H:%M:%S UT')}"]
-    if sun['rise'] > sun['set']:
-        sunstrings.reverse()
-
+    sunstrings = sun_event_strings(sun)
 
-    paths = {'Drobo': os.path.join('/', 'Volumes', 'DataCopy'),\
-             'macOS': os.path.expanduser('~'),\
-             'DroboPro': os.path.join('/', 'Volumes', 'MLOData')}
-    disks = {}
-    for disk in paths.keys():
-        if os.path.exists(paths[disk]):
-            size_GB, avail_GB, pcnt_used = free_space(paths[disk])
-            disks[disk] = [size_GB, avail_GB, pcnt_used]
+    disks = get_disks()
 
     tdcw300 = styles['tdc'].copy()
     tdcw300['width'] = '300px'
@@ -411,4 +318,5 @@ def generate_weather_table():
 
 
 if __name__ == '__main__':
+    start_watcher()
     app.run_server(debug=True)
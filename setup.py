@@ -4,6 +4,13 @@ setup(
     version = "1.1.2",
     author='Josh Walawender',
     packages = find_packages(),
+    entry_points = {
+        'console_scripts': [
+            'vysos-ephemeris = VYSOS.ephemeris:main',
+            'vysos-db-init = VYSOS.db_init:main',
+            'vysos-rollup = VYSOS.rollup:main',
+            'vysos-export = VYSOS.export:main',
+        ]},
 #     entry_points = {
 #         'console_scripts': [
 #             'measureimage = scripts.measure_image:main',
@@ -0,0 +1,101 @@
+'''
+Tests of the as-of join of exposure windows to telemetry.
+'''
+
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+from VYSOS.asof import asof_join, to_seconds
+
+
+times = np.array([0., 10., 20., 30., 40.])
+values = np.array([1., 2., 3., 4., 5.])
+
+
+def join(starts, ends, how, tolerance=None, times=times, values=values):
+    return asof_join(np.array(starts, dtype=float), np.array(ends, dtype=float),
+                     times, {'value': values}, how=how, tolerance=tolerance)
+
+
+@pytest.mark.parametrize('how, expected', [('mean', 2.5),
+                                           ('first', 2.),
+                                           ('last', 3.),
+                                           ('nearest', 2.)])
+def test_window(how, expected):
+    result = join([5.], [25.], how)
+    assert result['n'][0] == 2
+    assert result['value'][0] == pytest.approx(expected)
+
+
+def test_nearest_picks_closest_to_middle():
+    result = join([12., 22.], [14., 38.], 'nearest')
+    assert list(result['value']) == [2., 4.]
+
+
+def test_window_edges_inclusive():
+    result = join([10.], [20.], 'mean')
+    assert result['n'][0] == 2
+    assert result['value'][0] == pytest.approx(2.5)
+
+
+def test_mean_ignores_nan():
+    result = join([5.], [25.], 'mean', values=np.array([1., np.nan, 3., 4., 5.]))
+    assert result['value'][0] == pytest.approx(3.)
+
+
+@pytest.mark.parametrize('how', ['mean', 'first', 'last'])
+def test_empty_window_without_tolerance(how):
+    result = join([11.], [15.], how)
+    assert result['n'][0] == 0
+    assert np.isnan(result['value'][0])
+
+
+@pytest.mark.parametrize('how', ['mean', 'first', 'last'])
+def test_empty_window_with_tolerance(how):
+    ## The nearest sample (at 10) is 1 s before the window
+    assert join([11.], [15.], how, tolerance=5)['value'][0] == 2.
+    assert np.isnan(join([11.], [15.], how, tolerance=0.5)['value'][0])
+
+
+def test_nearest_tolerance():
+    assert join([100.], [100.], 'nearest')['value'][0] == 5.
+    assert np.isnan(join([100.], [100.], 'nearest', tolerance=10)['value'][0])
+
+
+@pytest.mark.parametrize('how', ['nearest', 'mean', 'first', 'last'])
+def test_empty_telemetry(how):
+    result = join([5., 15.], [25., 35.], how, tolerance=10,
+                  times=np.array([]), values=np.array([]))
+    assert list(result['n']) == [0, 0]
+    assert np.all(np.isnan(result['value']))
+
+
+@pytest.mark.parametrize('how', ['nearest', 'mean', 'first', 'last'])
+def test_unsorted_telemetry(how):
+    order = np.array([3, 0, 4, 1, 2])
+    starts, ends = [5., 12., 100.], [25., 14., 100.]
+    expected = join(starts, ends, how, tolerance=100)
+    result = join(starts, ends, how, tolerance=100,
+                  times=times[order], values=values[order])
+    np.testing.assert_array_equal(result['n'], expected['n'])
+    np.testing.assert_array_equal(result['value'], expected['value'])
+
+
+def test_datetimes():
+    t0 = dt(2018, 6, 1, 10, 0, 0)
+    sample_times = [t0 + tdelta(0, t) for t in times]
+    result = asof_join([t0 + tdelta(0, 5)], [t0 + tdelta(0, 25)], sample_times,
+                       {'value': values}, how='mean')
+    assert result['value'][0] == pytest.approx(2.5)
+    assert to_seconds([t0])[0] == pytest.approx((t0 - dt(1970, 1, 1)).total_seconds())
+
+
+def test_bad_aggregate():
+    with pytest.raises(ValueError):
+        join([5.], [25.], 'median')
@@ -0,0 +1,72 @@
+'''
+Tests of the vectorized sun and moon ephemerides against the per-call
+pyephem computation they replaced in make_nightly_plots.
+'''
+
+import math
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('astropy')
+ephem = pytest.importorskip('ephem')
+
+from astropy.utils import iers
+
+from VYSOS import ephemeris
+
+
+date_string = '20180505UT'
+start = dt(2018, 5, 5, 0, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def no_table(monkeypatch, tmp_path):
+    '''Compute everything rather than use a precomputed table, and use the
+    bundled IERS-B table rather than download one (the dates are in it).
+    '''
+    monkeypatch.setattr(ephemeris, 'default_table_file', str(tmp_path / 'none.npz'))
+    with iers.conf.set_temp('auto_download', False):
+        yield
+
+
+def observatory():
+    '''The pyephem Observer which make_nightly_plots used, without
+    refraction so that it matches the astropy AltAz frame.
+    '''
+    Observatory = ephem.Observer()
+    Observatory.lon = "-155:34:33.9"
+    Observatory.lat = "+19:32:09.66"
+    Observatory.elevation = 3400.0
+    Observatory.pressure = 0
+    return Observatory
+
+
+def test_sun_moon_grid_matches_pyephem():
+    times = [start + tdelta(0, 60*60*i) for i in range(24)]
+    positions = ephemeris.sun_moon_grid(times)
+    Observatory = observatory()
+    TheSun = ephem.Sun()
+    TheMoon = ephem.Moon()
+    for i, time in enumerate(times):
+        Observatory.date = time
+        TheSun.compute(Observatory)
+        TheMoon.compute(Observatory)
+        assert positions['sun_alt'][i] == pytest.approx(math.degrees(TheSun.alt), abs=0.05)
+        assert positions['moon_alt'][i] == pytest.approx(math.degrees(TheMoon.alt), abs=0.05)
+        assert positions['moon_phase'][i] == pytest.approx(TheMoon.phase, abs=0.5)
+
+
+def test_twilights_match_pyephem():
+    twilights = ephemeris.twilights(date_string)
+    Observatory = observatory()
+    Observatory.date = start.strftime('%Y/%m/%d 10:00:00')
+    for name, horizon, setting in ephemeris.twilight_definitions:
+        Observatory.horizon = str(horizon)
+        if setting:
+            expected = Observatory.previous_setting(ephem.Sun(), use_center=True).datetime()
+        else:
+            expected = Observatory.next_rising(ephem.Sun(), use_center=True).datetime()
+        assert abs((twilights[name] - expected).total_seconds()) < 30, name
@@ -0,0 +1,181 @@
+'''
+Tests of the Parquet export, using an in-memory stand-in for the mongo
+collections.
+'''
+
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pyarrow')
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+from bson import ObjectId
+
+from VYSOS import export
+
+
+class FakeCollection(object):
+    '''Supports just the queries made by export_collection.
+    '''
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+
+    def find_one(self, query, projection=None, sort=None):
+        documents = [d for d in self.documents if self.matches(d, query)]
+        if len(documents) == 0:
+            return None
+        key, direction = sort[0]
+        return sorted(documents, key=lambda d: d[key], reverse=direction < 0)[0]
+
+    def find(self, query, projection=None, sort=None):
+        documents = [d for d in self.documents if self.matches(d, query)]
+        if sort is not None:
+            ## documents without the key sort first
+            key = sort[0][0]
+            documents.sort(key=lambda d: (key in d, d.get(key, 0)))
+        return [dict(d) for d in documents]
+
+    def aggregate(self, pipeline):
+        match = pipeline[0]['$match']
+        months = set([d['date'].strftime('%Y-%m') if isinstance(d.get('date'), dt) else None
+                      for d in self.documents if self.matches(d, match)])
+        return [{'_id': month} for month in months]
+
+    def matches(self, document, query):
+        for key, condition in query.items():
+            value = document.get(key, None)
+            if not isinstance(condition, dict):
+                if value != condition:
+                    return False
+            elif '$type' in condition:
+                if not isinstance(value, dt):
+                    return False
+            elif '$not' in condition:
+                if isinstance(value, dt):
+                    return False
+            else:
+                if value is None:
+                    return False
+                if '$gt' in condition and not value > condition['$gt']:
+                    return False
+                if '$gte' in condition and not value >= condition['$gte']:
+                    return False
+                if '$lt' in condition and not value < condition['$lt']:
+                    return False
+        return True
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    collections = {name: FakeCollection() for name in export.collections.keys()}
+    monkeypatch.setattr(export, 'get_collection', lambda name: collections[name])
+    return collections
+
+
+def weather_doc(date, temp):
+    return {'_id': ObjectId(), 'date': date, 'temp': temp, 'safe': True}
+
+
+def image_doc(telescope, date, fwhm, filename=None):
+    return {'_id': ObjectId(), 'telescope': telescope, 'date': date, 'exptime': 60,
+            'FWHM_pix': fwhm, 'filename': filename or f'{telescope}_{date:%Y%m%dat%H%M%S}.fts',
+            'jpegs': ['a.jpg']}
+
+
+def test_read_missing_export(tmp_path):
+    assert export.read('weather', root=str(tmp_path)) == {}
+    assert export.exported_until('weather', root=str(tmp_path)) is None
+
+
+def test_round_trip_with_filters(mongo, tmp_path):
+    root = str(tmp_path)
+    start = dt(2018, 5, 31, 23, 0, 0)
+    mongo['weather'].documents = [weather_doc(start + tdelta(0, 600*i), float(i))
+                                  for i in range(12)]
+    assert export.export_collection('weather', root=root) == 12
+    assert (tmp_path / 'weather' / 'telescope=site' / 'month=2018-05' / 'data.parquet').exists()
+    assert (tmp_path / 'weather' / 'telescope=site' / 'month=2018-06' / 'data.parquet').exists()
+    assert export.exported_until('weather', root=root) == start + tdelta(0, 600*11)
+
+    data = export.read('weather', root=root)
+    np.testing.assert_array_equal(data['temp'], np.arange(12.))
+    assert data['date'][0] == np.datetime64(start, 'us')
+
+    data = export.read('weather', columns=['date', 'temp'], root=root,
+                       start=start + tdelta(0, 1200), end=start + tdelta(0, 4800))
+    assert sorted(data.keys()) == ['date', 'temp']
+    np.testing.assert_array_equal(data['temp'], [2., 3., 4., 5., 6., 7.])
+
+    ## Entirely within one month partition
+    data = export.read('weather', columns=['temp'], root=root,
+                       start=dt(2018, 6, 1, 0, 30), end=dt(2018, 7, 1))
+    np.testing.assert_array_equal(data['temp'], [9., 10., 11.])
+
+    frame = export.read('weather', root=root, start=start, end=dt(2018, 6, 1),
+                        as_pandas=True)
+    assert len(frame) == 6
+
+
+def test_telescope_filter(mongo, tmp_path):
+    root = str(tmp_path)
+    date = dt(2018, 6, 1, 10, 0, 0)
+    mongo['images'].documents = [image_doc('V5', date, 1.5),
+                                 image_doc('V20', date + tdelta(0, 60), 3.0),
+                                 image_doc('V5', date + tdelta(0, 120), 2.5)]
+    export.export_collection('images', root=root)
+    data = export.read('images', columns=['date', 'FWHM_pix'], telescope='V5', root=root)
+    np.testing.assert_array_equal(data['FWHM_pix'], [1.5, 2.5])
+    data = export.read('images', columns=['FWHM_pix'], telescope='V20', root=root,
+                       start=date, end=date + tdelta(1))
+    np.testing.assert_array_equal(data['FWHM_pix'], [3.0])
+    ## Nested fields are not exported
+    assert 'jpegs' not in export.read('images', root=root)
+
+
+def test_incremental_export(mongo, tmp_path):
+    root = str(tmp_path)
+    ## An _id given before the first export, for a sample which only reaches
+    ## mongo later (as when it is replayed from the telemetry spool)
+    late_id = ObjectId()
+    date = dt.utcnow().replace(microsecond=0) - tdelta(0, 3600)
+    mongo['V5status'].documents = [{'_id': ObjectId(), 'date': date + tdelta(0, 20*i),
+                                    'focuser_temperature': float(i)}
+                                   for i in range(5)]
+    assert export.export_collection('V5status', root=root) == 5
+    last_id, last_date = export.read_watermark(root, 'V5status')
+    assert last_id == mongo['V5status'].documents[-1]['_id']
+    assert last_date == date + tdelta(0, 80)
+
+    mongo['V5status'].documents.append({'_id': late_id, 'date': date + tdelta(0, 50),
+                                        'focuser_temperature': 99.})
+    mongo['V5status'].documents.append({'_id': ObjectId(), 'date': date + tdelta(0, 100),
+                                        'focuser_temperature': 5.})
+    export.export_collection('V5status', root=root)
+    data = export.read('V5status', root=root)
+    np.testing.assert_array_equal(data['focuser_temperature'],
+                                  [0., 1., 2., 99., 3., 4., 5.])
+    assert export.exported_until('V5status', root=root) == date + tdelta(0, 100)
+
+
+def test_reanalysis_does_not_duplicate(mongo, tmp_path):
+    root = str(tmp_path)
+    date = dt(2018, 6, 1, 10, 0, 0)
+    mongo['images'].documents = [image_doc('V5', date, 1.5),
+                                 image_doc('V5', date + tdelta(0, 120), 2.5)]
+    export.export_collection('images', root=root)
+    ## Reanalysis deletes the document and inserts a new one (new _id, same
+    ## date and filename), long after the overlap window
+    old = mongo['images'].documents.pop(0)
+    mongo['images'].documents.append(image_doc('V5', date, 1.8, filename=old['filename']))
+    export.export_collection('images', root=root)
+    data = export.read('images', columns=['filename', 'FWHM_pix'], root=root)
+    assert sorted(data['filename']) == sorted(set(data['filename']))
+    np.testing.assert_array_equal(data['FWHM_pix'], [1.8, 2.5])
+
+
+def test_empty_collection(mongo, tmp_path):
+    assert export.export_collection('weather', root=str(tmp_path)) == 0
+    assert export.read('weather', root=str(tmp_path)) == {}
@@ -0,0 +1,95 @@
+'''
+Tests of the status poller using the simulated devices.
+'''
+
+import time
+import logging
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+from VYSOS import get_status
+from VYSOS.devices import SimulatedDevice, DeviceError
+
+
+log = logging.getLogger('test_get_status')
+
+telescope_fields = ['connected', 'park', 'slewing', 'tracking', 'alt', 'az', 'RA', 'DEC']
+focuser_fields = ['focuser_temperature', 'focuser_position']
+tcc_fields = ['truss_temperature', 'primary_temperature', 'secondary_temperature',
+              'fan_speed']
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.documents = []
+
+    def write(self, document, flush=False):
+        self.documents.append(document)
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(get_status, 'get_writer', lambda *args, **kwargs: writer)
+    return writer
+
+
+def test_simulated_status(writer):
+    get_status.get_status_and_log('V20', log, cadence=0.2, max_age=1,
+                                  simulate=True, latency=0.01, cycles=3)
+    assert len(writer.documents) == 3
+    for document in writer.documents:
+        assert document['telescope'] == 'V20'
+        for field in telescope_fields + focuser_fields + tcc_fields:
+            assert field in document
+    dates = [document['date'] for document in writer.documents]
+    assert dates == sorted(dates)
+
+
+def test_simulated_status_V5(writer):
+    get_status.get_status_and_log('V5', log, cadence=0.2, max_age=1,
+                                  simulate=True, cycles=1)
+    document = writer.documents[0]
+    for field in telescope_fields + focuser_fields:
+        assert field in document
+    for field in tcc_fields:
+        assert field not in document
+
+
+def test_simulated_device_errors(writer, caplog):
+    with caplog.at_level(logging.WARNING, logger='test_get_status'):
+        get_status.get_status_and_log('V5', log, cadence=0.2, max_age=1,
+                                      simulate=True, error_rate=1., cycles=2)
+    ## Every sample failed, so the documents are written without device values
+    assert [sorted(document.keys()) for document in writer.documents] ==\
+           [['date', 'telescope'], ['date', 'telescope']]
+    assert 'Failed to sample' in caplog.text
+
+
+def test_hung_device_is_left_out():
+    '''A device slower than max_age does not delay the others and its old
+    values are not reported.
+    '''
+    fast = get_status.DevicePoller(SimulatedDevice('fast', {'a': 1}, interval=0.05), log)
+    slow = get_status.DevicePoller(SimulatedDevice('slow', {'b': 2}, interval=0.05,
+                                                   latency=1.), log)
+    for poller in [fast, slow]:
+        poller.start()
+    time.sleep(0.3)
+    status = get_status.assemble_status('V5', [fast, slow], max_age=0.5)
+    for poller in [fast, slow]:
+        poller.stop()
+    assert status['a'] == 1
+    assert 'b' not in status
+
+
+def test_simulated_device_error_rate():
+    device = SimulatedDevice('sim', {'x': 1.0}, error_rate=1.)
+    with pytest.raises(DeviceError):
+        device.sample()
+    device = SimulatedDevice('sim', {'x': 1.0, 'n': 5}, noise=0.)
+    assert device.sample() == {'x': 1.0, 'n': 5}
@@ -0,0 +1,113 @@
+'''
+Tests of the columnar query_mongo loader, and a benchmark against the old
+row by row (Table.add_row) loader.  The benchmark is slow, so it only runs
+if the VYSOS_BENCHMARK environment variable is set.
+'''
+
+import os
+import time
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('matplotlib')
+pytest.importorskip('pymongo')
+Table = pytest.importorskip('astropy.table').Table
+
+from VYSOS.make_nightly_plots import query_mongo
+
+
+class FakeCursor(object):
+    def __init__(self, documents):
+        self.documents = documents
+
+    def limit(self, n):
+        return FakeCursor(self.documents[:n] if n > 0 else self.documents)
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeCollection(object):
+    def __init__(self, documents):
+        self.documents = documents
+        self.projections = []
+
+    def find(self, query, projection=None):
+        self.projections.append(projection)
+        if projection is None:
+            return FakeCursor([dict(document) for document in self.documents])
+        return FakeCursor([{k: v for k, v in document.items() if projection.get(k, 0)}
+                           for document in self.documents])
+
+
+def weather_documents(n):
+    start = dt(2018, 6, 1, 6, 0, 0)
+    return [{'date': start + tdelta(0, 20*i), 'temp': 10. + (i % 50)/10.,
+             'clouds': -25. + (i % 7), 'wind': 5., 'gust': 8., 'rain': 3000,
+             'light': 100, 'safe': True}
+            for i in range(n)]
+
+
+def query_mongo_rowwise(db, collection, query):
+    '''The loader query_mongo replaced: one add_row per document.
+    '''
+    names = ('date', 'temp', 'clouds')
+    result = Table(names=names, dtype=(object, np.float64, np.float64))
+    for entry in db[collection].find(query):
+        result.add_row([entry.get(name, np.nan) for name in names])
+    return result
+
+
+def test_query_mongo():
+    documents = weather_documents(100)
+    del documents[3]['temp']
+    db = {'weather': FakeCollection(documents)}
+    result = query_mongo(db, 'weather', {})
+    assert result.colnames == ['date', 'temp', 'clouds']
+    assert len(result) == 100
+    assert result['date'][0] == np.datetime64(documents[0]['date'], 'us')
+    assert result['temp'][1] == documents[1]['temp']
+    assert np.isnan(result['temp'][3])
+    ## Only the plotted fields are requested
+    assert db['weather'].projections == [{'date': 1, 'temp': 1, 'clouds': 1, '_id': 0}]
+
+
+def test_query_mongo_limit():
+    result = query_mongo({'weather': FakeCollection(weather_documents(10))},
+                         'weather', {}, limit=8)
+    assert len(result) == 8
+
+
+def test_query_mongo_grows_columns():
+    documents = weather_documents(100)
+    result = query_mongo({'weather': FakeCollection(documents)}, 'weather', {}, chunk=16)
+    assert len(result) == 100
+    np.testing.assert_array_equal(result['temp'], [d['temp'] for d in documents])
+    assert result['date'][-1] == np.datetime64(documents[-1]['date'], 'us')
+
+
+def test_query_mongo_empty():
+    result = query_mongo({'weather': FakeCollection([])}, 'weather', {})
+    assert len(result) == 0
+
+
+@pytest.mark.skipif(os.environ.get('VYSOS_BENCHMARK', None) is None,
+                    reason='set VYSOS_BENCHMARK to run benchmarks')
+@pytest.mark.parametrize('n', [10000, 100000])
+def test_query_mongo_benchmark(n, capsys):
+    db = {'weather': FakeCollection(weather_documents(n))}
+    start = time.monotonic()
+    columnar = query_mongo(db, 'weather', {})
+    columnar_time = time.monotonic() - start
+    start = time.monotonic()
+    rowwise = query_mongo_rowwise(db, 'weather', {})
+    rowwise_time = time.monotonic() - start
+
+    np.testing.assert_array_equal(columnar['temp'], rowwise['temp'])
+    with capsys.disabled():
+        print(f'\n  {n} documents: add_row {rowwise_time:.2f} s, '
+              f'columnar {columnar_time:.2f} s '
+              f'({rowwise_time/columnar_time:.0f}x faster)')
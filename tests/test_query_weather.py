@@ -0,0 +1,218 @@
+'''
+Tests of the AAG Solo weather ingest against a local fake AAG HTTP server.
+'''
+
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+from VYSOS import query_weather
+
+
+last_data = '''dataGMTTime=2018/06/01 10:00:00
+clouds=-25.5
+temp=12.25
+wind=5
+gust=8
+rain=3000
+light=120
+switch=0
+safe=1
+'''
+
+hist_data_pairs = '''dataGMTTime=2018/06/01 09:59:00,clouds=-25.0,temp=12.0,wind=4,gust=6,rain=3000,light=110,switch=0,safe=1
+dataGMTTime=2018/06/01 09:58:00&clouds=-24.0&temp=12.1&wind=3&gust=5&rain=3000&light=100&switch=0&safe=0
+not a record
+'''
+
+hist_data_csv = '''dataGMTTime,clouds,temp,wind,gust,rain,light,switch,safe
+2018/06/01 09:59:00,-25.0,12.0,4,6,3000,110,0,1
+2018/06/01 09:58:00,-24.0,12.1,3,5,3000,100,0,0
+2018/06/01 09:57:00,bad,12.1,3,5,3000,100,0,0
+'''
+
+log = logging.getLogger('test_query_weather')
+
+
+##-------------------------------------------------------------------------
+## Fake AAG Solo and Telemetry Writer
+##-------------------------------------------------------------------------
+class FakeAAG(BaseHTTPRequestHandler):
+    pages = {'/cgi-bin/cgiLastData': last_data,
+             '/cgi-bin/cgiHistData': hist_data_csv}
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = self.pages.get(self.path, None)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.documents = []
+
+    def write(self, document, flush=False):
+        self.documents.append(document)
+
+
+class FakeCollection(object):
+    def __init__(self, dates):
+        self.dates = dates
+
+    def distinct(self, key, query):
+        return list(self.dates)
+
+
+@pytest.fixture
+def aag(monkeypatch):
+    handler = type('Handler', (FakeAAG,), {'delay': 0})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(query_weather, 'aag_address',
+                        f'http://127.0.0.1:{server.server_address[1]}')
+    yield handler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(query_weather, 'get_writer', lambda *args, **kwargs: writer)
+    return writer
+
+
+##-------------------------------------------------------------------------
+## Parsing
+##-------------------------------------------------------------------------
+def test_parse_last_data():
+    doc = query_weather.parse_last_data(last_data, querydate=dt(2018, 6, 1, 10, 0, 5))
+    assert doc['date'] == dt(2018, 6, 1, 10, 0, 0)
+    assert doc['querydate'] == dt(2018, 6, 1, 10, 0, 5)
+    assert doc['clouds'] == -25.5
+    assert doc['temp'] == 12.25
+    assert doc['rain'] == 3000
+    assert doc['safe'] is True
+
+
+def test_parse_last_data_missing_key():
+    with pytest.raises(KeyError):
+        query_weather.parse_last_data(last_data.replace('temp=12.25\n', ''))
+
+
+@pytest.mark.parametrize('text', [hist_data_pairs, hist_data_csv])
+def test_parse_hist_data(text):
+    docs = query_weather.parse_hist_data(text)
+    assert [doc['date'] for doc in docs] == [dt(2018, 6, 1, 9, 58), dt(2018, 6, 1, 9, 59)]
+    assert [doc['safe'] for doc in docs] == [False, True]
+    assert docs[1]['clouds'] == -25.0
+
+
+def test_parse_hist_data_empty():
+    assert query_weather.parse_hist_data('\n\n') == []
+
+
+##-------------------------------------------------------------------------
+## Queries to the Fake AAG Solo
+##-------------------------------------------------------------------------
+def test_get_weather(aag, writer):
+    doc = query_weather.get_weather(log)
+    assert doc['date'] == dt(2018, 6, 1, 10, 0, 0)
+    assert writer.documents == [doc]
+
+
+def test_get_weather_filtered(aag, writer):
+    sample_filter = query_weather.SampleFilter()
+    query_weather.get_weather(log, sample_filter=sample_filter)
+    ## Same device timestamp, so the second sample is not saved
+    query_weather.get_weather(log, sample_filter=sample_filter)
+    assert len(writer.documents) == 1
+
+
+def test_get_weather_timeout(aag, writer, monkeypatch):
+    aag.delay = 2
+    monkeypatch.setattr(query_weather, 'timeout', (0.5, 0.5))
+    start = time.monotonic()
+    assert query_weather.get_weather(log) is None
+    assert time.monotonic() - start < 1.5
+    assert writer.documents == []
+
+
+def test_get_weather_bad_response(aag, writer):
+    aag.pages = {'/cgi-bin/cgiLastData': 'garbage'}
+    assert query_weather.get_weather(log) is None
+    assert writer.documents == []
+
+
+def test_backfill(aag, writer, monkeypatch):
+    monkeypatch.setattr(query_weather, 'get_collection',
+                        lambda name: FakeCollection([dt(2018, 6, 1, 9, 58)]))
+    n = query_weather.backfill(dt(2018, 6, 1, 9, 50), dt(2018, 6, 1, 10, 0), log)
+    assert n == 1
+    assert [doc['date'] for doc in writer.documents] == [dt(2018, 6, 1, 9, 59)]
+
+
+def test_backfill_timeout(aag, writer, monkeypatch):
+    aag.delay = 2
+    monkeypatch.setattr(query_weather, 'timeout', (0.5, 0.5))
+    n = query_weather.backfill(dt(2018, 6, 1, 9, 50), dt(2018, 6, 1, 10, 0), log)
+    assert n == 0
+    assert writer.documents == []
+
+
+##-------------------------------------------------------------------------
+## Ingest Loop
+##-------------------------------------------------------------------------
+def test_ingest_one_backfill_at_a_time(monkeypatch, caplog):
+    ## Every poll jumps 5 minutes, so every poll finds a gap
+    polls = []
+    def get_weather(logger, session, sample_filter):
+        polls.append(dt(2018, 6, 1, 10) + tdelta(0, 300*len(polls)))
+        return {'date': polls[-1]}
+    release = threading.Event()
+    backfills = []
+    def backfill(start, end, logger):
+        backfills.append((start, end))
+        release.wait(5)
+        return 3
+    monkeypatch.setattr(query_weather, 'latest_weather_date', lambda logger: dt(2018, 6, 1, 9))
+    monkeypatch.setattr(query_weather, 'get_weather', get_weather)
+    monkeypatch.setattr(query_weather, 'backfill', backfill)
+
+    async def run():
+        task = asyncio.ensure_future(query_weather.ingest(log, interval=0.01))
+        await asyncio.sleep(0.2)
+        ## The first backfill is still running, so no others were started
+        assert backfills == [(dt(2018, 6, 1, 9), dt(2018, 6, 1, 10))]
+        assert len(polls) > 2
+        release.set()
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    with caplog.at_level(logging.INFO, logger=log.name):
+        asyncio.run(run())
+    assert len(backfills) > 1
+    assert 'Backfill finished, saved 3 samples' in caplog.text
+    assert 'Backfill already running' in caplog.text
@@ -0,0 +1,24 @@
+'''
+Tests of the status page helpers in VYSOS.status_data.
+'''
+
+from datetime import datetime as dt
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+from VYSOS.status_data import sun_event_strings
+
+
+def test_sun_event_strings_in_order():
+    sun = {'rise': dt(2018, 5, 5, 15, 50, 0), 'set': dt(2018, 5, 5, 4, 55, 0)}
+    assert sun_event_strings(sun) == ['Next sunset is at 2018/05/05 04:55:00 UT',
+                                      'Next sunrise is at 2018/05/05 15:50:00 UT']
+
+
+def test_sun_event_strings_missing_event():
+    sun = {'rise': None, 'set': dt(2018, 5, 5, 4, 55, 0)}
+    assert sun_event_strings(sun) == ['Next sunset is at 2018/05/05 04:55:00 UT',
+                                      'No sunrise in the next 3 days']
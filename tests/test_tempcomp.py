@@ -0,0 +1,109 @@
+'''
+Tests of the archive/tempcomp.py data loading from the Parquet export, with
+mongo used for the part the export does not cover.
+'''
+
+import os
+import sys
+import functools
+from datetime import datetime as dt
+from datetime import timedelta as tdelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pyarrow')
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+pytest.importorskip('matplotlib')
+
+import matplotlib
+matplotlib.use('Agg')
+from bson import ObjectId
+
+from VYSOS import export
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'archive'))
+import tempcomp
+
+from test_export import FakeCollection
+
+
+start = dt(2018, 6, 1, 10, 0, 0)
+
+
+@pytest.fixture
+def mongo(monkeypatch, tmp_path):
+    '''In-memory collections, with the export (in tmp_path) and tempcomp
+    reading from them.
+    '''
+    collections = {name: FakeCollection() for name in export.collections.keys()}
+    monkeypatch.setattr(export, 'get_collection', lambda name: collections[name])
+    monkeypatch.setattr(tempcomp, 'get_collection', lambda name: collections[name])
+    root = str(tmp_path)
+    monkeypatch.setattr(export, 'read', functools.partial(export.read, root=root))
+    monkeypatch.setattr(export, 'exported_until',
+                        functools.partial(export.exported_until, root=root))
+    collections['root'] = root
+    return collections
+
+
+def test_load_series_export_and_tail(mongo, monkeypatch):
+    mongo['V5status'].documents = [{'_id': ObjectId(), 'date': start + tdelta(0, 20*i),
+                                    'focuser_temperature': float(i)}
+                                   for i in range(5)]
+    export.export_collection('V5status', root=mongo['root'])
+    ## Newer than the export, so this has to come from mongo
+    mongo['V5status'].documents.append({'_id': ObjectId(), 'date': start + tdelta(0, 100),
+                                        'focuser_temperature': 5.})
+    queries = []
+    def load_telemetry(collection_name, begin, end, fields):
+        queries.append((begin, end))
+        documents = [d for d in mongo[collection_name].documents if begin <= d['date'] <= end]
+        return (tempcomp.asof.to_seconds([d['date'] for d in documents]),
+                {f: np.array([d[f] for d in documents]) for f in fields})
+    monkeypatch.setattr(tempcomp.asof, 'load_telemetry', load_telemetry)
+
+    times, columns = tempcomp.load_series('V5status', start, start + tdelta(0, 200),
+                                          ['focuser_temperature'])
+    np.testing.assert_array_equal(columns['focuser_temperature'], [0., 1., 2., 3., 4., 5.])
+    assert len(times) == 6
+    ## Only the tail after the export was queried
+    assert queries == [(start + tdelta(0, 80), start + tdelta(0, 200))]
+
+
+def test_load_images_from_export(mongo):
+    mongo['images'].documents = [
+        {'_id': ObjectId(), 'telescope': 'V5', 'date': start, 'exptime': 60., 'FWHM_pix': 1.5},
+        {'_id': ObjectId(), 'telescope': 'V5', 'date': start + tdelta(0, 120), 'FWHM_pix': 1.6},
+        {'_id': ObjectId(), 'telescope': 'V5', 'date': start + tdelta(0, 240), 'exptime': 60.,
+         'FWHM_pix': 3.0},
+        {'_id': ObjectId(), 'telescope': 'V5', 'exptime': 60., 'FWHM_pix': 1.2},
+        {'_id': ObjectId(), 'telescope': 'V20', 'date': start, 'exptime': 60., 'FWHM_pix': 1.0},
+    ]
+    export.export_collection('images', root=mongo['root'])
+    ## Newer than the export, so these have to come from mongo
+    mongo['images'].documents += [
+        {'_id': ObjectId(), 'telescope': 'V5', 'date': start + tdelta(0, 360), 'exptime': 30.,
+         'FWHM_pix': 1.4},
+        {'_id': ObjectId(), 'telescope': 'V20', 'date': start + tdelta(0, 360), 'exptime': 30.,
+         'FWHM_pix': 1.4},
+    ]
+    dates, exptimes = tempcomp.load_images('V5')
+    ## The image without an exptime gets 0, the one without a date is dropped
+    assert dates == [start, start + tdelta(0, 120), start + tdelta(0, 360)]
+    np.testing.assert_array_equal(exptimes, [60., 0., 30.])
+
+
+def test_broken_export_falls_back_to_mongo(mongo, monkeypatch):
+    mongo['V5status'].documents = [{'_id': ObjectId(), 'date': start,
+                                    'focuser_temperature': 1.}]
+    export.export_collection('V5status', root=mongo['root'])
+    def broken(*args, **kwargs):
+        raise OSError('partial export')
+    monkeypatch.setattr(export, 'read', broken)
+    monkeypatch.setattr(tempcomp.asof, 'load_telemetry',
+                        lambda *args: ('mongo', {'focuser_temperature': 'mongo'}))
+    assert tempcomp.load_series('V5status', start, start + tdelta(0, 60),
+                                ['focuser_temperature'])[0] == 'mongo'
@@ -0,0 +1,112 @@
+'''
+Tests (and a small benchmark) of the directory watcher, using an in-memory
+stand-in for the images collection.  The benchmark is slow, so it only runs
+if the VYSOS_BENCHMARK environment variable is set.
+'''
+
+import os
+import sys
+import time
+import types
+import queue
+import logging
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+## watch_directory imports measure_image as a top level module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'VYSOS'))
+try:
+    import measure_image
+except ImportError:
+    ## The analysis itself (SIDRE) is not needed to test the watcher
+    sys.modules['measure_image'] = types.SimpleNamespace(measure_image=None)
+
+from VYSOS.watch_directory import DirectoryWatcher
+
+
+log = logging.getLogger('test_watch_directory')
+
+
+class FakeImages(object):
+    '''Minimal stand-in for the images collection which supports the two
+    filename queries and counts round trips.  latency (seconds) is added to
+    each query to mimic the network.
+    '''
+    def __init__(self, filenames, latency=0.):
+        self.filenames = set(filenames)
+        self.latency = latency
+        self.queries = 0
+
+    def find(self, query, projection=None):
+        self.queries += 1
+        time.sleep(self.latency)
+        wanted = query['filename']
+        if isinstance(wanted, dict):
+            wanted = wanted['$in']
+        else:
+            wanted = [wanted]
+        return [{'filename': f} for f in wanted if f in self.filenames]
+
+
+def frame_names(n):
+    return [f'V5_M42-20180601at{i:06d}.fts' for i in range(n)]
+
+
+def make_watcher(images):
+    return DirectoryWatcher('V5', queue.Queue(), images, log, settle_time=0)
+
+
+##-------------------------------------------------------------------------
+## find_unanalyzed
+##-------------------------------------------------------------------------
+def test_find_unanalyzed_one_query():
+    frames = frame_names(5000)
+    images = FakeImages(frames[:4000])
+    watcher = make_watcher(images)
+    assert watcher.find_unanalyzed(frames) == frames[4000:]
+    assert images.queries == 1
+
+
+def test_find_unanalyzed_remembers_analyzed():
+    frames = frame_names(5000)
+    images = FakeImages(frames[:4000])
+    watcher = make_watcher(images)
+    watcher.find_unanalyzed(frames)
+    ## Only the 1000 unanalyzed frames are asked about again
+    images.filenames.update(frames[4000:4500])
+    assert watcher.find_unanalyzed(frames) == frames[4500:]
+    assert images.queries == 2
+    ## Nothing to ask about, so no query
+    assert watcher.find_unanalyzed(frames[:4500]) == []
+    assert images.queries == 2
+
+
+@pytest.mark.skipif(os.environ.get('VYSOS_BENCHMARK', None) is None,
+                    reason='set VYSOS_BENCHMARK to run benchmarks')
+def test_find_unanalyzed_benchmark(capsys):
+    '''Compare one $in query per scan with the old query per file, with 0.2 ms
+    of simulated latency per query.
+    '''
+    frames = frame_names(5000)
+
+    images = FakeImages(frames[:4000], latency=0.0002)
+    start = time.monotonic()
+    old = [f for f in frames if len(images.find({'filename': f})) == 0]
+    old_time = time.monotonic() - start
+    old_queries = images.queries
+
+    images = FakeImages(frames[:4000], latency=0.0002)
+    start = time.monotonic()
+    new = make_watcher(images).find_unanalyzed(frames)
+    new_time = time.monotonic() - start
+
+    assert new == old
+    assert (old_queries, images.queries) == (5000, 1)
+    with capsys.disabled():
+        print(f'\n  5000 frames: per file {old_time:.2f} s ({old_queries} queries), '
+              f'$in {new_time:.3f} s ({images.queries} query)')
+
@@ -0,0 +1,41 @@
+'''
+Tests of the retry of files which were still being written when the
+directory watcher first saw them.
+'''
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('astropy')
+
+from test_watch_directory import FakeImages, frame_names, make_watcher
+
+
+##-------------------------------------------------------------------------
+## Files Still Being Written
+##-------------------------------------------------------------------------
+def test_check_files_retries_pending(tmp_path):
+    watcher = make_watcher(FakeImages([]))
+    name = frame_names(1)[0]
+    (tmp_path / name).write_bytes(b'')
+    ## Empty (still being written) so it is kept pending, not dropped
+    watcher.check_files(str(tmp_path), [name])
+    assert watcher.queue.empty()
+    assert watcher.pending == {name}
+    ## No new event for the file, but it is picked up on the next check
+    (tmp_path / name).write_bytes(b'data')
+    watcher.check_files(str(tmp_path), [])
+    assert watcher.queue.get_nowait() == str(tmp_path / name)
+    assert watcher.pending == set()
+
+
+def test_check_files_skips_analyzed_and_removed(tmp_path):
+    frames = frame_names(3)
+    for name in frames:
+        (tmp_path / name).write_bytes(b'data')
+    watcher = make_watcher(FakeImages(frames[:1]))
+    watcher.pending = {'V5_M42-20180601at999999.fts'}
+    watcher.check_files(str(tmp_path), frames + ['notes.txt'])
+    queued = [watcher.queue.get_nowait() for i in range(watcher.queue.qsize())]
+    assert queued == [str(tmp_path / name) for name in frames[1:]]
+    assert watcher.pending == set()
@@ -2,228 +2,324 @@ from __future__ import division, print_function
 
 ## Import General Tools
 import sys
-import os
 import argparse
 import logging
 from datetime import datetime as dt
 from datetime import timedelta as tdelta
-import re
-import glob
+import json
 from time import sleep
 
-import pymongo
-
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import RequestHandler, Application, url, StaticFileHandler
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from tornado.escape import xhtml_escape
 import tornado.log as tlog
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-import ephem
 
 import IQMon
 from VYSOS import weather_limits
+from VYSOS.status_data import get_astronomy, get_disks, get_latest,\
+                               get_image_list, get_flat_list, sun_event_strings
 
 
 ##-------------------------------------------------------------------------
 ## Get Telescope Status
 ##-------------------------------------------------------------------------
-def get_status(telescope, db):
-    collection = db[f'{telescope}status']
-    two_min_ago = dt.utcnow() - tdelta(0, 2*60)
-    values = [x for x in
-              collection.find( {'date': {'$gt': two_min_ago}} ).sort('date')]
-    try:
-        current = status_values[-1]
-    except:
-        current = None
-    return current
+def get_status(telescope):
+    return get_latest(f'{telescope}status')
 
 
-##-------------------------------------------------------------------------
-## Check for Images
-##-------------------------------------------------------------------------
-def get_image_list(telescope, date):
-#     path = os.path.join('/Volumes/Data_{}/Images/{}'.format(telescope, date))
-    path = os.path.join('/', 'Users', 'vysosuser', f'{telescope}Data', 'Images', f'{date}')
-    image_list = glob.glob(os.path.join(path, '{}*fts'.format(telescope)))
-    return image_list
+##-----------------------------------------------------------------------------
+## Gather Status Information
+##-----------------------------------------------------------------------------
+def get_status_data(nowut):
+    '''Collect everything shown on the status page.  This does blocking file
+    system and mongo access, so the handler runs it in a thread pool.
+    '''
+    ##------------------------------------------------------------------------
+    ## Look up sunrise and sunset times
+    ##------------------------------------------------------------------------
+    sun, moon = get_astronomy()
 
-##-------------------------------------------------------------------------
-## Check for Flats
-##-------------------------------------------------------------------------
-def get_flat_list(telescope, date):
-#     path = os.path.join('/Volumes/Data_{}/Images/{}/AutoFlat'.format(telescope, date))
-    path = os.path.join('/', 'Users', 'vysosuser', f'{telescope}Data', 'Images', f'{date}', 'AutoFlat')
-    image_list = glob.glob(os.path.join(path, 'AutoFlat*fts'))
-    return image_list
+    tlog.app_log.info('  Ephem data calculated')
 
+    ##---------------------------------------------------------------------
+    ## Get disk use info
+    ##---------------------------------------------------------------------
+    disks = get_disks()
 
-##-------------------------------------------------------------------------
-## Check Free Space on Drive
-##-------------------------------------------------------------------------
-def free_space(path):
-    statvfs = os.statvfs(path)
-    size = statvfs.f_frsize * statvfs.f_blocks * u.byte
-    avail = statvfs.f_frsize * statvfs.f_bfree * u.byte
-
-    if re.search('\/Volumes\/DataCopy', path):
-        print('Correcting for 4.97 TB disk capacity')
-        capacity = (4.97*u.TB).to(u.byte)
-        correction = size - capacity
-        size -= correction
-        avail -= correction
-    elif re.search('\/Volumes\/MLOData', path):
-        print('Correcting for 16 TB disk capacity')
-        capacity = (16.89*u.TB).to(u.byte)
-        correction = size - capacity
-        size -= correction
-        avail -= correction
-        if capacity > 16*u.TB:
-            correction2 = (capacity - 16*u.TB).to(u.byte)
-            size -= correction2
-    used = (size - avail)/size
-
-    return (size.to(u.GB).value, avail.to(u.GB).value, used.to(u.percent).value)
+    tlog.app_log.info('  Disk use data determined')
+
+    ##---------------------------------------------------------------------
+    ## Get Telescope Status
+    ##---------------------------------------------------------------------
+    telstatus = {}
+    tlog.app_log.info(f"Getting telescope status records from mongo")
+    for telescope in ['V20', 'V5']:
+        telstatus[telescope] = get_latest(f'{telescope}status')
+        if telstatus[telescope] is not None:
+            if 'RA' in telstatus[telescope] and 'DEC' in telstatus[telescope]:
+                coord = SkyCoord(telstatus[telescope]['RA'],
+                                 telstatus[telescope]['DEC'], unit=u.deg)
+                telstatus[telescope]['RA'], telstatus[telescope]['DEC'] = coord.to_string('hmsdms', sep=':', precision=0).split()
+            tlog.app_log.info(f"  Got telescope status record for {telescope}")
+        else:
+            telstatus[telescope] = {'date': dt.utcnow()-tdelta(365),
+                                    'connected': False}
+            tlog.app_log.info(f"  No telescope status records for {telescope}.")
+            tlog.app_log.info(f"  Filling in blank data for {telescope}.")
+    
+    
+    ##---------------------------------------------------------------------
+    ## Get Current Weather
+    ##---------------------------------------------------------------------
+    tlog.app_log.info(f"Getting weather records from mongo")
+    cw = get_latest('weather')
+    tlog.app_log.info(f"  Done")
+    
+    ##---------------------------------------------------------------------
+    ## Get Image and Flat Lists
+    ##---------------------------------------------------------------------
+    if nowut.hour < 6 and sun['now'] == 'day' and sun['set'] is not None\
+       and (sun['set']-nowut).total_seconds() >= 60.*60.:
+        link_date_string = (nowut - tdelta(1,0)).strftime('%Y%m%dUT')
+        files_string = "Last Night's Files"
+    elif sun['now'] != 'day':
+        link_date_string = nowut.strftime('%Y%m%dUT')
+        files_string = "Tonight's Files"
+    else:
+        link_date_string = nowut.strftime('%Y%m%dUT')
+        files_string = "Last Night's Files"
+
+    return {'disks': disks,
+            'link_date_string': link_date_string,
+            'moon': moon,
+            'sun': sun,
+            'telstatus': telstatus,
+            'files_string': files_string,
+            'v5_images': get_image_list('V5', link_date_string),
+            'v20_images': get_image_list('V20', link_date_string),
+            'v5_flats': get_flat_list('V5', link_date_string),
+            'v20_flats': get_flat_list('V20', link_date_string),
+            'currentweather': cw,
+           }
 
 
 ##-----------------------------------------------------------------------------
-## Handler for Status Page
+## Format Status Information
 ##-----------------------------------------------------------------------------
-class Status(RequestHandler):
-    def get(self, input):
-        tlog.app_log.info('Get request for Status "{}" recieved'.format(input))
-        nowut = dt.utcnow()
-        now = nowut - tdelta(0,10*60*60)
+def font(text, color=None):
+    text = xhtml_escape(text)
+    if color is None:
+        return text
+    return f'<font color="{color}">{text}</font>'
+
+
+def classify(value, limits, names, colors=('green', 'yellow', 'red')):
+    '''Return the condition name and color for a value given the two limits.
+    '''
+    if value < limits[0]:
+        return names[0], colors[0]
+    elif value >= limits[0] and value < limits[1]:
+        return names[1], colors[1]
+    elif value >= limits[1]:
+        return names[2], colors[2]
+    else:
+        return 'Unknown', 'red'
+
 
-        client = pymongo.MongoClient('192.168.1.101', 27017)
-        db = client['vysos']
-
-        ##------------------------------------------------------------------------
-        ## Use pyephem determine sunrise and sunset times
-        ##------------------------------------------------------------------------
-        Observatory = ephem.Observer()
-        Observatory.lon = "-155:34:33.9"
-        Observatory.lat = "+19:32:09.66"
-        Observatory.elevation = 3400.0
-        Observatory.temp = 10.0
-        Observatory.pressure = 680.0
-        Observatory.horizon = '0.0'
-
-        Observatory.date = nowut
-        TheSun = ephem.Sun()
-        TheSun.compute(Observatory)
-        sun = {}
-        sun['alt'] = float(TheSun.alt) * 180. / ephem.pi
-        sun['set'] = Observatory.next_setting(TheSun).datetime()
-        sun['rise'] = Observatory.next_rising(TheSun).datetime()
-        if sun['alt'] <= -18:
-            sun['now'] = 'night'
-        elif sun['alt'] > -18 and sun['alt'] <= -12:
-            sun['now'] = 'astronomical twilight'
-        elif sun['alt'] > -12 and sun['alt'] <= -6:
-            sun['now'] = 'nautical twilight'
-        elif sun['alt'] > -6 and sun['alt'] <= 0:
-            sun['now'] = 'civil twilight'
-        elif sun['alt'] > 0:
-            sun['now'] = 'day'
-
-        TheMoon = ephem.Moon()
-        Observatory.date = nowut
-        TheMoon.compute(Observatory)
-        moon = {}
-        moon['phase'] = TheMoon.phase
-        moon['alt'] = TheMoon.alt * 180. / ephem.pi
-        moon['set'] = Observatory.next_setting(TheMoon).datetime()
-        moon['rise'] = Observatory.next_rising(TheMoon).datetime()
-        if moon['alt'] > 0:
-            moon['now'] = 'up'
+def status_fields(data, nowut):
+    '''Return a dict of element id: html for each of the live values on the
+    status page.  The page is rendered from these and the same dict is used
+    to send updates to connected clients.
+    '''
+    now = nowut - tdelta(0,10*60*60)
+    fields = {'time-hst': now.strftime('%Y/%m/%d %H:%M:%S HST'),
+              'time-ut': nowut.strftime('%Y/%m/%d %H:%M:%S UT'),
+              'link-date': data['link_date_string'],
+              'files-string': xhtml_escape(data['files_string']),
+             }
+
+    ##---------------------------------------------------------------------
+    ## Weather
+    ##---------------------------------------------------------------------
+    cw = data['currentweather']
+    for key in ['temp', 'clouds', 'wind', 'gust', 'rain']:
+        fields[f'weather-{key}'] = ''
+    fields['weather-age'] = ''
+    if cw is None:
+        fields['weather-safe'] = font('None', 'red')
+    else:
+        age = (nowut - cw['date']).total_seconds()
+        fields['weather-age'] = 'Weather Data Age: {:.1f}s'.format(age)
+        if age >= 60:
+            fields['weather-safe'] = font('Stale', 'red')
+        elif cw.get('safe', None) is True:
+            fields['weather-safe'] = font('Safe', 'green')
+        elif cw.get('safe', None) is False:
+            fields['weather-safe'] = font('Unsafe', 'red')
         else:
-            moon['now'] = 'down'
+            fields['weather-safe'] = font('Unknown', 'red')
+        if cw.get('temp', None):
+            fields['weather-temp'] = '{:.1f} C, {:.1f} F'.format(float(cw['temp']), float(cw['temp'])*1.8+32.)
+        if cw.get('clouds', None):
+            fields['weather-clouds'] = font(*classify(cw['clouds'], weather_limits['Cloudiness (C)'],
+                                                      ['Clear', 'Cloudy', 'Overcast']))\
+                                       + ' ({:.1f} C)'.format(cw['clouds'])
+        for key in ['wind', 'gust']:
+            if cw.get(key, None):
+                fields[f'weather-{key}'] = font(*classify(cw[key], weather_limits['Wind (kph)'],
+                                                          ['Calm', 'Windy', 'Very Windy']))\
+                                           + ' ({:.1f} kph)'.format(cw[key])
+        if cw.get('rain', None):
+            if cw['rain'] > weather_limits['Rain'][0]:
+                fields['weather-rain'] = font('Dry', 'green')
+            else:
+                fields['weather-rain'] = font('Wet', 'red')
+            fields['weather-rain'] += ' ({:.0f})'.format(cw['rain'])
 
-        tlog.app_log.info('  Ephem data calculated')
+    ##---------------------------------------------------------------------
+    ## Disks
+    ##---------------------------------------------------------------------
+    disks = data['disks']
+    for disk, label, low in [('DroboPro', 'MLOData', 20),
+                             ('Drobo', 'DataCopy', 300),
+                             ('macOS', 'macOS', 40)]:
+        fields[f'disk-{disk}'] = ''
+        if disk in disks.keys():
+            color = 'red' if disks[disk][1] < low else 'black'
+            fields[f'disk-{disk}'] = f'<font color="{color}">'\
+                f'<font style="font-family: Courier, monospace">{label}</font>: '\
+                '{:.0f}GB free ({:.0f}% full)</font>'.format(disks[disk][1], disks[disk][2])
 
-        ##---------------------------------------------------------------------
-        ## Get disk use info
-        ##---------------------------------------------------------------------
-        paths = {'Drobo': os.path.join('/', 'Volumes', 'DataCopy'),\
-                 'macOS': os.path.expanduser('~'),\
-                 'DroboPro': os.path.join('/', 'Volumes', 'MLOData'),\
-                }
+    ##---------------------------------------------------------------------
+    ## Sun and Moon
+    ##---------------------------------------------------------------------
+    sun = data['sun']
+    moon = data['moon']
+    fields['sun-now'] = 'It is currently {} (Sun alt = {:.0f})'.format(sun['now'], sun['alt'])
+    fields['moon-now'] = 'A {:.0f}% illuminated moon is {}'.format(moon['phase'], moon['now'])
+    fields['sun-next1'], fields['sun-next2'] = sun_event_strings(sun)
 
-        disks = {}
-        for disk in paths.keys():
-            if os.path.exists(paths[disk]):
-                size_GB, avail_GB, pcnt_used = free_space(paths[disk])
-                disks[disk] = [size_GB, avail_GB, pcnt_used]
+    ##---------------------------------------------------------------------
+    ## Telescopes
+    ##---------------------------------------------------------------------
+    for telescope in ['V5', 'V20']:
+        ts = data['telstatus'][telescope]
+        fields[f'{telescope}-connected'] = xhtml_escape(str(ts.get('connected', '')))
+        fields[f'{telescope}-status'] = ''
+        if ts.get('connected', False):
+            if ts.get('slewing', False):
+                fields[f'{telescope}-status'] = font('Slewing', 'orange')
+            elif ts.get('tracking', False):
+                fields[f'{telescope}-status'] = font('Tracking', 'green')
+            elif ts.get('park', False):
+                fields[f'{telescope}-status'] = font('Parked', 'black')
+            else:
+                fields[f'{telescope}-status'] = font('Stationary', 'black')
+        for key in ['alt', 'az']:
+            fields[f'{telescope}-{key}'] = '{:.1f}'.format(ts[key]) if key in ts else ''
+        for key in ['RA', 'DEC']:
+            fields[f'{telescope}-{key}'] = xhtml_escape(str(ts[key])) if key in ts else ''
+        fields[f'{telescope}-age'] = '{:.1f} min'.format((nowut-ts['date']).total_seconds()/60.)
+        fields[f'{telescope}-images'] = '{:d}'.format(len(data[f'{telescope.lower()}_images']))
+        fields[f'{telescope}-flats'] = '{:d}'.format(len(data[f'{telescope.lower()}_flats']))
 
-        tlog.app_log.info('  Disk use data determined')
+    return fields
+
+
+##-----------------------------------------------------------------------------
+## Handler for Status Page
+##-----------------------------------------------------------------------------
+class Status(RequestHandler):
+    def initialize(self, executor=None):
+        self.executor = executor
+
+    async def get(self, input):
+        tlog.app_log.info('Get request for Status "{}" recieved'.format(input))
+        nowut = dt.utcnow()
+        now = nowut - tdelta(0,10*60*60)
+
+        status_data = await IOLoop.current().run_in_executor(self.executor,
+                                                             get_status_data, nowut)
 
-        ##---------------------------------------------------------------------
-        ## Get Telescope Status
-        ##---------------------------------------------------------------------
-        telstatus = {}
-        tlog.app_log.info(f"Getting telescope status records from mongo")
-        for telescope in ['V20', 'V5']:
-            try:
-                telstatus[telescope] = (db[f'{telescope}status'].find(limit=1, sort=[('date', pymongo.DESCENDING)])).next()
-                if 'RA' in telstatus[telescope] and 'DEC' in telstatus[telescope]:
-                    coord = SkyCoord(telstatus[telescope]['RA'],
-                                     telstatus[telescope]['DEC'], unit=u.deg)
-                    telstatus[telescope]['RA'], telstatus[telescope]['DEC'] = coord.to_string('hmsdms', sep=':', precision=0).split()
-                tlog.app_log.info(f"  Got telescope status record for {telescope}")
-            except StopIteration:
-                telstatus[telescope] = {'date': dt.utcnow()-tdelta(365),
-                                        'connected': False}
-                tlog.app_log.info(f"  No telescope status records for {telescope}.")
-                tlog.app_log.info(f"  Filling in blank data for {telescope}.")
-        
-        
-        ##---------------------------------------------------------------------
-        ## Get Current Weather
-        ##---------------------------------------------------------------------
-        tlog.app_log.info(f"Getting weather records from mongo")
-        weather = client.vysos['weather']
-        if weather.count() > 0:
-            cw = weather.find(limit=1, sort=[('date', pymongo.DESCENDING)]).next()
-        else:
-            cw = None
-        tlog.app_log.info(f"  Done")
-        
         ##---------------------------------------------------------------------
         ## Render
         ##---------------------------------------------------------------------
-        if nowut.hour < 6 and sun['now'] == 'day' and (sun['set']-nowut).total_seconds() >= 60.*60.:
-            link_date_string = (nowut - tdelta(1,0)).strftime('%Y%m%dUT')
-            files_string = "Last Night's Files"
-        elif sun['now'] != 'day':
-            link_date_string = nowut.strftime('%Y%m%dUT')
-            files_string = "Tonight's Files"
-        else:
-            link_date_string = nowut.strftime('%Y%m%dUT')
-            files_string = "Last Night's Files"
-
         tlog.app_log.info('  Rendering Status')
         cctv = False
         if input.lower() in ["cctv", "cctv.html"]:
             cctv = True
         self.render("status.html", title="VYSOS Status",
                     now = (now, nowut),
-                    disks = disks,
-                    link_date_string = link_date_string,
-                    moon = moon,
-                    sun = sun,
-                    telstatus=telstatus,
-                    files_string = files_string,\
-                    v5_images = get_image_list('V5', link_date_string),\
-                    v20_images = get_image_list('V20', link_date_string),\
-                    v5_flats = get_flat_list('V5', link_date_string),\
-                    v20_flats = get_flat_list('V20', link_date_string),\
                     cctv=cctv,
-                    currentweather=cw,
                     weather_limits=weather_limits,
-                    )
+                    fields=status_fields(status_data, nowut),
+                    **status_data)
         tlog.app_log.info('  Done')
 
 
+##-----------------------------------------------------------------------------
+## Live Status Updates
+##-----------------------------------------------------------------------------
+class StatusBroadcaster(object):
+    '''Sample the status once per interval and send the fields which changed
+    to every connected client.  The sampling cost does not depend on the
+    number of clients and no sampling is done when there are none.  The
+    sampling runs on the given executor (the web server's thread pool).
+    '''
+    def __init__(self, interval=5, executor=None):
+        self.interval = interval
+        self.executor = executor
+        self.clients = set()
+        self.fields = {}
+        self.sampling = False
+        self.callback = PeriodicCallback(self.tick, interval*1000)
+
+    def start(self):
+        self.callback.start()
+
+    def tick(self):
+        if len(self.clients) > 0 and not self.sampling:
+            IOLoop.current().spawn_callback(self.sample)
+
+    async def sample(self):
+        self.sampling = True
+        try:
+            nowut = dt.utcnow()
+            status_data = await IOLoop.current().run_in_executor(self.executor,
+                                                                 get_status_data, nowut)
+            fields = status_fields(status_data, nowut)
+        except Exception as e:
+            tlog.app_log.warning(f'Failed to sample status: {e}')
+            return
+        finally:
+            self.sampling = False
+        changed = {k: v for k, v in fields.items() if self.fields.get(k, None) != v}
+        self.fields = fields
+        if len(changed) > 0:
+            self.broadcast(json.dumps(changed))
+
+    def broadcast(self, message):
+        for client in list(self.clients):
+            try:
+                client.write_message(message)
+            except WebSocketClosedError:
+                self.clients.discard(client)
+
+
+class StatusSocket(WebSocketHandler):
+    def initialize(self, broadcaster):
+        self.broadcaster = broadcaster
 
+    def open(self):
+        tlog.app_log.info('Status client connected')
+        self.broadcaster.clients.add(self)
+        if len(self.broadcaster.fields) > 0:
+            self.write_message(json.dumps(self.broadcaster.fields))
 
+    def on_close(self):
+        tlog.app_log.info('Status client disconnected')
+        self.broadcaster.clients.discard(self)
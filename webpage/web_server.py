@@ -12,32 +12,114 @@ from datetime import timedelta as tdelta
 from argparse import ArgumentParser
 import re
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 import pymongo
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
 
 from tornado.ioloop import IOLoop
-from tornado.web import RequestHandler, Application, url, StaticFileHandler
-from tornado import websocket
+from tornado.web import RequestHandler, Application, url, StaticFileHandler, HTTPError
 import tornado.log as tlog
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
-import ephem
 
 from VYSOS import Telescope
+from VYSOS.db import get_collection
+
+##-----------------------------------------------------------------------------
+## HTTP caching
+##-----------------------------------------------------------------------------
+## Pages for past nights and the per-image plots (named after the image,
+## e.g. V5_M42-20180101at101010.jpg) from past nights do not change, so
+## they are cached by the browser.  Everything else, including logs and the
+## nightly and recent plots which are rewritten in place, is revalidated on
+## each request using an ETag, so an unchanged resource costs a 304 rather
+## than a full response.
+historical_max_age = 7*24*60*60
+immutable_files = re.compile('(^|/)[^/]*(\d{8})at\d{6}[^/]*\.(jpg|png)$')
+
+
+def is_historical(date_string):
+    '''True if the UT date (YYYYMMDDUT) is over a day in the past, so no more
+    images or plots will be added for it.
+    '''
+    try:
+        date = dt.strptime(date_string, '%Y%m%dUT')
+    except ValueError:
+        return False
+    return date + tdelta(2) < dt.utcnow()
+
+
+def set_cache_headers(handler, version, historical=False):
+    '''Set the ETag and Cache-Control headers for a dynamic page and return
+    True if the client already has this version (in which case a 304 has
+    been set and the handler should return without rendering).
+    '''
+    handler.set_header('Etag', '"{}"'.format(version))
+    if historical:
+        handler.set_header('Cache-Control', f'public, max-age={historical_max_age}')
+    else:
+        handler.set_header('Cache-Control', 'no-cache')
+    if handler.check_etag_header():
+        handler.set_status(304)
+        return True
+    return False
+
+
+def collection_version(collection, match={}):
+    '''Version string for the documents matching the query: the newest _id,
+    from a single sorted find_one (no count, so the cost does not grow with
+    the number of documents).  Analysis results are never modified in place
+    (a reanalysis deletes the document and inserts it with a new _id), so
+    this changes whenever a matching document is added or reanalysed.
+    '''
+    latest = collection.find_one(match, projection={'_id': 1},
+                                 sort=[('_id', pymongo.DESCENDING)])
+    return str(latest['_id']) if latest is not None else 'none'
+
 
 class MyStaticFileHandler(StaticFileHandler):
+    def compute_etag(self):
+        # Use mtime and size rather than hashing the file contents
+        stat = os.stat(self.absolute_path)
+        return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    def get_cache_time(self, path, modified, mime_type):
+        if self.is_immutable(path):
+            return historical_max_age
+        return 0
+
     def set_extra_headers(self, path):
-        # Disable cache
-        self.set_header('Cache-Control', 'no-store, no-cache, must-revalidate, max-age=0')
+        if not self.is_immutable(path):
+            self.set_header('Cache-Control', 'no-cache')
+
+    def is_immutable(self, path):
+        '''Only the per-image plots from past nights are cached without
+        revalidation.  Logs (e.g. watch_directory.txt), the recent and
+        status plots, and the nightly plots (which a reanalysis rewrites)
+        are all revalidated against the mtime and size ETag.
+        '''
+        match = immutable_files.search(path)
+        return match is not None and is_historical(f'{match.group(2)}UT')
+
+
+##-----------------------------------------------------------------------------
+## Run blocking work (mongo queries, file system access) in a thread pool so
+## that it does not block the IOLoop.
+##-----------------------------------------------------------------------------
+executor = ThreadPoolExecutor(max_workers=16)
+
+def run_blocking(func, *args):
+    return IOLoop.current().run_in_executor(executor, func, *args)
 
 
 ##-----------------------------------------------------------------------------
 ## Handler for image detail page
 ##-----------------------------------------------------------------------------
 class ImageDetailPage(RequestHandler):
-    def get(self, telescope, night, imagefile):
+    async def get(self, telescope, night, imagefile):
         tlog.app_log.info('Get request for ImageDetailPage recieved')
         tlog.app_log.info(f'  telescope = {telescope}')
         tlog.app_log.info(f'  night     = {night}')
@@ -47,17 +129,17 @@ class ImageDetailPage(RequestHandler):
 
         tel = Telescope(telescope)
 
-        tlog.app_log.info('  Linking to mongo')
-        client = MongoClient(tel.mongo_address, tel.mongo_port)
-        tlog.app_log.info('  Connected to client.')
-        db = client[tel.mongo_db]
-        collection = db[tel.mongo_collection]
+        collection = get_collection(tel.mongo_collection, tel=tel)
         tlog.app_log.info('  Retrieved collection.')
         
-        image_list = [entry for entry in\
-                      collection.find( {"filename": imagefile } )]
+        def find_images():
+            return [entry for entry in collection.find( {"filename": imagefile } )]
+        image_list = await run_blocking(find_images)
         tlog.app_log.info(f'  Found {len(image_list)} images with filename {imagefile}.')
 
+        if set_cache_headers(self, image_list[0]['_id'], is_historical(night)):
+            return
+
         tlog.app_log.info('  Rendering ImageDetailPage')
         self.render("image_detail.html", imagefile=imagefile,
                     image_info=image_list[0])
@@ -69,66 +151,210 @@ class ImageDetailPage(RequestHandler):
 ##-----------------------------------------------------------------------------
 ## Handler for list of images
 ##-----------------------------------------------------------------------------
+## Fields of the image documents shown in image_list.html
+image_fields = ['date', 'filename', 'jpegs', 'PSF plot', 'ZP plot', 'logfile',
+                'alt', 'az', 'airmass', 'moon_separation', 'moon_alt',
+                'moon_illumination', 'FWHM_pix', 'ellipticity', 'perr_arcmin',
+                'zero point', 'n_stars']
+
+
+def flag_expression(field, limit):
+    '''Aggregation expression which is true if the field exceeds the limit.
+    Missing fields compare as null which is never greater than the limit.
+    '''
+    limit = getattr(limit, 'value', limit)
+    if limit is None:
+        return False
+    return {'$cond': [{'$gt': ['$'+field, float(limit)]}, True, False]}
+
+
+def encode_cursor(image):
+    return '{}_{}'.format(image['date'].strftime('%Y%m%dT%H%M%S.%f'), image['_id'])
+
+
+def decode_cursor(cursor):
+    date_string, id_string = cursor.split('_')
+    return dt.strptime(date_string, '%Y%m%dT%H%M%S.%f'), ObjectId(id_string)
+
+
+def get_subject_match(collection, subject):
+    '''Return the query and sort direction for the images for the subject (a
+    date or target name) or None, None if the subject is neither.
+    '''
+    ##---------------------------------------------------------------------
+    ## If subject is formatted like a date, then get images from a date
+    ##---------------------------------------------------------------------
+    if re.match('\d{8}UT', subject):
+        start = dt.strptime(subject, '%Y%m%dUT')
+        end = start + tdelta(1)
+        match = {"date": {"$gt": start, "$lt": end} }
+        direction = pymongo.ASCENDING
+    ##---------------------------------------------------------------------
+    ## If subject matches a target name, then get images for that target
+    ##---------------------------------------------------------------------
+    elif collection.find_one({"target name": subject}, projection={'_id': 1}) is not None:
+        match = {"target name": subject}
+        direction = pymongo.DESCENDING
+    else:
+        return None, None
+    return match, direction
+
+
+def get_image_list(tel, collection, match, direction, after=None, page_size=200):
+    '''Return one page of image documents for the query and sort direction
+    from get_subject_match and the cursor string for the next page (None if
+    this is the last page).  If the match is None (the subject is not a date
+    or target) this returns None, None.
+
+    Only the fields shown in image_list.html are returned and the flags for
+    each image are computed by the aggregation.  Pages are keyed on (date,
+    _id) so the cost of a request depends only on the page size.
+    '''
+    if match is None:
+        return None, None
+
+    if after is not None:
+        date, _id = decode_cursor(after)
+        op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+        match = {'$and': [match, {'$or': [{'date': {op: date}},
+                                          {'date': date, '_id': {op: _id}}]}]}
+
+    pipeline = [{'$match': match},
+                {'$sort': {'date': direction, '_id': direction}},
+                {'$limit': page_size+1},
+                {'$project': {field: 1 for field in image_fields}},
+                {'$addFields': {'flags': {
+                    'FWHM': flag_expression('FWHM_pix', tel.FWHM_limit_pix),
+                    'ellipticity': flag_expression('ellipticity', tel.ellipticity_limit),
+                    'pointing error': flag_expression('perr_arcmin', tel.pointing_error_limit),
+                    'zero point': False,
+                }}},
+               ]
+    image_list = list(collection.aggregate(pipeline))
+    tlog.app_log.info('  Got list of {} images.'.format(len(image_list)))
+    if len(image_list) > page_size:
+        image_list = image_list[:page_size]
+        return image_list, encode_cursor(image_list[-1])
+    return image_list, None
+
+
+def get_target_counts(collection, page=1, page_size=100):
+    '''Return one page of the target index and the total number of targets.
+    Each entry is a dict with the target name, number of images, first and
+    last observation date, and median FWHM in pixels, all computed in a
+    single aggregation.
+    '''
+    group = {'_id': '$target name',
+             'n': {'$sum': 1},
+             'first': {'$min': '$date'},
+             'last': {'$max': '$date'},
+             'median FWHM': {'$median': {'input': '$FWHM_pix', 'method': 'approximate'}},
+            }
+    def pipeline(group):
+        return [{'$match': {'target name': {'$type': 'string'}}},
+                {'$group': group},
+                {'$sort': {'_id': pymongo.ASCENDING}},
+                {'$facet': {'total': [{'$count': 'n'}],
+                            'page': [{'$skip': (page-1)*page_size},
+                                     {'$limit': page_size}],
+                           }},
+               ]
+    try:
+        result = list(collection.aggregate(pipeline(group)))[0]
+    except pymongo.errors.OperationFailure:
+        ## $median needs mongo 7.0, on older servers collect the FWHM values
+        ## for each target and take the median here.
+        group['median FWHM'] = {'$push': '$FWHM_pix'}
+        result = list(collection.aggregate(pipeline(group)))[0]
+        for entry in result['page']:
+            values = sorted([x for x in entry['median FWHM']
+                             if isinstance(x, (int, float))])
+            n = len(values)
+            if n == 0:
+                entry['median FWHM'] = None
+            elif n % 2 == 1:
+                entry['median FWHM'] = values[n//2]
+            else:
+                entry['median FWHM'] = (values[n//2-1] + values[n//2])/2.
+    n_targets = result['total'][0]['n'] if len(result['total']) > 0 else 0
+    targets = [{'target': entry['_id'],
+                'n images': entry['n'],
+                'first': entry['first'],
+                'last': entry['last'],
+                'median FWHM': entry['median FWHM'],
+               } for entry in result['page']]
+    return targets, n_targets
+
+
 class ListOfImages(RequestHandler):
-    def get(self, telescope, subject):
+    async def get(self, telescope, subject):
         tlog.app_log.info('Get request for ListOfImages recieved')
 
         ## Create Telescope Object
-#         tlog.app_log.info('  Creating telescope object')
-#         config_file = os.path.join(os.path.expanduser('~'), '.{}.yaml'.format(telescope))
         tel = Telescope(telescope)
         telescopename = tel.name
         tlog.app_log.info('  Done.')
 
-        tlog.app_log.info('  Linking to mongo')
-        client = MongoClient(tel.mongo_address, tel.mongo_port)
-        tlog.app_log.info('  Connected to client.')
-        db = client[tel.mongo_db]
-        collection = db[tel.mongo_collection]
+        collection = get_collection(tel.mongo_collection, tel=tel)
         tlog.app_log.info('  Retrieved collection.')
 
+        after = self.get_argument('after', None)
+        page = self.get_argument('page', '1')
+        def get_version():
+            match, direction = get_subject_match(collection, subject)
+            version = collection_version(collection, match if match is not None else {})
+            return match, direction, version
+        match, direction, version = await run_blocking(get_version)
+        if set_cache_headers(self, f'{subject}-{after}-{page}-{version}',
+                             is_historical(subject)):
+            return
+
         tlog.app_log.info('  Getting list of images from mongo')
+        try:
+            image_list, next_page = await run_blocking(get_image_list, tel, collection,
+                                                       match, direction, after)
+        except (ValueError, InvalidId):
+            raise HTTPError(400, 'Invalid page cursor')
 
-        ##---------------------------------------------------------------------
-        ## If subject is formatted like a date, then get images from a date
-        ##---------------------------------------------------------------------
-        if re.match('\d{8}UT', subject):
-            start = dt.strptime(subject, '%Y%m%dUT')
-            end = start + tdelta(1)
-            image_list = [entry for entry in\
-                          collection.find( {"date": {"$gt": start, "$lt": end} } ).sort(\
-                          [('date', pymongo.ASCENDING)])]
-            tlog.app_log.info('  Got list of {} images for night.'.format(len(image_list)))
-        ##---------------------------------------------------------------------
-        ## If subject matches a target name, then get images for that target
-        ##---------------------------------------------------------------------
-        else:
-            tlog.app_log.info('    Getting list of target names from mongo')
-            target_name_list = sorted(collection.distinct("target name"))
-            if subject in target_name_list:
-                tlog.app_log.info('    Getting list of image list for {} from mongo'.format(subject))
-                image_list = [entry for entry in\
-                              collection.find({"target name":subject}).sort(\
-                              [('date', pymongo.DESCENDING)])]
-                tlog.app_log.info('  Got list of {} images for target.'.format(len(image_list)))
         ##---------------------------------------------------------------------
         ## If subject is not a date or target, then render a list of targets
         ##---------------------------------------------------------------------
-            else:
-                image_list = []
-                self.write('<html><head><style>')
-                self.write('table{border-collapse:collapse;margin-left:auto;margin-right:auto;}')
-                self.write('table,th,td{border:1px solid black;vertical-align:top;text-align:left;')
-                self.write('padding-top:5px;padding-right:5px;padding-bottom:5px;padding-left:5px;}')
-                self.write('</style></head>')
-                if (len(subject) > 0) and not re.match('[tT]argets', subject):
-                    self.write('<p style="text-align:center;">Could not find {} in target list:</p>'.format(subject))
-                self.write('<table style="border:1px solid black;">')
-                self.write('<tr><th>Target</th><th>n Images</th>')
-                for target in target_name_list:
-                    target_images = [entry for entry in collection.find( { "target name": target } ) ]
-                    self.write('<tr><td><a href="{0}">{0}</a></td><td>{1:d}</td></tr>'.format(target, len(target_images)))
-                self.write('</table></html>')
+        if image_list is None:
+            try:
+                page = max(int(page), 1)
+            except ValueError:
+                page = 1
+            page_size = 100
+            targets, n_targets = await run_blocking(get_target_counts,
+                                                    collection, page, page_size)
+            n_pages = max((n_targets + page_size - 1)//page_size, 1)
+            self.write('<html><head><style>')
+            self.write('table{border-collapse:collapse;margin-left:auto;margin-right:auto;}')
+            self.write('table,th,td{border:1px solid black;vertical-align:top;text-align:left;')
+            self.write('padding-top:5px;padding-right:5px;padding-bottom:5px;padding-left:5px;}')
+            self.write('</style></head>')
+            if (len(subject) > 0) and not re.match('[tT]argets', subject):
+                self.write('<p style="text-align:center;">Could not find {} in target list:</p>'.format(subject))
+            self.write('<table style="border:1px solid black;">')
+            self.write('<tr><th>Target</th><th>n Images</th><th>First Image (UT)</th>'
+                       '<th>Last Image (UT)</th><th>Median FWHM (pix)</th></tr>')
+            for target in targets:
+                first = target['first'].strftime('%Y-%m-%d %H:%M') if target['first'] else ''
+                last = target['last'].strftime('%Y-%m-%d %H:%M') if target['last'] else ''
+                FWHM = '{:.2f}'.format(target['median FWHM'])\
+                       if target['median FWHM'] is not None else ''
+                self.write('<tr><td><a href="{0}">{0}</a></td><td>{1:d}</td>'
+                           '<td>{2}</td><td>{3}</td><td>{4}</td></tr>'.format(
+                           target['target'], target['n images'], first, last, FWHM))
+            self.write('</table>')
+            self.write('<p style="text-align:center;">')
+            if page > 1:
+                self.write('<a href="?page={}">previous</a> '.format(page-1))
+            self.write('page {} of {}'.format(page, n_pages))
+            if page < n_pages:
+                self.write(' <a href="?page={}">next</a>'.format(page+1))
+            self.write('</p></html>')
+            return
 
         if tel.units_for_FWHM == u.arcsec:
             FWHM_multiplier = tel.pixel_scale.value
@@ -138,26 +364,6 @@ class ListOfImages(RequestHandler):
             FWHM_multiplier = 1.0
 
         if len(image_list) > 0:
-            tlog.app_log.info('  Determining Flags')
-            flags = []
-            for i,image in enumerate(image_list):
-                flags.append({'FWHM': False,
-                              'ellipticity': False,
-                              'pointing error': False,
-                              'zero point': False,
-                             })
-                try:
-                    flags[i]['FWHM'] = image['FWHM_pix'] > tel.FWHM_limit_pix.value
-                except:
-                    pass
-                try:
-                    flags[i]['ellipticity'] = image['ellipticity'] > tel.ellipticity_limit
-                except:
-                    pass
-                try:
-                    flags[i]['pointing error'] = image['perr_arcmin'] > tel.pointing_error_limit
-                except:
-                    pass
             tlog.app_log.info('  Rendering ListOfImages')
             self.render("image_list.html", title="{} Results".format(telescopename),\
                         telescope = telescope,\
@@ -166,61 +372,67 @@ class ListOfImages(RequestHandler):
                         image_list = image_list,\
                         FWHM_units = tel.units_for_FWHM.to_string(),\
                         FWHM_multiplier = FWHM_multiplier,\
-                        flags=flags,\
+                        first_page = after is not None,\
+                        next_page = next_page,\
                        )
             tlog.app_log.info('  Done.')
 
 ##-----------------------------------------------------------------------------
 ## Handler for list of nights
 ##-----------------------------------------------------------------------------
+def get_nights(collection, telescope):
+    '''Return a list of dicts describing each night with images, most recent
+    first.  The image counts come from a single aggregation grouping the
+    images by UT date and the nightly plots from a single directory listing.
+    '''
+    tlog.app_log.info('  Counting images per night')
+    pipeline = [{'$match': {'date': {'$type': 'date'}}},
+                {'$group': {'_id': {'$dateToString': {'format': '%Y%m%dUT',
+                                                      'date': '$date'}},
+                            'n': {'$sum': 1}}},
+                {'$sort': {'_id': pymongo.DESCENDING}},
+               ]
+    counts = [(entry['_id'], entry['n']) for entry in collection.aggregate(pipeline)]
+    tlog.app_log.info('  Done')
+
+    night_plot_path = os.path.abspath('/var/www/nights/')
+    try:
+        night_plots = set(os.listdir(night_plot_path))
+    except OSError:
+        night_plots = set()
+
+    nights = []
+    for date_string, n_images in counts:
+        night_info = {'date': date_string, 'n images': n_images}
+        night_graph_file = '{}_{}.png'.format(date_string, telescope)
+        if night_graph_file in night_plots:
+            night_info['night graph'] = night_graph_file
+        nights.append(night_info)
+    return nights
+
+
 class ListOfNights(RequestHandler):
 
-    def get(self, telescope):
+    async def get(self, telescope):
         tlog.app_log.info('Get request for ListOfNights recieved')
         telescope = telescope.strip('/')
 
         ## Create Telescope Object
-#         config_file = os.path.join(os.path.expanduser('~'), '.{}.yaml'.format(telescope))
         tel = Telescope(telescope)
         telescopename = tel.name
 
-        client = MongoClient(tel.mongo_address, tel.mongo_port)
-        db = client[tel.mongo_db]
-        collection = db[tel.mongo_collection]
+        collection = get_collection(tel.mongo_collection, tel=tel)
+        def get_version():
+            try:
+                plots_mtime = os.stat('/var/www/nights/').st_mtime_ns
+            except OSError:
+                plots_mtime = 0
+            return '{}-{}-{:x}'.format(telescope, collection_version(collection), plots_mtime)
+        version = await run_blocking(get_version)
+        if set_cache_headers(self, version):
+            return
 
-#         first_date_string = sorted(collection.distinct("date"), reverse=False)[0]
-#         first_date = dt.strptime('{} 00:00:00'.format(first_date_string), '%Y%m%dUT %H:%M:%S')
-        first_date = sorted(collection.distinct("date"), reverse=False)[0]
-        
-        tlog.app_log.info('  Building date_list')
-        date_list = []
-        while first_date <= dt.utcnow():
-            date_list.append(first_date.strftime('%Y%m%dUT'))
-            first_date += tdelta(1, 0)
-        date_list.append(first_date.strftime('%Y%m%dUT'))
-        tlog.app_log.info('  Done')
-
-        night_plot_path = os.path.abspath('/var/www/nights/')
-
-        tlog.app_log.info('  Looping over date_list')
-        nights = []
-        for date_string in date_list:
-            night_info = {'date': date_string }
-
-            night_graph_file = '{}_{}.png'.format(date_string, telescope)
-            if os.path.exists(os.path.join(night_plot_path, night_graph_file)):
-                night_info['night graph'] = night_graph_file
-
-#             night_info['n images'] = collection.find( {"date":date_string} ).count()
-            
-            start = dt.strptime(date_string, '%Y%m%dUT')
-            end = start + tdelta(1)
-            night_info['n images'] = collection.find( {"date": {"$gt": start, "$lt": end} } ).count()
-            
-            if night_info['n images'] > 0:
-                nights.append(night_info)
-        nights.reverse() # reverse sort to put recent dates at top of page
-        tlog.app_log.info('  Done')
+        nights = await run_blocking(get_nights, collection, telescope)
 
         tlog.app_log.info('  Rendering ListOfNights')
         self.render("night_list.html", title="{} Results".format(telescopename),\
@@ -266,8 +478,14 @@ def main():
 
     if args.status:
         tlog.app_log.info('Importing status handler')
-        from custom_handlers import Status
-        list_of_handlers.append(url(r"/()", Status))
+        from custom_handlers import Status, StatusSocket, StatusBroadcaster
+        from VYSOS.status_data import start_watcher
+        start_watcher()
+        broadcaster = StatusBroadcaster(interval=5, executor=executor)
+        broadcaster.start()
+        list_of_handlers.append(url(r"/status/ws", StatusSocket,
+                                    {'broadcaster': broadcaster}))
+        list_of_handlers.append(url(r"/()", Status, {'executor': executor}))
 
 
 #         try: